@@ -1,9 +1,9 @@
 import streamlit as st
 from PIL import Image
-from colourlesstransformer import process_image_complete, clear_output_directory
+from colourlesstransformer import process_image_complete, clear_output_directory, is_out_of_memory, PlanRejected
 import tempfile
+import json
 import os
-from torch import OutOfMemoryError
 
 # Set page config to wide mode
 st.set_page_config(layout="wide")
@@ -21,6 +21,8 @@ Created by **Ethan Marks** ([@ethmarks](https://github.com/ethmarks)).
 2. **Set Parameters (optional):** Change how ColourlessTransformer processes your image by configuring the settings.
     - **Animation**: allows you to choose whether to generate a static image of the finished image or an animated GIF showing the entire painting process.
     - **Resize**: resizes the input image to a maximum of 512 pixels. This is **highly recommended**, as it vastly decreases processing time and memory usage without significantly affecting the quality of the output.
+    - **Memory budget**: optionally limits how much memory processing may use. The image is downscaled as needed to fit, and rejected before any work starts if it cannot fit.
+    - **Profile**: records how long each stage of the painting pipeline takes and how much memory it uses.
 3. **Generate Results:** Click the Generate button to process your uploaded image. Depending on your hardware, the processing should take between a few seconds and a few minutes.
 4. **View Results:** Once processing is complete, view the result in the right column. You can download the result by right-clicking and selecting "Save Image As...".
 """
@@ -31,6 +33,8 @@ if "generated_result" not in st.session_state:
     st.session_state["generated_result"] = None
 if "generated_result_type" not in st.session_state:
     st.session_state["generated_result_type"] = None
+if "profile" not in st.session_state:
+    st.session_state["profile"] = None
 
 # Create two columns for side-by-side display
 col1, col2 = st.columns(2)
@@ -43,6 +47,9 @@ uploaded_file = st.file_uploader(
 # Checkboxes for options
 animation = st.checkbox("Animation", value=False, help="Enable animation for the generated result.")
 resize = st.checkbox("Resize", value=True, help="Resize the input image to a maximum dimension of 512 pixels. Vastly speeds up processing and reduces resource usage for minimal quality reduction.")
+preset = st.selectbox("Quality", ["draft", "standard", "fine"], index=1, help="Draft paints fewer layers and strokes for a quick preview. Fine adds a layer of finer strokes at several times the cost.")
+profile = st.checkbox("Profile", value=False, help="Record the time and memory used by each stage of the painting pipeline.")
+memory_budget = st.text_input("Memory budget", value="", placeholder="e.g. 4GB", help="Optional. The image is downscaled as needed so that processing fits this much memory, and rejected if it cannot fit.").strip() or None
 
 # Add informational section about resizing
 if not resize:
@@ -68,31 +75,53 @@ if st.button("Generate"):
             temp_path = temp_file.name
             image.save(temp_path)
 
+        profile_path = os.path.splitext(temp_path)[0] + ".profile.json" if profile else None
+        st.session_state["profile"] = None
+
         # Simulate a processing delay
         with st.spinner("Processing your image..."):
             try:
                 # Process the image using comprehensive function
-                result_path, result_type = process_image_complete(temp_path, animation, None, resize)
+                result_path, result_type = process_image_complete(
+                    temp_path, animation, None, resize, profile_path, memory_budget, preset
+                )
 
                 # Update session state with the result
                 st.session_state["generated_result"] = result_path
                 st.session_state["generated_result_type"] = result_type
 
-            except OutOfMemoryError as e:
-                # Get image dimensions for more helpful error message
-                img_width, img_height = image.size
+                if profile_path:
+                    trace_path = os.path.splitext(profile_path)[0] + ".trace.json"
+                    with open(profile_path) as f:
+                        profile_json = f.read()
+                    with open(trace_path) as f:
+                        trace_json = f.read()
+                    st.session_state["profile"] = (profile_json, trace_json)
+                    os.unlink(profile_path)
+                    os.unlink(trace_path)
+
+            except PlanRejected as e:
                 st.error(
-                    "⚠️ **GPU Out of Memory Error**\n\n"
-                    f"Your image ({img_width}x{img_height} pixels) is too large for your GPU memory.\n\n"
-                    "**Try these solutions:**\n"
-                    "- ✅ **Enable the 'Resize' option above** (recommended)\n"
-                    "- Use a smaller input image\n"
-                    "- Close other GPU-intensive applications\n"
-                    "- Try processing without animation if enabled\n\n"
-                    f"Technical details: {str(e)}"
+                    "⚠️ **Image too large for the memory budget**\n\n"
+                    f"{str(e)}\n\n"
+                    "Enable the 'Resize' option above, use a smaller image or raise the memory budget."
                 )
             except Exception as e:
-                st.error(f"An error occurred while processing the image: {str(e)}")
+                if is_out_of_memory(e):
+                    # Get image dimensions for more helpful error message
+                    img_width, img_height = image.size
+                    st.error(
+                        "⚠️ **GPU Out of Memory Error**\n\n"
+                        f"Your image ({img_width}x{img_height} pixels) is too large for your GPU memory.\n\n"
+                        "**Try these solutions:**\n"
+                        "- ✅ **Enable the 'Resize' option above** (recommended)\n"
+                        "- Use a smaller input image\n"
+                        "- Close other GPU-intensive applications\n"
+                        "- Try processing without animation if enabled\n\n"
+                        f"Technical details: {str(e)}"
+                    )
+                else:
+                    st.error(f"An error occurred while processing the image: {str(e)}")
             finally:
                 # Clean up temporary input file
                 if temp_path and os.path.exists(temp_path):
@@ -116,6 +145,14 @@ if st.session_state["generated_result"]:
                 use_container_width=True,
             )
 
+# Display the profile of the last run
+if st.session_state["profile"]:
+    profile_json, trace_json = st.session_state["profile"]
+    st.subheader("Profile")
+    st.dataframe(json.loads(profile_json)["summary"], use_container_width=True)
+    st.download_button("Download profile (JSON)", profile_json, file_name="profile.json", mime="application/json")
+    st.download_button("Download Chrome trace", trace_json, file_name="profile.trace.json", mime="application/json")
+
 # Button to clear all image files from output directory
 if st.button("Clear Output Directory"):
     clear_output_directory()
@@ -0,0 +1,101 @@
+"""
+Occlusion culling of hidden strokes: cull rate, speed and equality of results.
+
+Times param2img_parallel with and without culling on random strokes of every brush mode, and end-to-end paint()
+on the samples in inference/input/, and reports the share of active strokes that culling drops (from the
+'culled_strokes' and 'active_strokes' profiling counters, recorded without the memory profiling that would slow
+down the timed runs). Every culled result must be equal to the unculled one, bit for bit; the script exits with
+status 1 otherwise.
+
+    python benchmarks/bench_culling.py
+    python benchmarks/bench_culling.py --save benchmarks/baselines/culling.json
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+
+from bench_inference import make_painter, median_time, random_params
+
+import torch
+from PIL import Image
+
+import inference.inference as inference
+import inference.presets as presets
+from inference.profiling import Profiler
+
+
+def counter_total(profiler, name):
+    return sum(counter['value'] for counter in profiler.counters if counter['name'] == name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--max-dim', type=int, default=512, help='resize samples to this size, 0 keeps them')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', metavar='PATH', help='write the results as JSON')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.set_grad_enabled(False)
+    net_g, _, weights = make_painter(device)
+    meta_brushes = inference.load_brushes(device)
+    generator = torch.Generator().manual_seed(0)
+    rows = []
+
+    for patch_num, patch_size in ((16, 64), (32, 64)):
+        param = random_params(patch_num * patch_num * 8, generator).view(1, patch_num, patch_num, 8, 8).to(device)
+        decision = (torch.rand(1, patch_num, patch_num, 8, generator=generator) > 0.5).to(device)
+        canvas = torch.rand(1, 3, patch_num * patch_size // 2, patch_num * patch_size // 2,
+                            generator=generator).to(device)
+        for brush_mode in presets.BRUSH_MODES:
+            brushes = meta_brushes.brushes('large', patch_size) if brush_mode == 'texture' else brush_mode
+            results = {}
+            for cull in (False, True):
+                profiler = Profiler(memory=False)
+                with profiler.activate():
+                    seconds, results[cull] = median_time(lambda: inference.param2img_parallel(
+                        param, decision, brushes, canvas, cull=cull), args.repeat, device)
+                rows.append({'case': 'param2img_parallel/patches%d/patch%d/%s' % (patch_num, patch_size, brush_mode),
+                             'cull': cull, 'median_s': seconds,
+                             'cull_rate': counter_total(profiler, 'culled_strokes') / (args.repeat + 1)
+                             / max(decision.sum().item(), 1),
+                             'equal': torch.equal(results[cull], results[False])})
+
+    for path in sorted(glob.glob('inference/input/*.jpg')):
+        image = Image.open(path).convert('RGB')
+        if args.max_dim:
+            image.thumbnail((args.max_dim, args.max_dim), Image.LANCZOS)
+        original = inference.img_to_tensor(image, device)
+        name = os.path.splitext(os.path.basename(path))[0]
+        results = {}
+        for cull in (False, True):
+            profiler = Profiler(memory=False)
+            with profiler.activate():
+                seconds, results[cull] = median_time(lambda: inference.paint(
+                    original, net_g, meta_brushes, preset=presets.resolve(cull=cull)), args.repeat, device)
+            rows.append({'case': 'paint/%s/%dx%d' % (name, *image.size), 'cull': cull, 'median_s': seconds,
+                         'cull_rate': counter_total(profiler, 'culled_strokes')
+                         / max(counter_total(profiler, 'active_strokes'), 1),
+                         'equal': torch.equal(results[cull], results[False])})
+
+    print('%-48s %-5s %9s %10s %6s' % ('case', 'cull', 'time', 'cull rate', 'equal'))
+    for row in rows:
+        print('%-48s %-5s %8.4fs %9.1f%% %6s' % (row['case'], row['cull'], row['median_s'], 100 * row['cull_rate'],
+                                                 row['equal']))
+    if weights != 'checkpoint':
+        print('inference/model.pth not found: end-to-end results use random weights', file=sys.stderr)
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump({'device': args.device, 'weights': weights, 'results': rows}, f, indent=2)
+    if not all(row['equal'] for row in rows):
+        print('culling changed the result', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+"""
+Benchmark suite for the painting pipeline.
+
+Times the building blocks of the renderer (param2stroke, param2img_parallel, param2img_serial and the
+morphology ops) and end-to-end inference.main() across input sizes: the samples in inference/input/
+plus synthetic square inputs. Everything runs on CPU by default. When inference/model.pth is not
+present, a Painter with randomly initialised weights is used instead, which has the same cost.
+
+Results are written as a machine-readable baseline, and can be compared against an earlier baseline
+to fail when a benchmark regresses by more than a threshold:
+
+    python benchmarks/bench_inference.py --save benchmarks/baselines/my-machine.json
+    python benchmarks/bench_inference.py --compare benchmarks/baselines/my-machine.json --threshold 0.2
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# The inference module resolves brush and model paths relative to the repository root. The other benchmarks
+# import this module before the inference package, to get the same setup and the helpers below.
+os.chdir(ROOT)
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+import inference.inference as inference
+import inference.morphology as morphology
+import inference.network as network
+
+MODEL_PATH = 'inference/model.pth'
+SYNTHETIC_SIZES = [256, 512, 1024, 2048, 4096]
+
+
+def make_painter(device, need_path=False):
+    """
+    Return a Painter, the path of its weights and where they come from ('checkpoint' or 'random'). Without a
+    checkpoint, the weights are randomly initialised, and only saved when need_path is set, to a temporary file
+    that the caller deletes. The path is None otherwise.
+    """
+    if os.path.exists(MODEL_PATH):
+        return inference.load_painter(MODEL_PATH, device), MODEL_PATH, 'checkpoint'
+    torch.manual_seed(0)
+    net_g = network.Painter(5, 8, 256, 8, 3, 3).to(device)
+    net_g.eval()
+    for param in net_g.parameters():
+        param.requires_grad = False
+    if not need_path:
+        return net_g, None, 'random'
+    fd, model_path = tempfile.mkstemp(suffix='.pth')
+    os.close(fd)
+    torch.save(net_g.state_dict(), model_path)
+    return net_g, model_path, 'random'
+
+
+def random_params(n, generator):
+    """
+    Random but plausible stroke parameters: centers inside the patch, sizes up to half of it.
+    """
+    low = torch.tensor([0.25, 0.25, 0.02, 0.02, 0., 0., 0., 0.])
+    high = torch.tensor([0.75, 0.75, 0.5, 0.5, 1., 1., 1., 1.])
+    return low + (high - low) * torch.rand(n, 8, generator=generator)
+
+
+def synthetic_image(size, seed=0):
+    """
+    A smooth gradient with noise, so strokes have something to follow.
+    """
+    rng = np.random.default_rng(seed)
+    x = np.broadcast_to(np.linspace(0, 1, size, dtype=np.float32)[None, :], (size, size))
+    y = np.broadcast_to(np.linspace(0, 1, size, dtype=np.float32)[:, None], (size, size))
+    img = np.stack([x, y, (x + y) / 2], axis=-1) * 200 + rng.integers(0, 56, (size, size, 3), dtype=np.uint8)
+    return Image.fromarray(img.astype(np.uint8))
+
+
+def time_fn(fn, repeat, warmup=1, device=None):
+    """
+    Seconds of each of repeat runs of fn, after warmup untimed runs. On a cuda device, every run waits for its
+    kernels to finish.
+    """
+    for _ in range(warmup):
+        fn()
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        if device is not None and device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        runs.append(time.perf_counter() - start)
+    return runs
+
+
+def median_time(fn, repeat, device=None):
+    """
+    Median seconds of repeat runs of fn after a warmup run, see time_fn, and the result of the last run.
+    """
+    last = {}
+
+    def run():
+        last['result'] = fn()
+
+    runs = time_fn(run, repeat, device=device)
+    return statistics.median(runs), last['result']
+
+
+def psnr(a, b):
+    """
+    Peak signal-to-noise ratio in dB of two images in [0, 1].
+    """
+    mse = F.mse_loss(a, b).item()
+    return float('inf') if mse == 0 else 10 * torch.log10(torch.tensor(1. / mse)).item()
+
+
+def build_cases(args, device, net_g, model_path, meta_brushes, temp_dir):
+    """
+    Return a list of (name, function, repeat) benchmark cases.
+    """
+    generator = torch.Generator().manual_seed(0)
+    cases = []
+
+    for patch_size in (64, 128, 256):
+        param = random_params(args.strokes, generator).to(device)
+        cases.append(('param2stroke/patch%d/n%d' % (patch_size, args.strokes),
+                      lambda param=param, patch_size=patch_size:
+                      inference.param2stroke(param, patch_size, patch_size, meta_brushes), args.repeat))
+
+        x = torch.rand(args.strokes, 3, patch_size, patch_size, generator=generator).to(device)
+        cases.append(('dilation/patch%d/n%d' % (patch_size, args.strokes),
+                      lambda x=x: morphology.dilation(x), args.repeat))
+        cases.append(('erosion/patch%d/n%d' % (patch_size, args.strokes),
+                      lambda x=x: morphology.erosion(x), args.repeat))
+
+    for patch_num, patch_size in ((4, 256), (16, 64), (32, 64)):
+        param = random_params(patch_num * patch_num * 8, generator).view(1, patch_num, patch_num, 8, 8).to(device)
+        decision = (torch.rand(1, patch_num, patch_num, 8, generator=generator) > 0.5).to(device)
+        canvas = torch.rand(1, 3, patch_num * patch_size // 2, patch_num * patch_size // 2,
+                            generator=generator).to(device)
+        suffix = 'patches%d/patch%d' % (patch_num, patch_size)
+        cases.append(('param2img_parallel/' + suffix,
+                      lambda param=param, decision=decision, canvas=canvas:
+                      inference.param2img_parallel(param, decision, meta_brushes, canvas), args.repeat))
+        cases.append(('param2img_serial/' + suffix,
+                      lambda param=param, decision=decision, canvas=canvas:
+                      inference.param2img_serial(param, decision, meta_brushes, canvas, None), args.repeat))
+
+    inputs = []
+    if not args.no_samples:
+        inputs += sorted(glob.glob('inference/input/*.jpg'))
+    for size in args.sizes:
+        path = os.path.join(temp_dir, 'synthetic_%d.png' % size)
+        synthetic_image(size).save(path)
+        inputs.append(path)
+    output_dir = os.path.join(temp_dir, 'output')
+    for path in inputs:
+        with Image.open(path) as image:
+            width, height = image.size
+        name = 'main/%s/%dx%d' % (os.path.splitext(os.path.basename(path))[0], width, height)
+        # Large inputs take minutes each on CPU, so they are timed once.
+        repeat = args.repeat if max(width, height) <= 1024 else 1
+        cases.append((name, lambda path=path: inference.main(path, model_path, output_dir), repeat))
+    return cases
+
+
+def machine_info(device):
+    return {'platform': platform.platform(), 'processor': platform.processor(), 'python': platform.python_version(),
+            'torch': torch.__version__, 'device': str(device), 'num_threads': torch.get_num_threads()}
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare medians against a baseline. Returns the names of benchmarks slower by more than threshold.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['median_s']
+        change = result['median_s'] / before - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-48s %10.4fs -> %10.4fs  %+7.1f%%%s' % (name, before, result['median_s'], change * 100, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--device', default='cpu', help='torch device to benchmark on (default: cpu)')
+    parser.add_argument('--sizes', type=int, nargs='*', default=SYNTHETIC_SIZES,
+                        help='sizes of the synthetic square inputs (default: %(default)s)')
+    parser.add_argument('--no-samples', action='store_true', help='skip the sample images in inference/input/')
+    parser.add_argument('--strokes', type=int, default=512, help='strokes per param2stroke/morphology call')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark')
+    parser.add_argument('--filter', default=None, help='only run benchmarks whose name contains this string')
+    parser.add_argument('--save', metavar='PATH', help='write the results as a baseline to PATH')
+    parser.add_argument('--compare', metavar='PATH', help='compare against the baseline at PATH')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slowdown of the median that counts as a regression (default: 0.2)')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    # main() loads its weights from a file, so random weights are saved once for it.
+    net_g, model_path, weights = make_painter(device, need_path=True)
+    meta_brushes = inference.load_meta_brushes(device)
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir, torch.no_grad():
+            for name, fn, repeat in build_cases(args, device, net_g, model_path, meta_brushes, temp_dir):
+                if args.filter and args.filter not in name:
+                    continue
+                runs = time_fn(fn, repeat, warmup=1 if repeat > 1 else 0, device=device)
+                results[name] = {'median_s': statistics.median(runs), 'min_s': min(runs), 'runs': runs}
+                print('%-48s %10.4fs (min %.4fs, %d runs)' % (name, results[name]['median_s'], min(runs),
+                                                              len(runs)))
+    finally:
+        if weights == 'random':
+            os.unlink(model_path)
+
+    report = {'machine': machine_info(device), 'weights': weights, 'results': results}
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Baseline saved to %s' % args.save)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print()
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('\n%d benchmark(s) regressed by more than %.0f%%' % (len(regressions), args.threshold * 100))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Reduced-precision render mode: speed, stroke buffer size and difference against float32.
+
+For every precision of inference.presets.PRECISIONS, times param2img_parallel on random strokes and end-to-end
+paint() on the samples in inference/input/, and compares every result with the float32 one: the largest and mean
+absolute difference in 8-bit levels and the PSNR of the 8-bit images. The low-precision mode is accepted when
+the rendering benchmark matches float32 to within one 8-bit level, and the script exits with status 1 otherwise;
+end-to-end results can differ more, since the Painter sees the rounded canvas of the previous layers.
+
+    python benchmarks/bench_precision.py
+    python benchmarks/bench_precision.py --save benchmarks/baselines/precision.json
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+
+from bench_inference import make_painter, median_time, random_params
+
+import torch
+from PIL import Image
+
+import inference.inference as inference
+import inference.presets as presets
+
+# Largest difference from float32, in 8-bit levels, accepted for the rendering benchmark.
+MAX_RENDER_DIFF = 1
+
+
+def to_levels(img):
+    return (img.float().clamp(0, 1) * 255).to(torch.uint8).float()
+
+
+def compare(result, reference):
+    """
+    Difference of two images in [0, 1], in 8-bit levels after the conversion every output goes through.
+    """
+    diff = (to_levels(result) - to_levels(reference)).abs()
+    mse = (diff ** 2).mean().item()
+    return {'max_diff': diff.max().item(), 'mean_diff': diff.mean().item(),
+            'psnr': float('inf') if mse == 0 else 10 * torch.log10(torch.tensor(255. ** 2 / mse)).item()}
+
+
+def stroke_buffer_bytes(dtype, size):
+    """
+    Bytes of the foreground and alpha buffers of one stroke rendered at size x size, as allocated by render_group.
+    """
+    if dtype == torch.float32:
+        return 2 * 3 * size * size * 4
+    return 3 * size * size * torch.empty((), dtype=dtype).element_size() + size * size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--max-dim', type=int, default=512, help='resize samples to this size, 0 keeps them')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', metavar='PATH', help='write the results as JSON')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.set_grad_enabled(False)
+    net_g, _, weights = make_painter(device)
+    meta_brushes = inference.load_brushes(device)
+    generator = torch.Generator().manual_seed(0)
+    rows = []
+
+    for patch_num, patch_size in ((16, 64), (32, 64)):
+        param = random_params(patch_num * patch_num * 8, generator).view(1, patch_num, patch_num, 8, 8).to(device)
+        decision = (torch.rand(1, patch_num, patch_num, 8, generator=generator) > 0.5).to(device)
+        canvas = torch.rand(1, 3, patch_num * patch_size // 2, patch_num * patch_size // 2,
+                            generator=generator).to(device)
+        brushes = meta_brushes.brushes('large', patch_size)
+        reference = None
+        for precision in presets.PRECISIONS:
+            dtype = getattr(torch, precision)
+            seconds, result = median_time(lambda: inference.param2img_parallel(
+                param, decision, brushes, canvas.to(dtype)), args.repeat, device)
+            reference = result if reference is None else reference
+            rows.append(dict({'case': 'param2img_parallel/patches%d/patch%d' % (patch_num, patch_size),
+                              'precision': precision, 'median_s': seconds,
+                              'stroke_buffer_bytes': stroke_buffer_bytes(dtype, patch_size)},
+                             **compare(result, reference)))
+
+    for path in sorted(glob.glob('inference/input/*.jpg')):
+        image = Image.open(path).convert('RGB')
+        if args.max_dim:
+            image.thumbnail((args.max_dim, args.max_dim), Image.LANCZOS)
+        original = inference.img_to_tensor(image, device)
+        reference = None
+        for precision in presets.PRECISIONS:
+            seconds, result = median_time(lambda: inference.paint(
+                original, net_g, meta_brushes, preset=presets.resolve(precision=precision)), args.repeat, device)
+            reference = result if reference is None else reference
+            rows.append(dict({'case': 'paint/%s/%dx%d' % (os.path.splitext(os.path.basename(path))[0], *image.size),
+                              'precision': precision, 'median_s': seconds}, **compare(result, reference)))
+
+    print('%-36s %-9s %9s %12s %9s %10s %8s' % ('case', 'precision', 'time', 'stroke bufs', 'max diff',
+                                              'mean diff', 'PSNR'))
+    for row in rows:
+        buffers = '%d B' % row['stroke_buffer_bytes'] if 'stroke_buffer_bytes' in row else '-'
+        print('%-36s %-9s %8.3fs %12s %9.0f %10.4f %8.2f' % (row['case'], row['precision'], row['median_s'], buffers,
+                                                           row['max_diff'], row['mean_diff'], row['psnr']))
+    if weights != 'checkpoint':
+        print('inference/model.pth not found: end-to-end results use random weights', file=sys.stderr)
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump({'device': args.device, 'weights': weights, 'results': rows}, f, indent=2)
+    if any(row['max_diff'] > MAX_RENDER_DIFF for row in rows if row['case'].startswith('param2img_parallel/')):
+        print('the low-precision render mode differs from float32 by more than %d 8-bit level' % MAX_RENDER_DIFF,
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Speed/quality table of the painting presets.
+
+Paints every sample in inference/input/ with every preset of inference.presets and reports the median
+painting time next to PSNR and SSIM against the input, which measure how faithfully the painting
+reproduces the photo. Inputs are resized to --max-dim first, as the app and the command line do.
+
+    python benchmarks/bench_presets.py
+    python benchmarks/bench_presets.py --max-dim 1024 --save benchmarks/baselines/presets.json
+
+The table is printed in Markdown so it can be pasted into the README. When inference/model.pth is not
+present, the Painter has random weights: timings are still meaningful, quality numbers are not.
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+
+from bench_inference import MODEL_PATH, ROOT, make_painter, median_time, psnr
+
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+import inference.inference as inference
+import inference.presets as presets
+
+
+def ssim(a, b, window_size=11, sigma=1.5):
+    """
+    Mean structural similarity of two 1 x 3 x H x W images in [0, 1], averaged over channels,
+    with the usual 11 x 11 Gaussian window.
+    """
+    coords = torch.arange(window_size, dtype=a.dtype, device=a.device) - window_size // 2
+    gauss = torch.exp(-coords ** 2 / (2 * sigma ** 2))
+    gauss = gauss / gauss.sum()
+    window = (gauss[:, None] * gauss[None, :]).expand(3, 1, window_size, window_size).contiguous()
+
+    def blur(x):
+        return F.conv2d(x, window, groups=3)
+
+    c1, c2 = 0.01 ** 2, 0.03 ** 2
+    mu_a, mu_b = blur(a), blur(b)
+    var_a = blur(a * a) - mu_a ** 2
+    var_b = blur(b * b) - mu_b ** 2
+    cov = blur(a * b) - mu_a * mu_b
+    ssim_map = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+    return ssim_map.mean().item()
+
+
+def load_input(path, max_dim, device):
+    image = Image.open(path).convert('RGB')
+    if max_dim:
+        image.thumbnail((max_dim, max_dim), Image.LANCZOS)
+    return inference.img_to_tensor(image, device)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--max-dim', type=int, default=512, help='resize inputs to this size, 0 keeps them')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--presets', nargs='+', default=list(presets.PRESETS), choices=list(presets.PRESETS))
+    parser.add_argument('--save', metavar='PATH', help='write the results as JSON')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.set_grad_enabled(False)
+    net_g, _, weights = make_painter(device)
+    meta_brushes = inference.load_brushes(device)
+    if weights != 'checkpoint':
+        print('%s not found, using random weights: quality numbers are meaningless' % MODEL_PATH, file=sys.stderr)
+
+    rows = []
+    for path in sorted(glob.glob(os.path.join(ROOT, 'inference/input/*.jpg'))):
+        original = load_input(path, args.max_dim, device)
+        name = os.path.splitext(os.path.basename(path))[0]
+        for preset in args.presets:
+            seconds, painted = median_time(lambda: inference.paint(original, net_g, meta_brushes, preset=preset),
+                                           args.repeat, device)
+            row = {'image': name, 'size': '%dx%d' % tuple(original.shape[-1:-3:-1]), 'preset': preset,
+                   'median_s': seconds, 'psnr': psnr(painted, original),
+                   'ssim': ssim(painted, original)}
+            rows.append(row)
+            print('%s %s %s: %.2fs, PSNR %.2f dB, SSIM %.4f' % (row['image'], row['size'], preset,
+                                                                 row['median_s'], row['psnr'], row['ssim']),
+                  file=sys.stderr)
+
+    print('| preset | time (s) | PSNR (dB) | SSIM |')
+    print('|---|---|---|---|')
+    for preset in args.presets:
+        selected = [row for row in rows if row['preset'] == preset]
+        if selected:
+            print('| %s | %.2f | %.2f | %.4f |' % (preset, statistics.mean(row['median_s'] for row in selected),
+                                                   statistics.mean(row['psnr'] for row in selected),
+                                                   statistics.mean(row['ssim'] for row in selected)))
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump({'device': args.device, 'max_dim': args.max_dim, 'weights': weights,
+                       'settings': {preset: presets.resolve(preset) for preset in args.presets}, 'results': rows},
+                      f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
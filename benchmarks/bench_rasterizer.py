@@ -0,0 +1,107 @@
+"""
+Analytic strokes against texture brushes: speed and visual differences.
+
+For every brush mode of inference.presets.BRUSH_MODES, times param2stroke and param2img_parallel on random strokes
+and end-to-end paint() on the samples in inference/input/, and compares every painting with the texture one and
+with the input (PSNR). With --diff-dir, every painting is saved next to an image of its absolute difference with
+the texture painting, amplified 4 times, for visual inspection.
+
+    python benchmarks/bench_rasterizer.py
+    python benchmarks/bench_rasterizer.py --diff-dir rasterizer-diffs --save benchmarks/baselines/rasterizer.json
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+
+from bench_inference import make_painter, median_time, psnr, random_params
+
+import torch
+from PIL import Image
+
+import inference.inference as inference
+import inference.presets as presets
+
+
+def stroke_brushes(meta_brushes, brush_mode, size):
+    return meta_brushes.brushes('large', size) if brush_mode == 'texture' else brush_mode
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--max-dim', type=int, default=512, help='resize samples to this size, 0 keeps them')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--diff-dir', metavar='DIR', help='save every painting and its difference with texture')
+    parser.add_argument('--save', metavar='PATH', help='write the results as JSON')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.set_grad_enabled(False)
+    net_g, _, weights = make_painter(device)
+    meta_brushes = inference.load_brushes(device)
+    generator = torch.Generator().manual_seed(0)
+    rows = []
+
+    for n, size in ((2048, 32), (512, 128)):
+        param = random_params(n, generator).to(device)
+        for brush_mode in presets.BRUSH_MODES:
+            brushes = stroke_brushes(meta_brushes, brush_mode, size)
+            seconds, _ = median_time(lambda: inference.param2stroke(param, size, size, brushes), args.repeat, device)
+            rows.append({'case': 'param2stroke/n%d/size%d' % (n, size), 'brush_mode': brush_mode,
+                         'median_s': seconds})
+
+    for patch_num, patch_size in ((16, 64), (32, 64)):
+        param = random_params(patch_num * patch_num * 8, generator).view(1, patch_num, patch_num, 8, 8).to(device)
+        decision = (torch.rand(1, patch_num, patch_num, 8, generator=generator) > 0.5).to(device)
+        canvas = torch.rand(1, 3, patch_num * patch_size // 2, patch_num * patch_size // 2,
+                            generator=generator).to(device)
+        reference = None
+        for brush_mode in presets.BRUSH_MODES:
+            brushes = stroke_brushes(meta_brushes, brush_mode, patch_size)
+            seconds, result = median_time(lambda: inference.param2img_parallel(param, decision, brushes, canvas),
+                                          args.repeat, device)
+            reference = result if reference is None else reference
+            rows.append({'case': 'param2img_parallel/patches%d/patch%d' % (patch_num, patch_size),
+                         'brush_mode': brush_mode, 'median_s': seconds, 'psnr_texture': psnr(result, reference)})
+
+    if args.diff_dir:
+        os.makedirs(args.diff_dir, exist_ok=True)
+    for path in sorted(glob.glob('inference/input/*.jpg')):
+        image = Image.open(path).convert('RGB')
+        if args.max_dim:
+            image.thumbnail((args.max_dim, args.max_dim), Image.LANCZOS)
+        original = inference.img_to_tensor(image, device)
+        name = os.path.splitext(os.path.basename(path))[0]
+        reference = None
+        for brush_mode in presets.BRUSH_MODES:
+            seconds, result = median_time(lambda: inference.paint(
+                original, net_g, meta_brushes, preset=presets.resolve(brush_mode=brush_mode)), args.repeat, device)
+            reference = result if reference is None else reference
+            rows.append({'case': 'paint/%s/%dx%d' % (name, *image.size), 'brush_mode': brush_mode,
+                         'median_s': seconds, 'psnr_texture': psnr(result, reference),
+                         'psnr_input': psnr(result, original)})
+            if args.diff_dir:
+                inference.save_img(result[0], os.path.join(args.diff_dir, '%s_%s.png' % (name, brush_mode)))
+                if brush_mode != 'texture':
+                    diff = ((result - reference).abs() * 4).clamp(0, 1)
+                    inference.save_img(diff[0], os.path.join(args.diff_dir, '%s_%s_diff.png' % (name, brush_mode)))
+
+    print('%-36s %-10s %9s %13s %11s' % ('case', 'brush mode', 'time', 'PSNR texture', 'PSNR input'))
+    for row in rows:
+        print('%-36s %-10s %8.4fs %13s %11s' % (
+            row['case'], row['brush_mode'], row['median_s'],
+            '%.2f' % row['psnr_texture'] if 'psnr_texture' in row else '-',
+            '%.2f' % row['psnr_input'] if 'psnr_input' in row else '-'))
+    if weights != 'checkpoint':
+        print('inference/model.pth not found: end-to-end results use random weights', file=sys.stderr)
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump({'device': args.device, 'weights': weights, 'results': rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Startup-time benchmark.
+
+Measures what short invocations and freshly spawned workers pay before any painting starts: importing the
+command-line module, `--help`, a usage error and `--plan` in fresh interpreters, plus importing torch for
+reference, and in-process the time to load the Painter with and without a memory-mapped checkpoint.
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --repeat 10 --save benchmarks/baselines/startup.json
+
+When inference/model.pth is not present, random weights of the same size are saved to a temporary
+checkpoint and loaded instead.
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_command(args, repeat):
+    """
+    Median wall time of running a command in a fresh interpreter from the repository root.
+    """
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        runs.append(time.perf_counter() - start)
+    return runs
+
+
+def time_model_load(repeat):
+    """
+    Time load_painter with and without mmap. Runs in this process, after torch has been imported.
+    """
+    sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+    from bench_inference import make_painter
+    import torch
+    import inference.inference as inference
+
+    device = torch.device('cpu')
+    _, model_path, weights = make_painter(device, need_path=True)
+    results = {}
+    try:
+        for mmap in (False, True):
+            runs = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                inference.load_painter(model_path, device, mmap=mmap)
+                runs.append(time.perf_counter() - start)
+            results['load_painter/%s/%s' % ('mmap' if mmap else 'read', weights)] = runs
+    finally:
+        if weights == 'random':
+            os.unlink(model_path)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--save', metavar='PATH', help='write the results as JSON')
+    args = parser.parse_args()
+
+    sample = (sorted(glob.glob(os.path.join(ROOT, 'inference/input/*.jpg'))) or [None])[0]
+    commands = {
+        'python': ['-c', 'pass'],
+        'import torch': ['-c', 'import torch'],
+        'import colourlesstransformer': ['-c', 'import colourlesstransformer'],
+        'cli --help': ['colourlesstransformer.py', '--help'],
+        'cli usage error': ['colourlesstransformer.py'],
+    }
+    if sample is not None:
+        commands['cli --plan'] = ['colourlesstransformer.py', sample, '--plan']
+
+    results = {}
+    for name, command in commands.items():
+        results[name] = time_command(command, args.repeat)
+        print('%-40s %8.3fs' % (name, statistics.median(results[name])), flush=True)
+    for name, runs in time_model_load(args.repeat).items():
+        results[name] = runs
+        print('%-40s %8.3fs' % (name, statistics.median(runs)), flush=True)
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump({'python': sys.version, 'repeat': args.repeat,
+                       'results': {name: {'median_s': statistics.median(runs), 'runs_s': runs}
+                                   for name, runs in results.items()}}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -37,41 +37,40 @@ if defined NO_RESIZE_FLAG echo No-resize mode enabled.
 echo This may take some time depending on the number of images and their sizes.
 echo.
 
-:: Iterate over all dropped files
+:: Collect all dropped files
+set "FILES="
 for %%I in (%*) do (
     :: Skip the flag parameters
     if /i not "%%I"=="--animation" (
         if /i not "%%I"=="--no-resize" (
             :: Ensure the file has a valid image extension
-            if /i "%%~xI"==".jpg" (call :PROCESS_FILE "%%~fI")
-            if /i "%%~xI"==".jpeg" (call :PROCESS_FILE "%%~fI")
-            if /i "%%~xI"==".png" (call :PROCESS_FILE "%%~fI")
+            if /i "%%~xI"==".jpg" (call :ADD_FILE "%%~fI")
+            if /i "%%~xI"==".jpeg" (call :ADD_FILE "%%~fI")
+            if /i "%%~xI"==".png" (call :ADD_FILE "%%~fI")
         )
     )
 )
 
-echo.
-echo All image processing tasks completed.
-pause
-exit /b
-
-:PROCESS_FILE
-:: Set up variables
-set "INPUT_FILE=%~1"
-
-:: Notify which file is being processed
-echo Resizing and processing file: %INPUT_FILE%
-echo.
+if not defined FILES (
+    echo No JPG or PNG images to process.
+    pause
+    exit /b
+)
 
-:: Call the Python script to resize and process the image
-python colourlesstransformer.py "%INPUT_FILE%" %ANIMATION_FLAG% %NO_RESIZE_FLAG%
+:: Process all files in one pipelined batch, so the model is loaded once and
+:: decoding and saving overlap with painting
+python colourlesstransformer.py %FILES% %ANIMATION_FLAG% %NO_RESIZE_FLAG%
 
 :: Check the exit status of Python
+echo.
 if %errorlevel% neq 0 (
-    echo Failed to process: %INPUT_FILE%.
-    echo.
-    exit /b
+    echo Some images failed to process.
 ) else (
-    echo Successfully processed: %INPUT_FILE%.
-    echo.
+    echo All image processing tasks completed.
 )
+pause
+exit /b
+
+:ADD_FILE
+set "FILES=%FILES% "%~1""
+exit /b
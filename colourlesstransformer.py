@@ -5,10 +5,13 @@ This module provides a Python interface for Paint Transformer, a neural network
 feed-forward neural painting with stroke prediction. It can process images to create painterly
 transformations, either as static images or animated sequences showing the painting process.
 
-The module can be used both as a command-line tool and as a Python library.
+The module can be used both as a command-line tool and as a Python library. Besides the
+file-based workflow, images can be painted entirely in memory with `paint_image`, which avoids
+temporary files and is better suited for long-running services.
 
 Command Line Usage:
-    python colourlesstransformer.py <image_path> [--animation] [--no-resize]
+    python colourlesstransformer.py <image_path> [--animation] [--no-resize] [--profile PATH]
+                                    [--memory-budget SIZE] [--plan]
 
 Python API Usage:
     from colourlesstransformer import process_image_complete
@@ -19,6 +22,17 @@ Python API Usage:
         resize=True
     )
 
+    from colourlesstransformer import paint_image
+
+    painted = paint_image(Image.open("image.jpg"))  # PIL image, numpy array or bytes
+
+    from colourlesstransformer import submit_paint
+
+    job = submit_paint("image.jpg")  # inside a coroutine; painting runs on a dedicated thread
+    async for event in job.events():
+        print(f"pass {event['done']}/{event['passes']}")
+    painted = await job
+
 Dependencies:
     - numpy
     - pillow
@@ -31,10 +45,388 @@ Based on Paint Transformer by Songhua Liu et al.
 
 import sys
 import os
+import io
+import argparse
+import asyncio
+import threading
+import concurrent.futures
 import tempfile
 import glob
+import shutil
+import functools
+import importlib
+import numpy as np
 from PIL import Image
-from inference.inference import main
+from inference import profiling
+from inference import planner
+from inference import presets
+from inference.profiling import Profiler
+from inference.planner import PlanRejected
+from inference.pipeline import BatchPipeline
+
+MODEL_PATH = "inference/model.pth"
+
+# torch and the inference stack take seconds to import, so they are imported on first use: `--help`,
+# usage errors and `--plan` never load them. Names this module used to re-export are resolved lazily.
+_LAZY_ATTRIBUTES = {
+    "torch": ("torch", None),
+    "main": ("inference.inference", "main"),
+    "load_painter": ("inference.inference", "load_painter"),
+    "load_brushes": ("inference.inference", "load_brushes"),
+    "load_meta_brushes": ("inference.inference", "load_meta_brushes"),
+    "paint": ("inference.inference", "paint"),
+    "img_to_tensor": ("inference.inference", "img_to_tensor"),
+    "tensor_to_array": ("inference.inference", "tensor_to_array"),
+    "atomic_save": ("inference.inference", "atomic_save"),
+    "PaintContext": ("inference.inference", "PaintContext"),
+    "PaintCancelled": ("inference.inference", "PaintCancelled"),
+}
+
+_paint_executor = None
+_paint_executor_lock = threading.Lock()
+
+
+def is_out_of_memory(error):
+    """
+    Return whether an exception is torch's OutOfMemoryError, without importing torch.
+    """
+    torch = sys.modules.get("torch")
+    return torch is not None and isinstance(error, torch.OutOfMemoryError)
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module_name, attribute = _LAZY_ATTRIBUTES[name]
+    module = importlib.import_module(module_name)
+    return module if attribute is None else getattr(module, attribute)
+
+
+def load_image(source):
+    """
+    Load an image from any of the supported in-memory or on-disk sources.
+
+    Args:
+        source (str | os.PathLike | bytes | PIL.Image.Image | numpy.ndarray): A path to an image file,
+            the encoded bytes of an image file, a PIL image, or an H x W (x C) array.
+
+    Returns:
+        PIL.Image.Image or numpy.ndarray: The decoded image. Arrays are returned unchanged.
+
+    Raises:
+        PIL.UnidentifiedImageError: If the path or bytes do not contain a valid image
+        TypeError: If the source type is not supported
+    """
+    if isinstance(source, (Image.Image, np.ndarray)):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return Image.open(io.BytesIO(source))
+    if isinstance(source, (str, os.PathLike)):
+        return Image.open(source)
+    raise TypeError(f"Unsupported image source: {type(source).__name__}")
+
+
+def image_size(image):
+    """
+    Return the (width, height) of a PIL image or an H x W (x C) array.
+    """
+    if isinstance(image, np.ndarray):
+        return image.shape[1], image.shape[0]
+    return image.size
+
+
+def array_to_image(array):
+    """
+    Convert an H x W (x C) array to a PIL image for resizing, read as `img_to_tensor` reads arrays:
+    floating point arrays hold values in [0, 1], and single channel arrays are grayscale.
+    """
+    if np.issubdtype(array.dtype, np.floating):
+        array = (np.clip(array, 0, 1) * 255 + 0.5).astype(np.uint8)
+    if array.ndim == 3 and array.shape[2] == 1:
+        array = array[:, :, 0]
+    return Image.fromarray(array)
+
+
+def fit_size(width, height, max_dim=512):
+    """
+    Return the (width, height) an image is resized to by `resize_to_fit`.
+    """
+    if width <= max_dim and height <= max_dim:
+        return width, height
+    resize_ratio = min(max_dim / width, max_dim / height)
+    return int(width * resize_ratio), int(height * resize_ratio)
+
+
+def resize_to_fit(image, max_dim=512):
+    """
+    Resize an in-memory image to fit within the maximum dimension while maintaining the aspect ratio.
+
+    Args:
+        image (PIL.Image.Image | numpy.ndarray): The image to resize
+        max_dim (int): Maximum dimension (width or height) for the resized image. Defaults to 512.
+
+    Returns:
+        PIL.Image.Image or numpy.ndarray: The resized image, or the input itself if it already fits.
+            Resized arrays are uint8, see `array_to_image`.
+    """
+    width, height = image_size(image)
+    new_size = fit_size(width, height, max_dim)
+    if new_size == (width, height):
+        return image
+    if isinstance(image, np.ndarray):
+        return np.array(array_to_image(image).resize(new_size, Image.LANCZOS))
+    return image.resize(new_size, Image.LANCZOS)
+
+
+def resize_exact(image, size):
+    """
+    Resize an in-memory image to exactly (width, height), without keeping the aspect ratio.
+    """
+    if image_size(image) == tuple(size):
+        return image
+    if isinstance(image, np.ndarray):
+        return np.array(array_to_image(image).resize(size, Image.LANCZOS))
+    return image.resize(size, Image.LANCZOS)
+
+
+def load_mask(mask, size, source_size=None):
+    """
+    Build the painting mask of an image from a mask image or from bounding boxes.
+
+    Args:
+        mask: Either a mask image in any format accepted by `load_image`, whose alpha channel (or
+              luminance, if it has none) selects the region to paint, or a list of
+              (left, top, right, bottom) boxes in pixels of the source image.
+        size (tuple): (width, height) of the image that is painted. The mask is resized to it.
+        source_size (tuple, optional): (width, height) of the source image the boxes refer to, if it
+                                       was resized before painting. Defaults to size.
+
+    Returns:
+        torch.Tensor: A 1 x 1 x H x W tensor with values in [0, 1]
+    """
+    import torch
+    width, height = size
+    if isinstance(mask, (list, tuple)) and all(isinstance(box, (list, tuple)) for box in mask):
+        source_width, source_height = source_size or size
+        scale_x, scale_y = width / source_width, height / source_height
+        array = np.zeros((height, width), dtype=np.float32)
+        for left, top, right, bottom in mask:
+            array[max(int(np.floor(top * scale_y)), 0):max(int(np.ceil(bottom * scale_y)), 0),
+                  max(int(np.floor(left * scale_x)), 0):max(int(np.ceil(right * scale_x)), 0)] = 1
+    else:
+        image = load_image(mask)
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        image = image.getchannel("A") if "A" in image.getbands() else image.convert("L")
+        array = np.asarray(image.resize(size, Image.BILINEAR), dtype=np.float32) / 255
+    return torch.from_numpy(array)[None, None]
+
+
+def parse_box(text):
+    """
+    Parse a "left,top,right,bottom" box given on the command line.
+    """
+    try:
+        left, top, right, bottom = (float(value) for value in text.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected left,top,right,bottom, got {text!r}")
+    return left, top, right, bottom
+
+
+@functools.lru_cache(maxsize=None)
+def get_painter(model_path=MODEL_PATH, device=None):
+    """
+    Load the network and meta brushes once and reuse them across calls.
+
+    Args:
+        model_path (str): Path to the model weights. Defaults to "inference/model.pth".
+        device (str, optional): Torch device to run on. If None, CUDA is used when available.
+
+    Returns:
+        tuple: A tuple containing (net_g, brushes), the network and its `BrushLibrary`
+    """
+    import torch
+    from inference.inference import load_painter, load_brushes
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    device = torch.device(device)
+    return load_painter(model_path, device), load_brushes(device)
+
+
+@functools.lru_cache(maxsize=None)
+def get_execution_profile(device):
+    """
+    Load the execution profile of a device once, as saved by `python -m inference.autotune`.
+
+    Returns:
+        dict: The profile, or None if this machine has not been tuned
+    """
+    from inference import autotune
+    return autotune.load(device)
+
+
+def plan_image(image, resize=True, max_dim=512, memory_budget=None, allow_resize=True, calibration=None,
+               preset=None):
+    """
+    Estimate peak memory and runtime of painting an image, and decide how to fit the memory budget.
+
+    Only the image header is read; nothing is painted.
+
+    Args:
+        image (str | bytes | PIL.Image.Image | numpy.ndarray): The image to paint. See `load_image`.
+        resize (bool): Whether the image will be resized to fit within max_dim. Defaults to True.
+        max_dim (int): Maximum dimension used when resize is True. Defaults to 512.
+        memory_budget (int | str, optional): Memory budget in bytes, or a size such as "2GB".
+                                             None means unlimited. Defaults to None.
+        allow_resize (bool): Whether the image may be downscaled further to fit the budget. Defaults to True.
+        calibration (str, optional): Path of a benchmark baseline (see benchmarks/bench_inference.py)
+                                     to calibrate the runtime estimate for this machine. Defaults to None.
+        preset (str | dict, optional): Speed/quality preset, 'draft', 'standard' or 'fine', or a dict of
+                                       settings from `inference.presets.resolve`. Defaults to 'standard'.
+
+    Returns:
+        dict: The plan. 'action' is 'run', 'chunk' or 'resize', 'max_dim' is the size to resize to,
+              'max_render_bytes' is the memory budget for rasterized strokes, and 'estimate' holds
+              the peak memory ('peak_bytes') and runtime ('runtime_s') overall and per pass.
+
+    Raises:
+        PlanRejected: If the job cannot fit the memory budget
+    """
+    width, height = image_size(load_image(image))
+    if resize:
+        width, height = fit_size(width, height, max_dim)
+    if isinstance(memory_budget, str):
+        memory_budget = planner.parse_size(memory_budget)
+    coefficients = planner.calibrate(calibration) if calibration else {}
+    return planner.plan(height, width, memory_budget, allow_resize, preset=preset, **coefficients)
+
+
+def paint_image(image, resize=True, max_dim=512, output="pil", model_path=MODEL_PATH, ctx=None,
+                memory_budget=None, preset=None, mask=None, base=None, tuned=False):
+    """
+    Paint an image entirely in memory, without any temporary files.
+
+    The image is decoded at most once and converted to a tensor exactly once. The network is loaded
+    on first use and cached for subsequent calls.
+
+    Args:
+        image (str | bytes | PIL.Image.Image | numpy.ndarray): The image to paint. See `load_image`.
+        resize (bool): If True, resizes the image to fit within max_dim while maintaining aspect ratio.
+                       Defaults to True.
+        max_dim (int): Maximum dimension used when resize is True. Defaults to 512.
+        output (str): Either "pil" to return a PIL image or "array" to return an H x W x 3 uint8
+                      numpy array. Defaults to "pil".
+        model_path (str): Path to the model weights. Defaults to "inference/model.pth".
+        ctx (PaintContext, optional): Job-scoped state of this run. Pass
+                                      `PaintContext(collect_frames=True)` to receive the animation
+                                      frames in `ctx.frames`. Defaults to None.
+        memory_budget (int | str, optional): If given, the job is planned before any work starts and
+                                             the image is downscaled as needed to fit this budget.
+                                             See `plan_image`. Defaults to None.
+        preset (str | dict, optional): Speed/quality preset, 'draft', 'standard' or 'fine', or a dict of
+                                       settings from `inference.presets.resolve`. Defaults to 'standard'.
+        mask (optional): Region to paint, as a mask image or a list of boxes. See `load_mask`. Only
+                         the patches that reach the mask are painted, so the cost scales with the
+                         masked area. Defaults to None, which paints the whole image.
+        base (optional): Image shown outside the mask, such as a previous painting result, in any
+                         format accepted by `load_image`. Defaults to None, which shows the input.
+        tuned (bool): Whether to apply this machine's execution profile, see `inference.autotune`.
+                      It sets torch's process-wide thread count during every pass, so enable it
+                      where one painting runs at a time. Defaults to False.
+
+    Returns:
+        PIL.Image.Image or numpy.ndarray: The painted image
+
+    Raises:
+        ValueError: If output is not "pil" or "array"
+        PlanRejected: If memory_budget is given and the job cannot fit it
+
+    Example:
+        >>> with open("photo.jpg", "rb") as f:
+        ...     painted = paint_image(f.read(), output="array")
+    """
+    from inference.inference import paint, img_to_tensor, tensor_to_array
+    if output not in ("pil", "array"):
+        raise ValueError(f"output must be 'pil' or 'array', not {output!r}")
+    profiler = ctx.profiler if ctx is not None else None
+    with profiling.activate(profiler):
+        image = load_image(image)
+        source_size = image_size(image)
+        original_img, max_render_bytes = prepare_image(image, resize, max_dim, memory_budget, preset=preset)
+        size = (original_img.shape[-1], original_img.shape[-2])
+        with profiling.stage("decode"):
+            mask = load_mask(mask, size, source_size) if mask is not None else None
+            base = img_to_tensor(resize_exact(load_image(base), size)) if base is not None else None
+        net_g, meta_brushes = get_painter(model_path)
+        serial = ctx is not None and ctx.need_frames
+        painted = paint(original_img.to(meta_brushes.device), net_g, meta_brushes, ctx, serial, max_render_bytes,
+                        preset, mask, base, get_execution_profile(meta_brushes.device) if tuned else None)
+        with profiling.stage("to_output"):
+            result = tensor_to_array(painted[0])
+            if output == "pil":
+                result = Image.fromarray(result)
+    return result
+
+
+def prepare_image(image, resize=True, max_dim=512, memory_budget=None, draft=False, preset=None):
+    """
+    Decode and resize an image and convert it to the tensor `paint` expects, applying the memory plan.
+
+    Args:
+        image (str | bytes | PIL.Image.Image | numpy.ndarray): The image to paint. See `load_image`.
+        resize (bool): If True, resizes the image to fit within max_dim. Defaults to True.
+        max_dim (int): Maximum dimension used when resize is True. Defaults to 512.
+        memory_budget (int | str, optional): Memory budget, see `plan_image`. Defaults to None.
+        draft (bool): If True and the image is a JPEG that will be downscaled, lets the decoder
+                      downscale it by up to 8x while decoding, which is much faster than decoding at
+                      full size. The final size may differ by a pixel from the one without draft
+                      decoding. Defaults to False.
+        preset (str | dict, optional): Speed/quality preset the memory plan is made for. Defaults to None.
+
+    Returns:
+        tuple: A tuple containing (original_img, max_render_bytes), a 1 x 3 x H x W CPU tensor and the
+               memory budget for rasterized strokes to pass to `paint`
+
+    Raises:
+        PlanRejected: If memory_budget is given and the job cannot fit it
+    """
+    from inference.inference import img_to_tensor
+    with profiling.stage("decode"):
+        image = load_image(image)
+        if resize:
+            if draft and isinstance(image, Image.Image) and image.format == "JPEG":
+                image.draft("RGB", fit_size(*image.size, max_dim))
+            image = resize_to_fit(image, max_dim)
+    max_render_bytes = planner.DEFAULT_RENDER_BYTES
+    if memory_budget is not None:
+        plan = plan_image(image, resize=False, memory_budget=memory_budget, preset=preset)
+        max_render_bytes = plan["max_render_bytes"]
+        if plan["action"] != "run":
+            print(f"Memory planner: {plan['reason']}")
+        if plan["action"] == "resize":
+            with profiling.stage("decode"):
+                image = resize_to_fit(image, plan["max_dim"])
+    with profiling.stage("to_tensor"):
+        original_img = img_to_tensor(image)
+    return original_img, max_render_bytes
+
+
+def save_profile(profiler, path):
+    """
+    Export a profiler's records as JSON and as a Chrome trace.
+
+    Args:
+        profiler (Profiler): The profiler of a finished run
+        path (str): Path of the JSON file. The Chrome trace is written next to it with a
+                    ".trace.json" suffix and can be opened in chrome://tracing or Perfetto.
+
+    Returns:
+        tuple: A tuple containing (json_path, trace_path)
+    """
+    trace_path = os.path.splitext(path)[0] + ".trace.json"
+    profiler.save_json(path)
+    profiler.save_chrome_trace(trace_path)
+    return path, trace_path
 
 
 def resize_image(input_path, max_dim=512):
@@ -86,33 +478,66 @@ def copy_image_to_temp(input_path):
     return temp_file.name
 
 
-def create_animation_gif(temp_file_path, output_dir="inference/output/"):
+def create_job_dir(output_dir="inference/output/"):
     """
-    Create a GIF animation from the generated frame sequence.
+    Create a unique working directory for one processing job.
 
     Args:
-        temp_file_path (str): Path to the temporary file used for processing
-        output_dir (str): Directory containing the generated animation frames.
-                         Defaults to "inference/output/"
+        output_dir (str): Directory in which the job directory is created. Defaults to "inference/output/"
 
     Returns:
-        str or None: Path to the created GIF file, or None if no frames were found
+        str: Path to the new, empty job directory
 
     Note:
-        This function looks for .jpg files in a subdirectory named after the temp file
-        and combines them into an animated GIF with 100ms frame duration.
+        Every job writes only inside its own directory, so concurrent jobs in threads, processes
+        or app sessions never overwrite each other's frames or results.
     """
-    filename = os.path.splitext(os.path.basename(temp_file_path))[0]
-    in_dir = os.path.join(output_dir, filename, "*.jpg")
-    out_path = os.path.join(output_dir, "animation.gif")
+    os.makedirs(output_dir, exist_ok=True)
+    return tempfile.mkdtemp(prefix="job-", dir=output_dir)
 
-    frame_files = sorted(glob.glob(in_dir))
-    if not frame_files:
+
+def publish_file(src_path, dst_path):
+    """
+    Atomically move a finished result to its final location.
+
+    Args:
+        src_path (str): Path to the finished file
+        dst_path (str): Destination path. Readers never observe a partially written file here.
+    """
+    try:
+        os.replace(src_path, dst_path)
+    except OSError:
+        # Different filesystems: copy next to the destination first so the final rename stays atomic
+        fd, temp_path = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(os.path.abspath(dst_path)))
+        os.close(fd)
+        try:
+            shutil.copyfile(src_path, temp_path)
+            os.replace(temp_path, dst_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        os.unlink(src_path)
+
+
+def save_animation_gif(frames, out_path):
+    """
+    Atomically save a sequence of frames as an animated GIF with 100ms frame duration.
+
+    Args:
+        frames (list): PIL images, in display order
+        out_path (str): Path of the GIF file to create
+
+    Returns:
+        str or None: out_path, or None if there were no frames
+    """
+    from inference.inference import atomic_save
+    if not frames:
         return None
 
-    img, *imgs = [Image.open(f) for f in frame_files]
-    img.save(
-        fp=out_path,
+    img, *imgs = frames
+    atomic_save(
+        img,
+        out_path,
         format="GIF",
         append_images=imgs,
         save_all=True,
@@ -122,6 +547,32 @@ def create_animation_gif(temp_file_path, output_dir="inference/output/"):
     return out_path
 
 
+def create_animation_gif(temp_file_path, output_dir="inference/output/", out_path=None):
+    """
+    Create a GIF animation from the generated frame sequence.
+
+    Args:
+        temp_file_path (str): Path to the temporary file used for processing
+        output_dir (str): Directory containing the generated animation frames, usually the job
+                         directory returned by `create_job_dir`. Defaults to "inference/output/"
+        out_path (str, optional): Path of the GIF file to create. If None, "animation.gif" in output_dir.
+
+    Returns:
+        str or None: Path to the created GIF file, or None if no frames were found
+
+    Note:
+        This function looks for .jpg files in a subdirectory named after the temp file
+        and combines them into an animated GIF with 100ms frame duration.
+    """
+    filename = os.path.splitext(os.path.basename(temp_file_path))[0]
+    in_dir = os.path.join(output_dir, filename, "*.jpg")
+    if out_path is None:
+        out_path = os.path.join(output_dir, "animation.gif")
+
+    frame_files = sorted(glob.glob(in_dir))
+    return save_animation_gif([Image.open(f) for f in frame_files], out_path)
+
+
 def clear_output_directory(output_dir="inference/output/"):
     """
     Clear all image files and subdirectories from the output directory.
@@ -150,7 +601,6 @@ def clear_output_directory(output_dir="inference/output/"):
     for item in os.listdir(output_dir):
         item_path = os.path.join(output_dir, item)
         if os.path.isdir(item_path):
-            import shutil
             shutil.rmtree(item_path)
 
 
@@ -160,7 +610,7 @@ def process_image(temp_file, output_path=None, need_animation=False, serial=Fals
 
     Args:
         temp_file (str): Path to the temporary image file to process
-        output_path (str, optional): Desired output path. If None, saves to output directory.
+        output_path (str, optional): Desired output path. If None, saves to a new job directory.
         need_animation (bool): Whether to generate animation frames. Defaults to False.
         serial (bool): Whether to process frames serially. Defaults to False.
 
@@ -169,35 +619,42 @@ def process_image(temp_file, output_path=None, need_animation=False, serial=Fals
 
     Note:
         This function calls the main inference routine from the inference module.
-        The model file is expected to be at "inference/model.pth".
-    """
-    temp_output_dir = "inference/output/"
-    os.makedirs(temp_output_dir, exist_ok=True)
-
-    # Run inference on the resized image
-    main(
-        input_path=temp_file,
-        model_path="inference/model.pth",
-        output_dir=temp_output_dir,
-        need_animation=need_animation,
-        serial=serial,
-    )
-
-    # Handle the output
-    processed_image_path = os.path.join(temp_output_dir, os.path.basename(temp_file))
-
-    if output_path:
+        The model file is expected to be at "inference/model.pth". Each call works in its own
+        job directory (see `create_job_dir`), which also holds the animation frames. The directory
+        is removed when the result is published to output_path or when processing fails.
+    """
+    from inference.inference import main
+    job_dir = create_job_dir()
+    processed_image_path = os.path.join(job_dir, os.path.basename(temp_file))
+    try:
+        # Run inference on the resized image
+        main(
+            input_path=temp_file,
+            model_path=MODEL_PATH,
+            output_dir=job_dir,
+            need_animation=need_animation,
+            serial=serial,
+        )
+        if not output_path:
+            # Return the path to the processed image, which keeps its job directory
+            if os.path.exists(processed_image_path):
+                return processed_image_path
+            return None
         # Move the final output image to the desired location
         if os.path.exists(processed_image_path):
-            os.rename(processed_image_path, output_path)
+            publish_file(processed_image_path, output_path)
             print(f"Processed image saved to {output_path}")
             return output_path
-    else:
-        # Return the path to the processed image
-        return processed_image_path if os.path.exists(processed_image_path) else None
+        return None
+    finally:
+        # Nothing in the job directory is needed once the result is published, or when there is none
+        if output_path or not os.path.exists(processed_image_path):
+            shutil.rmtree(job_dir, ignore_errors=True)
 
 
-def process_image_complete(input_path, animation=False, output_path=None, resize=True):
+def process_image_complete(input_path, animation=False, output_path=None, resize=True, profile_path=None,
+                           memory_budget=None, preset=None, mask=None, base=None, on_progress=None,
+                           cancel_event=None, tuned=False):
     """
     Complete image processing workflow: optionally resize, process, and optionally create animation.
 
@@ -210,13 +667,36 @@ def process_image_complete(input_path, animation=False, output_path=None, resize
         animation (bool, optional): If True, generates an animated GIF showing the painting process.
                                    If False, generates a static paint-transformed image.
                                    Defaults to False.
-        output_path (str, optional): Custom path for the output file. If None, saves to the same
-                                    directory as input with '_painttransformed' suffix.
+        output_path (str, optional): Custom path for the output file. If None, saves to a new
+                                    job directory under "inference/output/". The file is published
+                                    atomically, so it is either absent or complete.
                                     Defaults to None.
         resize (bool, optional): If True, resizes the image to fit within 512px maximum dimension
                                 while maintaining aspect ratio. If False, processes at original size.
                                 Larger images may take significantly longer to process.
                                 Defaults to True.
+        profile_path (str, optional): If given, records the wall time and memory use of every stage
+                                     and writes them to this JSON file, plus a Chrome trace next to
+                                     it (see `save_profile`). Defaults to None.
+        memory_budget (int | str, optional): If given, the image is downscaled as needed to fit this
+                                             memory budget, e.g. "2GB", and jobs that cannot fit are
+                                             rejected before any work starts. Defaults to None.
+        preset (str | dict, optional): Speed/quality preset, 'draft', 'standard' or 'fine', or a dict of
+                                       settings from `inference.presets.resolve`. 'draft' is several
+                                       times faster, 'fine' paints finer detail at several times the cost.
+                                       Defaults to 'standard'.
+        mask (optional): Only paint this region, given as a path to a mask image or a list of
+                         (left, top, right, bottom) boxes in pixels of the input. See `load_mask`.
+                         Defaults to None, which paints the whole image.
+        base (str, optional): Path of the image shown outside the mask, such as a previous painting
+                              result. Defaults to None, which shows the input image.
+        on_progress (callable, optional): Called with a dict after every painting pass, see
+                                          `PaintJob.events`. Defaults to None.
+        cancel_event (threading.Event, optional): Stops painting at the next layer or parity group
+                                                  when set, raising `PaintCancelled`; nothing is
+                                                  saved. Defaults to None.
+        tuned (bool): Whether to apply this machine's execution profile, see `paint_image`.
+                      Defaults to False.
 
     Returns:
         tuple: A tuple containing (result_path, result_type) where:
@@ -226,6 +706,8 @@ def process_image_complete(input_path, animation=False, output_path=None, resize
     Raises:
         FileNotFoundError: If the input image file doesn't exist
         PIL.UnidentifiedImageError: If the input file is not a valid image
+        PlanRejected: If memory_budget is given and the job cannot fit it
+        PaintCancelled: If cancel_event was set
         Exception: If the neural network inference fails
 
     Example:
@@ -240,65 +722,428 @@ def process_image_complete(input_path, animation=False, output_path=None, resize
         ...     resize=False
         ... )
     """
-    # Resize or copy the image
-    if resize:
-        processed_path = resize_image(input_path)
-    else:
-        processed_path = copy_image_to_temp(input_path)
+    from inference.inference import PaintContext
+    file_base = os.path.splitext(os.path.basename(input_path))[0]
+    profiler = Profiler() if profile_path else None
+    ctx = PaintContext(collect_frames=animation, profiler=profiler, on_progress=on_progress,
+                       cancel_event=cancel_event)
+    painted = paint_image(input_path, resize=resize, ctx=ctx, memory_budget=memory_budget, preset=preset,
+                          mask=mask, base=base, tuned=tuned)
 
-    try:
-        # Process the image
-        result_path = process_image(
-            processed_path,
-            output_path=output_path,
-            need_animation=animation,
-            serial=animation
-        )
+    if output_path is None:
+        output_path = os.path.join(create_job_dir(), f"{file_base}.gif" if animation else f"{file_base}.png")
 
-        if animation:
-            # Create GIF from animation frames
-            gif_path = create_animation_gif(processed_path)
-            if gif_path:
-                return gif_path, "gif"
-            else:
-                # Fallback to static image if GIF creation fails
-                return result_path, "static"
+    with profiling.activate(profiler), profiling.stage("encode"):
+        result_path, result_type = save_result(painted, ctx.frames, output_path)
+
+    print(f"Processed {'animation' if result_type == 'gif' else 'image'} saved to {result_path}")
+    if profiler is not None:
+        json_path, trace_path = save_profile(profiler, profile_path)
+        print(f"Profile saved to {json_path} and {trace_path}")
+    return result_path, result_type
+
+
+def paint_executor():
+    """
+    Return the default executor of painting jobs, created on first use.
+
+    It has a single dedicated thread: jobs run one at a time in submission order, so concurrent
+    jobs never compete for the CPU threads or GPU memory of one another, and the event loop is
+    never blocked by painting.
+    """
+    global _paint_executor
+    with _paint_executor_lock:
+        if _paint_executor is None:
+            _paint_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="paint")
+        return _paint_executor
+
+
+class PaintJob:
+    """
+    A painting job running on an executor, as returned by `submit_paint` and `submit_process_image`.
+
+    Await the job for its result. Progress events are posted to the event loop after every painting
+    pass, see `events`, and the job is cancelled cooperatively, see `cancel`.
+
+    Attributes:
+        cancel_event (threading.Event): Set when the job is cancelled. The painting run checks it
+                                        before every layer and parity group.
+        progress (dict): The latest progress event, or None before the first pass is done.
+    """
+
+    def __init__(self, cancel_event=None, on_progress=None):
+        self.loop = asyncio.get_running_loop()
+        self.cancel_event = threading.Event() if cancel_event is None else cancel_event
+        self.progress = None
+        self._on_progress = on_progress
+        self._events = asyncio.Queue()
+        self._concurrent_future = None
+        self._future = None
+
+    def _start(self, executor, fn):
+        concurrent_future = (executor or paint_executor()).submit(fn)
+        self._concurrent_future = concurrent_future
+        self._future = asyncio.wrap_future(concurrent_future, loop=self.loop)
+        self._future.add_done_callback(lambda _: self._events.put_nowait(None))
+
+    def _report(self, event):
+        # Called from the painting thread.
+        if self._on_progress is not None:
+            self._on_progress(event)
+        self.loop.call_soon_threadsafe(self._post, event)
+
+    def _post(self, event):
+        self.progress = event
+        self._events.put_nowait(event)
+
+    def cancel(self):
+        """
+        Cancel the job. A job that has not started yet never starts, and a running job stops at the
+        next layer or parity group. Awaiting a cancelled job raises asyncio.CancelledError.
+        Can be called from any thread.
+        """
+        self.cancel_event.set()
+        self._concurrent_future.cancel()
+
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def done(self):
+        return self._future.done()
+
+    async def result(self):
+        """
+        Wait for the job and return its result. Cancelling the awaiting task cancels the job.
+        """
+        try:
+            return await asyncio.shield(self._future)
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
+        except Exception as error:
+            # PaintCancelled can only have been raised once the inference module is imported.
+            inference = sys.modules.get("inference.inference")
+            if inference is not None and isinstance(error, inference.PaintCancelled):
+                raise asyncio.CancelledError() from None
+            raise
+
+    def __await__(self):
+        return self.result().__await__()
+
+    async def events(self):
+        """
+        Yield the progress events of the job as they come, until it finishes.
+
+        Every event is a dict with the layer of the pass ('border' for the final border pass), 'done'
+        and 'passes', the number of passes done and in total, and 'patches' and 'active_strokes', the
+        patch and active stroke counts of the pass. Events are delivered to a single consumer.
+        """
+        while True:
+            event = await self._events.get()
+            if event is None:
+                return
+            yield event
+
+
+def submit_paint(image, executor=None, ctx=None, **paint_image_kwargs):
+    """
+    Start painting an image in memory on an executor, and return the job without waiting for it.
+
+    Must be called from a coroutine, as `asyncio.create_task` is. Painting, and loading the network
+    on first use, run on the executor, so the event loop stays responsive.
+
+    Args:
+        image (str | bytes | PIL.Image.Image | numpy.ndarray): The image to paint. See `load_image`.
+        executor (concurrent.futures.Executor, optional): Where to run the job. Defaults to the
+                                                          dedicated thread of `paint_executor`.
+        ctx (PaintContext, optional): Job-scoped state of this run, see `paint_image`. Its
+                                      cancel_event and on_progress are shared with the job.
+        **paint_image_kwargs: Any other argument of `paint_image`.
+
+    Returns:
+        PaintJob: The job. Awaiting it returns the result of `paint_image`.
+
+    Example:
+        >>> job = submit_paint("photo.jpg", preset="draft")
+        >>> painted = await asyncio.wait_for(job, timeout=60)  # cancels the job on timeout
+    """
+    job = PaintJob(ctx.cancel_event if ctx is not None else None, ctx.on_progress if ctx is not None else None)
+
+    def run():
+        from inference.inference import PaintContext
+        run_ctx = PaintContext(cancel_event=job.cancel_event) if ctx is None else ctx
+        run_ctx.on_progress = job._report
+        return paint_image(image, ctx=run_ctx, **paint_image_kwargs)
+
+    job._start(executor, run)
+    return job
+
+
+async def paint_image_async(image, executor=None, **paint_image_kwargs):
+    """
+    Paint an image in memory without blocking the event loop. Same as awaiting `submit_paint`.
+    """
+    return await submit_paint(image, executor, **paint_image_kwargs)
+
+
+def submit_process_image(input_path, executor=None, on_progress=None, **process_image_kwargs):
+    """
+    Start `process_image_complete` on an executor, and return the job without waiting for it.
+
+    Must be called from a coroutine. See `submit_paint` for the executor and the job.
+
+    Args:
+        input_path (str): Path to the input image file
+        executor (concurrent.futures.Executor, optional): Where to run the job. Defaults to the
+                                                          dedicated thread of `paint_executor`.
+        on_progress (callable, optional): Also called with every progress event, from the painting thread.
+        **process_image_kwargs: Any other argument of `process_image_complete`.
+
+    Returns:
+        PaintJob: The job. Awaiting it returns (result_path, result_type).
+    """
+    job = PaintJob(on_progress=on_progress)
+    job._start(executor, functools.partial(process_image_complete, input_path, on_progress=job._report,
+                                           cancel_event=job.cancel_event, **process_image_kwargs))
+    return job
+
+
+def save_result(painted, frames, output_path):
+    """
+    Atomically save a painted image, or the animation of its painting process.
+
+    Args:
+        painted (PIL.Image.Image): The painted image
+        frames (list, optional): Animation frames. If None, the static image is saved.
+        output_path (str): Path of the output file
+
+    Returns:
+        tuple: A tuple containing (result_path, result_type), see `process_image_complete`
+    """
+    from inference.inference import atomic_save
+    if frames is not None:
+        gif_path = save_animation_gif(frames, output_path)
+        if gif_path:
+            return gif_path, "gif"
+        # Fallback to a static image next to the requested GIF if there were no frames
+        output_path = os.path.splitext(output_path)[0] + ".png"
+    atomic_save(painted, output_path)
+    return output_path, "static"
+
+
+def painttransformed_path(input_path, animation=False):
+    """
+    Return the default output path for an input: next to it, with "_painttransformed" appended.
+    """
+    file_dir, file_name = os.path.split(input_path)
+    file_base, file_ext = os.path.splitext(file_name)
+    if animation:
+        return os.path.join(file_dir, f"{file_base}_painttransformed.gif")
+    return os.path.join(file_dir, f"{file_base}_painttransformed{file_ext}")
+
+
+def process_images(input_paths, animation=False, output_paths=None, resize=True, memory_budget=None,
+                   decode_workers=2, encode_workers=2, queue_size=4, model_path=MODEL_PATH, preset=None,
+                   tuned=False):
+    """
+    Process a batch of images with decoding, inference and encoding running concurrently.
+
+    Inputs are decoded and resized by a pool of decode threads ahead of inference (JPEGs that are
+    downscaled use draft-mode decoding), inference runs in the calling thread, and results are
+    encoded by a pool of encoder threads. At most queue_size images wait between any two stages.
+
+    Args:
+        input_paths (list): Paths of the input images
+        animation (bool): If True, creates an animated GIF for every image. Defaults to False.
+        output_paths (list, optional): Output path for every input. If None, every output is saved
+                                       next to its input with a '_painttransformed' suffix.
+        resize (bool): If True, resizes images to fit within 512px. Defaults to True.
+        memory_budget (int | str, optional): Memory budget for every image, see `plan_image`.
+        decode_workers (int): Number of decode threads. Defaults to 2.
+        encode_workers (int): Number of encode threads. Defaults to 2.
+        queue_size (int): Maximum number of images waiting between two stages. Defaults to 4.
+        model_path (str): Path to the model weights. Defaults to "inference/model.pth".
+        preset (str | dict, optional): Speed/quality preset, see `process_image_complete`.
+        tuned (bool): Whether to apply this machine's execution profile, see `paint_image`.
+                      Defaults to False.
+
+    Returns:
+        tuple: A tuple containing (results, stats) where:
+            - results (list): (input_path, result_path, result_type, error) for every input, in order.
+                              error is None on success, otherwise result_path and result_type are None.
+            - stats (list): Per-stage statistics (items, busy time, throughput, capacity and utilization)
+    """
+    from inference.inference import paint, tensor_to_array, PaintContext
+    if output_paths is None:
+        output_paths = [painttransformed_path(path, animation) for path in input_paths]
+    net_g, meta_brushes = get_painter(model_path)
+    tuning = get_execution_profile(meta_brushes.device) if tuned else None
+
+    def decode(item):
+        input_path, _ = item
+        return prepare_image(input_path, resize, memory_budget=memory_budget, draft=True, preset=preset)
+
+    def infer(prepared):
+        original_img, max_render_bytes = prepared
+        ctx = PaintContext(collect_frames=animation)
+        painted = paint(original_img.to(meta_brushes.device), net_g, meta_brushes, ctx, animation, max_render_bytes,
+                        preset, tuning=tuning)
+        return painted.cpu(), ctx.frames
+
+    def encode(item, result):
+        _, output_path = item
+        painted, frames = result
+        return save_result(Image.fromarray(tensor_to_array(painted[0])), frames, output_path)
+
+    pipeline = BatchPipeline(decode, infer, encode, decode_workers, encode_workers, queue_size)
+    results = []
+    for (input_path, _), output, error in pipeline.run(zip(input_paths, output_paths)):
+        if error is None:
+            results.append((input_path, output[0], output[1], None))
         else:
-            return result_path, "static"
+            results.append((input_path, None, None, error))
+    return results, pipeline.stats()
 
-    finally:
-        # Clean up temporary processed file
-        if os.path.exists(processed_path):
-            os.unlink(processed_path)
+
+def build_arg_parser():
+    """
+    Build the command-line argument parser.
+    """
+    parser = argparse.ArgumentParser(
+        prog="colourlesstransformer.py",
+        description="Paint an image with Paint Transformer.",
+    )
+    parser.add_argument("image_paths", nargs="+", metavar="image_path",
+                        help="Path to the input image. Several images are processed as a pipelined batch")
+    parser.add_argument("--animation", action="store_true", help="Create an animated GIF of the painting process")
+    parser.add_argument("--no-resize", dest="resize", action="store_false",
+                        help="Process the image at its original size instead of 512px maximum dimension")
+    parser.add_argument("--profile", metavar="PATH", default=None,
+                        help="Record per-stage timings and memory use to PATH (JSON) and a Chrome trace next to it")
+    parser.add_argument("--memory-budget", metavar="SIZE", default=None,
+                        help="Memory budget such as 2GB; the image is downscaled to fit it or the job is rejected")
+    parser.add_argument("--plan", action="store_true",
+                        help="Only print the estimated peak memory and runtime and how the job would run")
+    parser.add_argument("--calibration", metavar="BASELINE", default=None,
+                        help="Benchmark baseline used to calibrate the runtime estimate of --plan")
+    parser.add_argument("--preset", choices=sorted(presets.PRESETS), default=presets.DEFAULT_PRESET,
+                        help="Speed/quality preset (default: standard)")
+    parser.add_argument("--max-layers", type=int, default=None, help="Paint at most this many pyramid layers")
+    parser.add_argument("--min-layer", type=int, default=None, help="First pyramid layer to paint")
+    parser.add_argument("--skip-border", action="store_true", default=None, help="Skip the final shifted border pass")
+    parser.add_argument("--max-strokes", type=int, default=None, help="Maximum number of active strokes per patch")
+    parser.add_argument("--brushes", choices=["large", "small", "auto"], default=None,
+                        help="Brush set to paint with; auto uses the small brushes on the finest layers")
+    parser.add_argument("--precision", choices=presets.PRECISIONS, default=None,
+                        help="Canvas and stroke precision; float16 and bfloat16 move less memory (default: float32)")
+    parser.add_argument("--brush-mode", choices=presets.BRUSH_MODES, default=None,
+                        help="Warp the brush textures, or draw strokes as anti-aliased ellipses or rounded "
+                             "rectangles (default: texture)")
+    parser.add_argument("--no-cull", dest="cull", action="store_false", default=None,
+                        help="Rasterize strokes that later strokes fully cover; the result is the same, only slower")
+    parser.add_argument("--mask", metavar="PATH", default=None,
+                        help="Only paint where this mask image is set (its alpha channel, or luminance if it has none)")
+    parser.add_argument("--box", metavar="L,T,R,B", type=parse_box, action="append", default=None,
+                        help="Only paint inside this box, in pixels of the input; can be repeated")
+    parser.add_argument("--base", metavar="PATH", default=None,
+                        help="Image shown outside the mask, e.g. a previous result (default: the input image)")
+    parser.add_argument("--decode-workers", type=int, default=2, help="Decode threads for batches (default: 2)")
+    parser.add_argument("--encode-workers", type=int, default=2, help="Encode threads for batches (default: 2)")
+    parser.add_argument("--queue-size", type=int, default=4,
+                        help="Maximum number of images waiting between two batch stages (default: 4)")
+    return parser
+
+
+def print_plan(plan):
+    """
+    Print a plan returned by `plan_image` in a human-readable form.
+    """
+    estimate = plan["estimate"]
+    print(f"Painting at {estimate['width']}x{estimate['height']} in {estimate['layers']} layers")
+    print(f"{'pass':>8} {'patches':>8} {'strokes':>8} {'stroke px':>9} {'peak memory':>12} {'runtime':>9}")
+    for item in estimate["passes"]:
+        print(f"{item['layer']:>8} {item['patches']:>8} {item['strokes']:>8} {item['render_patch_size']:>9} "
+              f"{planner.format_size(item['peak_bytes']):>12} {item['runtime_s']:>8.2f}s")
+    print(f"Estimated peak memory: {planner.format_size(estimate['peak_bytes'])}")
+    print(f"Estimated runtime: {estimate['runtime_s']:.2f}s")
+    if plan["max_render_bytes"] is not None:
+        print(f"Strokes rendered in chunks of up to {planner.format_size(plan['max_render_bytes'])}")
+    print(f"Decision: {plan['action']} ({plan['reason']})")
+
+
+def print_pipeline_stats(stats):
+    """
+    Print the per-stage statistics returned by `process_images`.
+    """
+    print(f"{'stage':>8} {'workers':>8} {'items':>6} {'busy':>8} {'items/s':>8} {'capacity':>9} {'util':>6}")
+    for stage in stats:
+        print(f"{stage['name']:>8} {stage['workers']:>8} {stage['items']:>6} {stage['busy_s']:>7.2f}s "
+              f"{stage['items_per_s']:>8.2f} {stage['capacity_items_per_s']:>9.2f} {stage['utilization']:>6.0%}")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python colourlesstransformer.py <image_path> [--animation] [--no-resize]")
-        sys.exit(1)
+    parser = build_arg_parser()
+    args = parser.parse_args()
 
-    input_file = sys.argv[1]
-    animation = "--animation" in sys.argv
-    resize = "--no-resize" not in sys.argv
+    preset = presets.resolve(args.preset, max_layers=args.max_layers, min_layer=args.min_layer,
+                             skip_border=args.skip_border, max_strokes=args.max_strokes, brushes=args.brushes,
+                             precision=args.precision, brush_mode=args.brush_mode, cull=args.cull)
 
-    file_dir, file_name = os.path.split(input_file)
-    file_base, file_ext = os.path.splitext(file_name)
+    if args.plan:
+        rejected = False
+        for image_path in args.image_paths:
+            try:
+                print_plan(plan_image(image_path, args.resize, memory_budget=args.memory_budget,
+                                      calibration=args.calibration, preset=preset))
+            except PlanRejected as e:
+                print_plan(e.plan)
+                rejected = True
+        sys.exit(1 if rejected else 0)
 
-    # Final output file with "paint-transformed" appended
-    if animation:
-        output_file = os.path.join(file_dir, f"{file_base}_painttransformed.gif")
-    else:
-        output_file = os.path.join(file_dir, f"{file_base}_painttransformed{file_ext}")
+    animation = args.animation
+    resize = args.resize
 
-    print(f"Processing image: {input_file}")
     if animation:
         print("Animation mode enabled")
     if resize:
-        print("Resizing image to 512px maximum dimension")
+        print("Resizing images to 512px maximum dimension")
     else:
-        print("Processing image at original size")
+        print("Processing images at original size")
+
+    if args.mask and args.box:
+        parser.error("--mask and --box cannot be combined")
+    mask = args.mask or args.box
 
-    result_path, result_type = process_image_complete(input_file, animation, output_file, resize)
+    if len(args.image_paths) > 1:
+        if args.profile or mask or args.base:
+            parser.error("--profile, --mask, --box and --base only support a single image")
+        print(f"Processing {len(args.image_paths)} images")
+        results, stats = process_images(args.image_paths, animation, None, resize, args.memory_budget,
+                                        args.decode_workers, args.encode_workers, args.queue_size, preset=preset,
+                                        tuned=True)
+        failed = 0
+        for input_file, result_path, result_type, error in results:
+            if error is None:
+                print(f"Successfully created {result_type}: {result_path}")
+            else:
+                print(f"Processing {input_file} failed: {error}")
+                failed += 1
+        print_pipeline_stats(stats)
+        sys.exit(1 if failed else 0)
+
+    input_file = args.image_paths[0]
+    # Final output file with "paint-transformed" appended
+    output_file = painttransformed_path(input_file, animation)
+
+    print(f"Processing image: {input_file}")
+    try:
+        result_path, result_type = process_image_complete(
+            input_file, animation, output_file, resize, args.profile, args.memory_budget, preset, mask, args.base,
+            tuned=True
+        )
+    except PlanRejected as e:
+        print(f"Job rejected by the memory planner: {e}")
+        sys.exit(1)
 
     if result_path:
         print(f"Successfully created {result_type}: {result_path}")
@@ -0,0 +1,87 @@
+"""
+Analytic stroke rasterizer.
+
+The texture brushes of param2stroke are warped with affine_grid and grid_sample and their edges cleaned up with a
+dilation and an erosion, which sample 9 neighbours each. A stroke can instead be rasterized from its parameters
+alone: it covers a rotated ellipse or rounded rectangle centred at (x0 * W, y0 * H), rotated by theta * pi, with
+half extents W * w / 2 along its own x axis and H * h / 2 along its own y axis, the same area the texture brushes
+are warped to. Coverage is evaluated from the signed distance to the shape at every pixel centre, so the edges are
+anti-aliased over one pixel, and the stroke is filled with its colour.
+"""
+import math
+
+import torch
+
+SHAPES = ('ellipse', 'roundrect')
+# Corner radius of 'roundrect' strokes, as a fraction of their shorter half extent.
+CORNER_RADIUS = 0.5
+# Smallest half extent in pixels, which keeps the distances of degenerate strokes finite.
+MIN_EXTENT = 1e-2
+
+
+def signed_distance(param, H, W, shape):
+    """
+    Signed distance in pixels from every pixel centre to the outline of every stroke, negative inside.
+    Args:
+        param: a tensor with shape n_strokes x n_param_per_stroke, see inference.param2stroke.
+        H: output height.
+        W: output width.
+        shape: one of SHAPES.
+
+    Returns:
+        A tensor with shape n_strokes x 1 x H x W.
+    """
+    x0, y0, w, h, theta = [item.view(-1, 1, 1, 1) for item in param[:, :5].unbind(1)]
+    sin_theta = torch.sin(math.pi * theta)
+    cos_theta = torch.cos(math.pi * theta)
+    ys = torch.arange(H, device=param.device, dtype=param.dtype).view(1, 1, H, 1) + 0.5 - y0 * H
+    xs = torch.arange(W, device=param.device, dtype=param.dtype).view(1, 1, 1, W) + 0.5 - x0 * W
+    # Coordinates in the frame of the stroke, as the texture brushes are warped.
+    u = xs * cos_theta + ys * sin_theta
+    v = ys * cos_theta - xs * sin_theta
+    a = (W * w / 2).clamp_min(MIN_EXTENT)
+    b = (H * h / 2).clamp_min(MIN_EXTENT)
+    if shape == 'ellipse':
+        # First order distance to an ellipse: its implicit function divided by the norm of its gradient.
+        k0 = torch.sqrt((u / a) ** 2 + (v / b) ** 2)
+        k1 = torch.sqrt((u / (a * a)) ** 2 + (v / (b * b)) ** 2)
+        # k0 / k1 tends to a value between a and b at the centre, where both vanish.
+        return (k0 - 1) * torch.where(k1 > 0, k0 / k1, torch.minimum(a, b))
+    if shape == 'roundrect':
+        radius = CORNER_RADIUS * torch.minimum(a, b)
+        qu = u.abs() - a + radius
+        qv = v.abs() - b + radius
+        outside = torch.sqrt(qu.clamp_min(0) ** 2 + qv.clamp_min(0) ** 2)
+        return outside + torch.maximum(qu, qv).clamp_max(0) - radius
+    raise ValueError('unknown stroke shape %r, expected one of %s' % (shape, ', '.join(SHAPES)))
+
+
+def coverage(param, H, W, shape):
+    """
+    Fraction of every pixel covered by every stroke, a tensor with shape n_strokes x 1 x H x W in [0, 1].
+    """
+    return (0.5 - signed_distance(param, H, W, shape)).clamp_(0, 1)
+
+
+def param2stroke(param, H, W, shape, dtype=None):
+    """
+    Rasterize strokes analytically, as inference.param2stroke does with texture brushes.
+    Args:
+        param: a tensor with shape n_strokes x n_param_per_stroke.
+        H: output height.
+        W: output width.
+        shape: one of SHAPES.
+        dtype: None, or a reduced precision floating point dtype for the low-precision render mode, in which
+         foregrounds are returned in dtype and alphas as a bool tensor with a single channel, set where strokes
+         cover at least half of a pixel.
+
+    Returns:
+        foregrounds: a tensor with shape n_strokes x 3 x H x W, the colour of every stroke.
+        alphas: a tensor with shape n_strokes x 3 x H x W, the anti-aliased coverage of every stroke.
+    """
+    n = param.shape[0]
+    alphas = coverage(param, H, W, shape)
+    color = param[:, 5:8].view(n, 3, 1, 1)
+    if dtype is not None:
+        return color.to(dtype).expand(n, 3, H, W), alphas >= 0.5
+    return color.expand(n, 3, H, W), alphas.expand(n, 3, H, W)
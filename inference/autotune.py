@@ -0,0 +1,255 @@
+"""
+Per-machine execution profiles.
+
+How fast a painting pass runs depends on the number of CPU threads torch uses and on how many patches the
+Painter sees in one forward pass, and the best values depend on the machine and on the size of the pass:
+the coarse layers have 1 to 16 patches, the finest ones thousands. `tune` benchmarks the Painter forward pass
+and param2img_parallel on this machine for every layer of an image of up to max_dim pixels, across thread
+counts and batch sizes, and `save` writes the best settings of every layer as a profile. At paint time,
+`layer_settings` picks the settings of a pass from the profile of the layer with the closest number of patches.
+
+Profiles record the machine and torch version they were measured with, and `load` ignores a profile measured
+anywhere else. Run the tuner once per machine, from the repository root:
+
+    python -m inference.autotune
+    python -m inference.autotune --max-dim 2048 --device cuda
+
+Thread counts are process-wide in torch, so they are set for the duration of every pass and restored after, under
+a lock that tuned passes of concurrent paintings wait for. Applying a profile is therefore opt-in, for processes where
+one painting runs at a time, such as the command line or the painting thread of the async API.
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import statistics
+import tempfile
+import threading
+import time
+
+import torch
+
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache')
+PROFILE_VERSION = 1
+PATCH_SIZE = 32
+# Settings of a pass without a profile: torch's own thread count and a single forward pass over every patch.
+DEFAULT_SETTINGS = {'net_g_threads': None, 'net_g_batch': None, 'render_threads': None}
+# Held while a block runs with a tuned thread count, so that no other thread changes or restores it meanwhile.
+_threads_lock = threading.Lock()
+
+
+def profile_path(device):
+    """
+    Default path of the profile of a device type.
+    """
+    return os.path.join(PROFILE_DIR, 'autotune-%s.json' % torch.device(device).type)
+
+
+def machine(device):
+    """
+    What a profile is only valid for: the hardware, its CPU count, the torch version and the device. The host name
+    is left out, since containers get a new one on every start while running on the same hardware.
+    """
+    device = torch.device(device)
+    info = {'machine': platform.machine(), 'processor': platform.processor(),
+            'cpu_count': os.cpu_count(), 'torch': torch.__version__, 'device': device.type}
+    if device.type == 'cuda':
+        info['device_name'] = torch.cuda.get_device_name(device)
+    return info
+
+
+def candidate_threads(device, max_threads=None):
+    """
+    Thread counts to try: powers of two up to the CPU count, and the CPU count itself.
+    Threads barely matter on cuda, where torch's own setting is kept.
+    """
+    if torch.device(device).type == 'cuda':
+        return [None]
+    max_threads = max_threads or os.cpu_count() or 1
+    counts = [2 ** i for i in range(int(math.log2(max_threads)) + 1)]
+    return counts + ([max_threads] if max_threads not in counts else [])
+
+
+def candidate_batches(patches):
+    """
+    Forward pass batch sizes to try for a pass: every patch at once (None), and powers of 4 from 16 below it.
+    """
+    return [None] + [4 ** i for i in range(2, int(math.log(max(patches, 1), 4)) + 1) if 4 ** i < patches]
+
+
+@contextlib.contextmanager
+def threads(num_threads):
+    """
+    Run a block with torch using num_threads threads, and restore the previous count after. None changes nothing.
+    The thread count is global to the process, so blocks with a thread count run one at a time: without the lock,
+    concurrent blocks would restore each other's counts and leave the process on a count nobody chose.
+    """
+    if num_threads is None:
+        yield
+        return
+    with _threads_lock:
+        previous = torch.get_num_threads()
+        if num_threads != previous:
+            torch.set_num_threads(num_threads)
+        try:
+            yield
+        finally:
+            if num_threads != previous:
+                torch.set_num_threads(previous)
+
+
+def layer_settings(profile, patches):
+    """
+    Settings of a painting pass with the given number of patches.
+    Args:
+        profile: a profile as returned by load, or None.
+        patches: number of patches of the pass.
+
+    Returns:
+        A dict with net_g_threads, net_g_batch and render_threads, taken from the layer of the profile with the
+        closest number of patches. Every value is None without a profile.
+    """
+    if not profile or not profile.get('layers'):
+        return DEFAULT_SETTINGS
+    layer = min(profile['layers'], key=lambda item: abs(math.log(item['patches']) - math.log(max(patches, 1))))
+    return {key: layer[key] for key in DEFAULT_SETTINGS}
+
+
+def load(device, path=None):
+    """
+    The profile of a device, or None when there is none, it cannot be read, or it was measured on another
+    machine or with another version of torch or of the profile format.
+    """
+    path = profile_path(device) if path is None else path
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if profile.get('version') != PROFILE_VERSION or profile.get('machine') != machine(device):
+        return None
+    return profile
+
+
+def save(profile, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(suffix='.json', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(profile, f, indent=2)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def median_time(fn, device, repeat):
+    fn()
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        runs.append(time.perf_counter() - start)
+    return statistics.median(runs)
+
+
+def tuning_layers(max_dim):
+    """
+    Patches per side and stroke render size of every layer of an image of max_dim pixels.
+    """
+    num_layers = max(math.ceil(math.log2(max_dim / PATCH_SIZE)), 0) + 1
+    pad_size = PATCH_SIZE * 2 ** (num_layers - 1)
+    return [(2 ** layer, 2 * pad_size // 2 ** layer) for layer in range(num_layers)]
+
+
+def tune(net_g, device, max_dim=1024, repeat=3, max_threads=None, log=print):
+    """
+    Benchmark every layer of an image of max_dim pixels and return the best settings as a profile.
+
+    For every layer, the Painter forward pass (predict_strokes) is timed with every thread count and then, with
+    the best one, with every batch size, and param2img_parallel is timed with every thread count. Half of
+    the strokes of random parameters are active, as in benchmarks/bench_inference.py.
+    """
+    import inference.brushes as brushes
+    import inference.inference as inference
+
+    device = torch.device(device)
+    generator = torch.Generator().manual_seed(0)
+    library = brushes.load_library(device)
+    thread_counts = candidate_threads(device, max_threads)
+    stroke_num = net_g.query_pos.shape[0]
+    layers = []
+    for patch_num, render_size in tuning_layers(max_dim):
+        patches = patch_num * patch_num
+        img_patch = torch.rand(patches, 3, PATCH_SIZE, PATCH_SIZE, generator=generator).to(device)
+        result_patch = torch.rand(patches, 3, PATCH_SIZE, PATCH_SIZE, generator=generator).to(device)
+
+        def forward(num_threads, batch):
+            with threads(num_threads):
+                return median_time(lambda: inference.predict_strokes(net_g, img_patch, result_patch, patch_num,
+                                                                     patch_num, batch_size=batch), device, repeat)
+
+        net_g_times = {num_threads: forward(num_threads, None) for num_threads in thread_counts}
+        net_g_threads = min(net_g_times, key=net_g_times.get)
+        batch_times = {batch: forward(net_g_threads, batch) for batch in candidate_batches(patches)[1:]}
+        batch_times[None] = net_g_times[net_g_threads]
+        net_g_batch = min(batch_times, key=batch_times.get)
+
+        low = torch.tensor([0.25, 0.25, 0.02, 0.02, 0., 0., 0., 0.])
+        high = torch.tensor([0.75, 0.75, 0.5, 0.5, 1., 1., 1., 1.])
+        param = (low + (high - low) * torch.rand(patches * stroke_num, 8, generator=generator)).view(
+            1, patch_num, patch_num, stroke_num, 8).to(device)
+        decision = (torch.rand(1, patch_num, patch_num, stroke_num, generator=generator) > 0.5).to(device)
+        canvas = torch.zeros(1, 3, patch_num * render_size // 2, patch_num * render_size // 2, device=device)
+        meta_brushes = library.brushes(brushes.DEFAULT_SET, render_size)
+        render_times = {}
+        for num_threads in thread_counts:
+            with threads(num_threads):
+                render_times[num_threads] = median_time(
+                    lambda: inference.param2img_parallel(param, decision, meta_brushes, canvas), device, repeat)
+        render_threads = min(render_times, key=render_times.get)
+
+        layers.append({'patches': patches, 'render_size': render_size, 'net_g_threads': net_g_threads,
+                       'net_g_batch': net_g_batch, 'render_threads': render_threads,
+                       'net_g_s': batch_times[net_g_batch], 'render_s': render_times[render_threads],
+                       'default_s': net_g_times[thread_counts[-1]] + render_times[thread_counts[-1]]})
+        log('%5d patches, strokes at %4d px: net_g %s threads, batch %s (%.4fs), render %s threads (%.4fs)'
+            % (patches, render_size, net_g_threads, net_g_batch, batch_times[net_g_batch], render_threads,
+               render_times[render_threads]))
+    return {'version': PROFILE_VERSION, 'machine': machine(device), 'max_dim': max_dim, 'layers': layers}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--model', default='inference/model.pth',
+                        help='Painter weights. Random weights are used when the file does not exist, at the same cost')
+    parser.add_argument('--max-dim', type=int, default=1024, help='tune the layers of images up to this size')
+    parser.add_argument('--max-threads', type=int, help='largest thread count to try, defaults to the CPU count')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', metavar='PATH', help='where to save the profile, defaults to %s'
+                        % profile_path('cpu'))
+    args = parser.parse_args()
+
+    import inference.inference as inference
+    import inference.network as network
+
+    device = torch.device(args.device)
+    torch.set_grad_enabled(False)
+    if os.path.exists(args.model):
+        net_g = inference.load_painter(args.model, device)
+    else:
+        torch.manual_seed(0)
+        net_g = network.Painter(5, 8, 256, 8, 3, 3).to(device).eval()
+    profile = tune(net_g, device, args.max_dim, args.repeat, args.max_threads)
+    output = args.output or profile_path(device)
+    save(profile, output)
+    print('Profile saved to %s' % output)
+
+
+if __name__ == '__main__':
+    main()
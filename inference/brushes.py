@@ -0,0 +1,195 @@
+"""
+Brush library.
+
+Strokes are rasterized by warping a meta brush, a pair of vertical and horizontal brush images, that is first
+resized to the size strokes are rendered at. The library loads every brush set in inference/brush/
+(brush_<name>_vertical.png and brush_<name>_horizontal.png) once, and keeps a pyramid of every set resized to
+each power-of-two rendering size in a memory-mapped cache file, so painting never resizes brushes again.
+The cache lives next to the brushes and is rebuilt when a brush file changes.
+
+Every layer can be painted with a different brush set, see brush_set.
+"""
+import functools
+import glob
+import hashlib
+import os
+import re
+import tempfile
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+BRUSH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'brush')
+DEFAULT_SET = 'large'
+# Rendering sizes kept in the cache. Strokes are rendered at 2 * padded size / patches per side, a power of two
+# of at least 32 pixels; sizes above the largest level only occur on the coarsest layers of large inputs, with
+# a handful of patches, and are resized on first use.
+PYRAMID_SIZES = [2 ** level for level in range(3, 11)]
+# The 'auto' schedule paints strokes rendered at up to this size with the small brushes.
+SMALL_BRUSH_MAX_SIZE = 64
+CACHE_VERSION = 1
+
+
+def find_sets(brush_dir=BRUSH_DIR):
+    """
+    Brush sets in brush_dir, as a dict from set name to the paths of its vertical and horizontal brushes.
+    """
+    sets = {}
+    for vertical in sorted(glob.glob(os.path.join(brush_dir, 'brush_*_vertical.png'))):
+        name = re.fullmatch(r'brush_(.+)_vertical\.png', os.path.basename(vertical)).group(1)
+        horizontal = os.path.join(brush_dir, 'brush_%s_horizontal.png' % name)
+        if os.path.exists(horizontal):
+            sets[name] = (vertical, horizontal)
+    return sets
+
+
+def read_brush(path):
+    """
+    Read a brush image as a 1 x 1 x H x W float tensor with values in [0, 1].
+    """
+    img = np.array(Image.open(path).convert('L'))
+    return torch.from_numpy(img)[None, None].float() / 255.
+
+
+def build_pyramid(meta_brushes, sizes=PYRAMID_SIZES):
+    """
+    Resize meta brushes to every size, exactly as param2stroke would, and pack the results into a flat uint8
+    array: the 2 x size x size brushes of each size, one after the other. Brush values are multiples of 1 / 255,
+    so they are stored exactly.
+    """
+    levels = [(F.interpolate(meta_brushes, (size, size)) * 255.).round().to(torch.uint8).flatten()
+              for size in sizes]
+    return torch.cat(levels).numpy()
+
+
+def brush_set(schedule, layer, render_size):
+    """
+    Name of the brush set a painting pass uses.
+    Args:
+        schedule: None for the default set everywhere, the name of a set for every pass, 'auto' for the small
+         brushes on passes rendered at up to SMALL_BRUSH_MAX_SIZE pixels and the large ones elsewhere, or a dict
+         from layer (an int, or 'border' for the final shifted pass) to set name, with the default set for
+         missing layers.
+        layer: the layer of the pass.
+        render_size: the size strokes of the pass are rendered at.
+    """
+    if schedule is None:
+        return DEFAULT_SET
+    if schedule == 'auto':
+        return 'small' if render_size <= SMALL_BRUSH_MAX_SIZE else 'large'
+    if isinstance(schedule, str):
+        return schedule
+    return schedule.get(layer, DEFAULT_SET)
+
+
+class BrushLibrary:
+    """
+    Every brush set of a directory, loaded once and resized to rendering sizes through a cached pyramid.
+    Args:
+        device: device of the returned brushes. None means cpu.
+        brush_dir: directory of the brush images.
+        cache_dir: directory of the pyramid cache files. None means a .cache directory inside brush_dir.
+         When it cannot be written, the pyramids are kept in memory only.
+    """
+
+    def __init__(self, device=None, brush_dir=BRUSH_DIR, cache_dir=None):
+        self.device = torch.device('cpu') if device is None else torch.device(device)
+        self.brush_dir = brush_dir
+        self.cache_dir = os.path.join(brush_dir, '.cache') if cache_dir is None else cache_dir
+        self.sets = find_sets(brush_dir)
+        self._meta_brushes = {}
+        self._pyramids = {}
+        self._brushes = {}
+
+    @property
+    def names(self):
+        return list(self.sets)
+
+    def meta_brushes(self, name=DEFAULT_SET):
+        """
+        The full resolution brushes of a set, a tensor with shape 2 x 1 x meta_brush_height x meta_brush_width
+        on the device of the library.
+        The first slice on the batch dimension is the vertical brush and the second one the horizontal brush.
+        """
+        if name not in self._meta_brushes:
+            if name not in self.sets:
+                raise KeyError('unknown brush set %r, expected one of %s' % (name, ', '.join(self.sets)))
+            meta_brushes = torch.cat([read_brush(path) for path in self.sets[name]], dim=0)
+            self._meta_brushes[name] = meta_brushes.to(self.device)
+        return self._meta_brushes[name]
+
+    def brushes(self, name, size):
+        """
+        The brushes of a set resized to size x size, a tensor with shape 2 x 1 x size x size on the device of
+        the library, equal to resizing meta_brushes(name) with nearest neighbour interpolation.
+        Only the sizes of PYRAMID_SIZES are kept by the library, which lives as long as the process: other sizes
+        are resized on every call and freed with the painting that asked for them.
+        """
+        if size not in PYRAMID_SIZES:
+            return F.interpolate(self.meta_brushes(name), (size, size))
+        key = (name, size)
+        if key not in self._brushes:
+            offset = sum(2 * level * level for level in PYRAMID_SIZES[:PYRAMID_SIZES.index(size)])
+            level = np.array(self._pyramid(name)[offset:offset + 2 * size * size])
+            brushes = torch.from_numpy(level).view(2, 1, size, size).float() / 255.
+            self._brushes[key] = brushes.to(self.device)
+        return self._brushes[key]
+
+    def _cache_path(self, name):
+        stamp = [CACHE_VERSION, PYRAMID_SIZES]
+        for path in self.sets[name]:
+            stat = os.stat(path)
+            stamp.append((os.path.basename(path), stat.st_mtime_ns, stat.st_size))
+        digest = hashlib.sha1(repr(stamp).encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, 'brush_%s-%s.npy' % (name, digest))
+
+    def _pyramid(self, name):
+        """
+        The pyramid of a set as packed by build_pyramid, memory-mapped from the cache when possible.
+        """
+        if name in self._pyramids:
+            return self._pyramids[name]
+        expected = sum(2 * size * size for size in PYRAMID_SIZES)
+        cache_path = self._cache_path(name)
+        try:
+            pyramid = np.load(cache_path, mmap_mode='r')
+            if pyramid.dtype != np.uint8 or pyramid.shape != (expected,):
+                raise ValueError('stale brush cache %s' % cache_path)
+        except (OSError, ValueError):
+            pyramid = build_pyramid(self.meta_brushes(name).cpu())
+            try:
+                pyramid = self._save_pyramid(name, cache_path, pyramid)
+            except OSError:
+                # A read-only installation: keep the pyramid in memory for this process.
+                pass
+        self._pyramids[name] = pyramid
+        return pyramid
+
+    def _save_pyramid(self, name, cache_path, pyramid):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Cache files of older versions of the brushes.
+        for stale in glob.glob(os.path.join(self.cache_dir, 'brush_%s-*.npy' % name)):
+            if stale != cache_path:
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+        fd, temp_path = tempfile.mkstemp(suffix='.npy', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, pyramid)
+            os.replace(temp_path, cache_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return np.load(cache_path, mmap_mode='r')
+
+
+@functools.lru_cache(maxsize=None)
+def load_library(device=None, brush_dir=BRUSH_DIR):
+    """
+    The BrushLibrary of a device, created on first use and shared afterwards.
+    """
+    return BrushLibrary(device, brush_dir)
@@ -0,0 +1,204 @@
+"""
+Occlusion culling of hidden strokes.
+
+Within one rendering pass of param2img_parallel, strokes are composited in parity group order, and in stroke order
+within a patch. A stroke whose every drawn pixel is later covered by a stroke with an alpha of exactly 1 there
+leaves no trace in the result, so it can be dropped before it is rasterized. Every stroke gets two conservative
+footprints, rotated rectangles in pixels of the padded canvas, clipped to its patch:
+
+    outer: contains every pixel centre where the stroke has a non-zero alpha.
+    inner: contains only pixel centres where the stroke has an alpha of exactly 1.
+
+A stroke is culled when its outer footprint lies inside the inner footprint of a later stroke of the same patch or
+of an overlapping patch of a later parity group. With an alpha of 1, c = f * a + c * (1 - a) discards everything
+below, both in the loop and in the closed forms of composite_strokes and composite_masked_strokes, so the result
+is exactly the same.
+
+For texture brushes, the inner footprint is the largest centred rectangle of non-zero brush texels, whose bilinear
+samples are non-zero, shrunk by sqrt(2) pixels for the 3 x 3 erosion of alphas; the outer footprint grows the
+brush by the reach of bilinear sampling and by one pixel. Analytic strokes use bounds of their coverage function.
+"""
+import itertools
+import math
+
+import torch
+import torch.nn.functional as F
+
+import inference.analytic as analytic
+
+# Safety margin in pixels for the rounding of the stroke geometry.
+MARGIN = 0.05
+# Parity groups in rendering order, see inference.parity_groups.
+GROUP_ORDER = ((0, 0), (1, 1), (1, 0), (0, 1))
+# Stroke pair tensors with 4 corners alive at once while comparing two patches: rel_x, rel_y, u, v and temporaries.
+PAIR_TENSORS = 6
+
+
+def opaque_extents(brushes):
+    """
+    Half extents of the largest centred rectangle of non-zero texels of every brush, in normalized brush
+    coordinates: every bilinear sample of the brush inside it is non-zero.
+    Args:
+        brushes: a tensor with shape n x 1 x S_y x S_x.
+
+    Returns:
+        A tensor with shape n x 2, the half extents along x and y. Zero for a brush without non-zero centre.
+    """
+    n, _, size_y, size_x = brushes.shape
+    mask = (brushes[:, 0] > 0).to(torch.int32)
+    table = F.pad(mask.cumsum(1).cumsum(2), [1, 0, 1, 0])
+    rows = torch.arange(1, size_y // 2 + 1, device=brushes.device)
+    cols = torch.arange(1, size_x // 2 + 1, device=brushes.device)
+    top, bottom = size_y // 2 - rows, (size_y - 1) // 2 + rows
+    left, right = size_x // 2 - cols, (size_x - 1) // 2 + cols
+    # Texel sums of every centred rectangle, with 2 * rows (or 2 * rows + 1) rows and as many columns.
+    sums = (table[:, bottom + 1][:, :, right + 1] - table[:, top][:, :, right + 1]
+            - table[:, bottom + 1][:, :, left] + table[:, top][:, :, left])
+    areas = (bottom - top + 1)[:, None] * (right - left + 1)[None, :]
+    full = sums == areas
+    # The full rectangle with the largest area.
+    score = torch.where(full, areas.expand_as(full), torch.zeros_like(full, dtype=areas.dtype)).flatten(1)
+    best = score.argmax(1)
+    best_row, best_col = best // cols.numel(), best % cols.numel()
+    # Outermost texel centres of the rectangle, in normalized coordinates.
+    extent_y = (2 * bottom[best_row] + 1).float() / size_y - 1
+    extent_x = (2 * right[best_col] + 1).float() / size_x - 1
+    found = score.gather(1, best[:, None]).squeeze(1) > 0
+    return torch.stack([extent_x, extent_y], dim=1) * found[:, None]
+
+
+def footprints(param, patch_size_y, patch_size_x, meta_brushes):
+    """
+    Outer and inner half extents of strokes in pixels, see the module docstring.
+    Args:
+        param: a tensor with shape n_strokes x n_param_per_stroke.
+        patch_size_y, patch_size_x: size strokes are rendered at.
+        meta_brushes: the brushes of the pass, as passed to param2stroke, or the name of an analytic shape.
+
+    Returns:
+        outer, inner: tensors with shape n_strokes x 2, the half extents along the x and y axes of every stroke.
+         Inner half extents can be negative, for strokes without any pixel of alpha 1.
+    """
+    w, h = param[:, 2], param[:, 3]
+    a = (patch_size_x * w / 2).clamp_min(analytic.MIN_EXTENT)
+    b = (patch_size_y * h / 2).clamp_min(analytic.MIN_EXTENT)
+    extents = torch.stack([a, b], dim=1)
+    if isinstance(meta_brushes, str) and meta_brushes == 'ellipse':
+        # The first order distance of analytic.signed_distance is off by at most a factor of min(a, b) / max(a, b)
+        # of the implicit function, so alphas are zero outside the ellipse scaled by 1 + 0.5 / min(a, b) and one
+        # inside the ellipse scaled by 1 - 0.5 / min(a, b), whose inscribed rectangle is 1 / sqrt(2) of it.
+        shortest = torch.minimum(a, b)[:, None]
+        outer = extents * (1 + 0.5 / shortest) + MARGIN
+        inner = extents * (1 - 0.5 / shortest) / math.sqrt(2) - MARGIN
+        return outer, inner
+    if isinstance(meta_brushes, str) and meta_brushes == 'roundrect':
+        # The rounded rectangle distance is exact: alphas are zero half a pixel outside of it and one half a pixel
+        # inside of it, which contains the rectangle whose corners lie on the corner arcs, shrunk by the diagonal of
+        # half a pixel.
+        radius = analytic.CORNER_RADIUS * torch.minimum(a, b)[:, None]
+        outer = extents + 0.5 + MARGIN
+        inner = extents - radius * (1 - 1 / math.sqrt(2)) - 0.5 * math.sqrt(2) - MARGIN
+        return outer, inner
+    if isinstance(meta_brushes, str):
+        raise ValueError('unknown stroke shape %r, expected one of %s' % (meta_brushes, ', '.join(analytic.SHAPES)))
+    if meta_brushes.shape[-2:] != (patch_size_y, patch_size_x):
+        meta_brushes = F.interpolate(meta_brushes, (patch_size_y, patch_size_x))
+    # Vertical brush when h > w, as in param2stroke.
+    index = (h <= w).long()
+    size = torch.tensor([patch_size_x, patch_size_y], device=param.device, dtype=param.dtype)
+    # Bilinear samples reach half a texel past the outermost texel centres, which are half a texel from the edge.
+    outer = extents * (1 + 2 / size) + 1 + MARGIN
+    inner = extents * opaque_extents(meta_brushes).to(param.dtype)[index] - math.sqrt(2) - MARGIN
+    return outer, inner
+
+
+def hidden_strokes(param, decision, meta_brushes, patch_size_y, patch_size_x, max_bytes=None):
+    """
+    Find the active strokes of a rendering pass that are fully hidden by later strokes.
+    Args:
+        param: a tensor with shape b x h x w x n_stroke_per_patch x n_param_per_stroke, see param2img_parallel.
+        decision: a bool tensor with shape b x h x w x n_stroke_per_patch.
+        meta_brushes: the brushes of the pass, as passed to param2stroke, or the name of an analytic shape.
+        patch_size_y, patch_size_x: size strokes are rendered at. Neighbouring patches are half of it apart.
+        max_bytes: memory budget for comparing the strokes of neighbouring patches, which is done in chunks of
+         patch rows that fit in it. None means all rows at once.
+
+    Returns:
+        A bool tensor with the shape of decision, set for hidden strokes, which can be dropped without changing the
+        rendering result.
+    """
+    b, h, w, s, p = param.shape
+    device = param.device
+    flat = param.reshape(-1, p)
+    outer, inner = footprints(flat, patch_size_y, patch_size_x, meta_brushes)
+    outer = outer.view(b, h, w, s, 2)
+    inner = inner.view(b, h, w, s, 2)
+    theta = math.pi * param[..., 4]
+    cos_theta, sin_theta = torch.cos(theta), torch.sin(theta)
+    # Stroke centres and patch boxes in pixels of the padded canvas.
+    patch_y = torch.arange(h, device=device, dtype=param.dtype).view(1, h, 1, 1) * (patch_size_y // 2)
+    patch_x = torch.arange(w, device=device, dtype=param.dtype).view(1, 1, w, 1) * (patch_size_x // 2)
+    center_x = patch_x + param[..., 0] * patch_size_x
+    center_y = patch_y + param[..., 1] * patch_size_y
+    # Corners of the outer footprints: b x h x w x s x 4.
+    signs_u = torch.tensor([1., 1., -1., -1.], device=device, dtype=param.dtype)
+    signs_v = torch.tensor([1., -1., 1., -1.], device=device, dtype=param.dtype)
+    du = outer[..., 0:1] * signs_u
+    dv = outer[..., 1:2] * signs_v
+    corner_x = center_x[..., None] + du * cos_theta[..., None] - dv * sin_theta[..., None]
+    corner_y = center_y[..., None] + du * sin_theta[..., None] + dv * cos_theta[..., None]
+    # Bounding box of the outer footprint clipped to its patch.
+    box_top = torch.maximum(corner_y.amin(-1), patch_y)
+    box_bottom = torch.minimum(corner_y.amax(-1), patch_y + patch_size_y)
+    box_left = torch.maximum(corner_x.amin(-1), patch_x)
+    box_right = torch.minimum(corner_x.amax(-1), patch_x + patch_size_x)
+
+    group_rank = torch.empty(2, 2, dtype=torch.long)
+    for rank, (offset_y, offset_x) in enumerate(GROUP_ORDER):
+        group_rank[offset_y, offset_x] = rank
+    hidden = torch.zeros_like(decision)
+    stroke_index = torch.arange(s, device=device)
+    if max_bytes is None:
+        rows_per_chunk = h
+    else:
+        row_bytes = b * w * s * s * 4 * param.element_size() * PAIR_TENSORS
+        rows_per_chunk = max(1, min(h, max_bytes // max(row_bytes, 1)))
+    for row, dy, dx in itertools.product(range(0, h, rows_per_chunk), (-1, 0, 1), (-1, 0, 1)):
+        # The later stroke B lies in patch (y + dy, x + dx) of the stroke A at (y, x), for the rows y of the chunk.
+        ys = slice(max(row, -dy), min(row + rows_per_chunk, h - dy))
+        xs = slice(max(0, -dx), min(w, w - dx))
+        ys_b = slice(ys.start + dy, ys.stop + dy)
+        xs_b = slice(max(0, dx), min(w, w + dx))
+        if ys.start >= ys.stop or xs.start >= xs.stop:
+            continue
+        # rank_a, rank_b: render order of the parity groups of A and B, for every A patch.
+        parity_y = torch.arange(h)[ys] % 2
+        parity_x = torch.arange(w)[xs] % 2
+        rank_a = group_rank[parity_y[:, None], parity_x[None, :]]
+        rank_b = group_rank[(parity_y[:, None] + dy) % 2, (parity_x[None, :] + dx) % 2]
+        if dy == 0 and dx == 0:
+            # Same patch: B is later when its stroke index is larger.
+            later = (stroke_index[None, :] > stroke_index[:, None]).view(1, 1, 1, s, s)
+        else:
+            later = (rank_b > rank_a).to(device).view(1, *rank_a.shape, 1, 1).expand(1, *rank_a.shape, s, s)
+        if not later.any():
+            continue
+        # A is the row stroke, B the column stroke: b x ny x nx x s_a x s_b (x 4 corners).
+        a_slice = (slice(None), ys, xs)
+        b_slice = (slice(None), ys_b, xs_b)
+        cos_b = cos_theta[b_slice][..., None, :, None]
+        sin_b = sin_theta[b_slice][..., None, :, None]
+        rel_x = corner_x[a_slice][..., :, None, :] - center_x[b_slice][..., None, :, None]
+        rel_y = corner_y[a_slice][..., :, None, :] - center_y[b_slice][..., None, :, None]
+        u = rel_x * cos_b + rel_y * sin_b
+        v = rel_y * cos_b - rel_x * sin_b
+        inside = ((u.abs() <= inner[b_slice][..., None, :, 0:1])
+                  & (v.abs() <= inner[b_slice][..., None, :, 1:2])).all(-1)
+        # The clipped outer footprint of A must also lie in the patch of B, where B is drawn.
+        top_b = patch_y[:, ys_b]
+        left_b = patch_x[:, :, xs_b]
+        in_patch = ((box_top[a_slice] >= top_b) & (box_bottom[a_slice] <= top_b + patch_size_y)
+                    & (box_left[a_slice] >= left_b) & (box_right[a_slice] <= left_b + patch_size_x))
+        covers = inside & later & in_patch[..., :, None] & decision[b_slice][..., None, :]
+        hidden[a_slice] |= covers.any(-1)
+    return hidden & decision
@@ -4,18 +4,119 @@ import numpy as np
 from PIL import Image
 import inference.network as network
 import inference.morphology as morphology
+import inference.profiling as profiling
+import inference.planner as planner
+import inference.presets as presets
+import inference.brushes as brushes
+import inference.autotune as autotune
+import inference.analytic as analytic
+import inference.culling as culling
+import itertools
 import os
 import math
+import tempfile
+import threading
 
-idx = 0
+
+def tensor_to_array(img):
+    """
+    Convert a 3 x H x W tensor with values in [0, 1] to an H x W x 3 uint8 array.
+    """
+    return (img.data.cpu().float().numpy().transpose((1, 2, 0)) * 255).astype(np.uint8)
+
+
+def tensor_to_img(img):
+    return Image.fromarray(tensor_to_array(img))
+
+
+def atomic_save(image, output_path, **save_kwargs):
+    """
+    Save a PIL image so that readers of output_path never observe a partially written file.
+    The image is written to a temporary file in the same directory and then renamed over output_path.
+    """
+    directory = os.path.dirname(os.path.abspath(output_path))
+    suffix = os.path.splitext(output_path)[1]
+    image_format = save_kwargs.pop('format', None) or Image.registered_extensions().get(suffix.lower())
+    if image_format is None:
+        raise ValueError('unknown file extension: %s' % suffix)
+    fd, temp_path = tempfile.mkstemp(suffix=suffix, prefix='.tmp-', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, format=image_format, **save_kwargs)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
 
 
 def save_img(img, output_path):
-    result = Image.fromarray((img.data.cpu().numpy().transpose((1, 2, 0)) * 255).astype(np.uint8))
-    result.save(output_path)
+    result = tensor_to_img(img)
+    atomic_save(result, output_path)
+
+
+class PaintCancelled(Exception):
+    """
+    Raised inside a painting run whose PaintContext was cancelled.
+    """
+
+
+class PaintContext:
+    """
+    Job-scoped state of one painting run, so that concurrent runs never share anything mutable.
+    Args:
+        frame_dir: directory to save intermediate painting results. None means they are not saved to disk.
+        collect_frames: whether to keep intermediate painting results in memory as PIL images, in self.frames.
+        profiler: a profiling.Profiler that records the stages of this run. None means no profiling.
+        on_progress: a function called with a dict after every painting pass, see paint. It is called from the
+         painting thread.
+        cancel_event: a threading.Event that cancels the run when set, see cancel. None means a new event.
+    """
+
+    def __init__(self, frame_dir=None, collect_frames=False, profiler=None, on_progress=None, cancel_event=None):
+        self.frame_dir = frame_dir
+        self.frames = [] if collect_frames else None
+        self.frame_idx = 0
+        self.profiler = profiler
+        self.on_progress = on_progress
+        self.cancel_event = threading.Event() if cancel_event is None else cancel_event
+
+    @property
+    def need_frames(self):
+        return self.frame_dir is not None or self.frames is not None
 
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
 
-def param2stroke(param, H, W, meta_brushes):
+    def cancel(self):
+        """
+        Ask the run to stop. It can be called from any thread, and the run raises PaintCancelled at the next
+        painting pass or parity group.
+        """
+        self.cancel_event.set()
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise PaintCancelled('painting was cancelled')
+
+    def report(self, **event):
+        if self.on_progress is not None:
+            self.on_progress(event)
+
+    def add_frame(self, frame):
+        """
+        Record an intermediate painting result, a tensor with shape 1 x 3 x H x W.
+        """
+        self.frame_idx += 1
+        with profiling.stage('save_frame'):
+            if self.frame_dir is not None:
+                save_img(frame[0], os.path.join(self.frame_dir, '%03d.jpg' % self.frame_idx))
+            if self.frames is not None:
+                self.frames.append(tensor_to_img(frame[0]))
+
+
+def param2stroke(param, H, W, meta_brushes, dtype=None):
     """
     Input a set of stroke parameters and output its corresponding foregrounds and alpha maps.
     Args:
@@ -25,15 +126,24 @@ def param2stroke(param, H, W, meta_brushes):
         W: output width.
         meta_brushes: a tensor with shape 2 x 3 x meta_brush_height x meta_brush_width.
          The first slice on the batch dimension denotes vertical brush and the second one denotes horizontal brush.
+         The name of a shape of inference.analytic instead rasterizes strokes analytically, without brushes.
+        dtype: None, or a reduced precision floating point dtype for the low-precision render mode, in which
+         foregrounds are returned in dtype and alphas as a bool tensor with a single channel.
 
     Returns:
         foregrounds: a tensor with shape n_strokes x 3 x H x W, containing color information.
         alphas: a tensor with shape n_strokes x 3 x H x W,
          containing binary information of whether a pixel is belonging to the stroke (alpha mat), for painting process.
     """
+    if isinstance(meta_brushes, str):
+        return analytic.param2stroke(param, H, W, meta_brushes, dtype)
     # Firstly, resize the meta brushes to the required shape,
     # in order to decrease GPU memory especially when the required shape is small.
-    meta_brushes_resize = F.interpolate(meta_brushes, (H, W))
+    # Brushes from a BrushLibrary already have it.
+    if meta_brushes.shape[-2:] == (H, W):
+        meta_brushes_resize = meta_brushes
+    else:
+        meta_brushes_resize = F.interpolate(meta_brushes, (H, W))
     b = param.shape[0]
     # Extract shape parameters and color parameters.
     param_list = torch.split(param, 1, dim=1)
@@ -62,6 +172,15 @@ def param2stroke(param, H, W, meta_brushes):
     # Conduct warping.
     grid = F.affine_grid(warp, [b, 3, H, W], align_corners=False)
     brush = F.grid_sample(brush, grid, align_corners=False)
+    if dtype is not None:
+        # The three channels of alphas are equal, so a single one is eroded and kept, as a bool. Colours are not
+        # negative, so dilating the single channel brush before colouring it gives the same foreground, and both
+        # are done in dtype.
+        color_map = torch.cat([R, G, B], dim=1).unsqueeze(-1).unsqueeze(-1).to(dtype)
+        with profiling.stage('morphology'):
+            foreground = morphology.max_dilation(brush.to(dtype)) * color_map
+            alphas = morphology.erode_mask(brush > 0, dtype=dtype)
+        return foreground, alphas
     # alphas is the binary information suggesting whether a pixel is belonging to the stroke.
     alphas = (brush > 0).float()
     brush = brush.repeat(1, 3, 1, 1)
@@ -71,15 +190,185 @@ def param2stroke(param, H, W, meta_brushes):
     color_map = color_map.unsqueeze(-1).unsqueeze(-1).repeat(1, 1, H, W)
     foreground = brush * color_map
     # Dilation and erosion are used for foregrounds and alphas respectively to prevent artifacts on stroke borders.
-    foreground = morphology.dilation(foreground)
-    alphas = morphology.erosion(alphas)
+    with profiling.stage('morphology'):
+        foreground = morphology.dilation(foreground)
+        alphas = morphology.erosion(alphas)
     return foreground, alphas
 
 
+def parity_groups(h, w):
+    """
+    Patches overlap their neighbours by half a patch, so they are rendered in four groups of
+    non-overlapping patches: (even y, even x), (odd y, odd x), (odd y, even x) and (even y, odd x).
+    Args:
+        h: number of patches along height dimension.
+        w: number of patches along width dimension.
+
+    Returns:
+        A list of (offset_y, offset_x, n_y, n_x) in rendering order, for the non-empty groups. The patches of a group
+         are those with indices offset_y, offset_y + 2, ... and offset_x, offset_x + 2, ...
+    """
+    groups = []
+    for offset_y, offset_x in ((0, 0), (1, 1), (1, 0), (0, 1)):
+        n_y = (h - offset_y + 1) // 2
+        n_x = (w - offset_x + 1) // 2
+        if n_y > 0 and n_x > 0:
+            groups.append((offset_y, offset_x, n_y, n_x))
+    return groups
+
+
+def group_patches(canvas, offset_y, offset_x, n_y, n_x, patch_size_y, patch_size_x):
+    """
+    A strided view (no copy) of the patches of one parity group of a padded canvas.
+    Args:
+        canvas: a contiguous tensor with shape b x 3 x H x W, padded by patch_size // 4 on every side.
+        offset_y, offset_x, n_y, n_x: the parity group, see parity_groups.
+        patch_size_y, patch_size_x: size of a patch. Neighbouring patches are patch_size // 2 apart.
+
+    Returns:
+        A view with shape b x n_y x n_x x 3 x patch_size_y x patch_size_x. Writing to it writes to canvas.
+    """
+    b, c = canvas.shape[:2]
+    top = offset_y * (patch_size_y // 2)
+    left = offset_x * (patch_size_x // 2)
+    region = canvas[:, :, top:top + n_y * patch_size_y, left:left + n_x * patch_size_x]
+    return region.view(b, c, n_y, patch_size_y, n_x, patch_size_x).permute(0, 2, 4, 1, 3, 5)
+
+
+def composite_strokes(canvas_patches, foregrounds, alphas):
+    """
+    Composite strokes over canvas patches in place, in stroke order.
+    Repeating c = f_i * a_i + c * (1 - a_i) over the strokes is evaluated in closed form as
+    c * prod_i (1 - a_i) + sum_i f_i * a_i * prod_{j > i} (1 - a_j), with a cumulative product over the stroke
+    dimension. As alphas are binary, at most one term of the sum is non-zero, so the result is exactly that of the loop.
+    The anti-aliased alphas of analytic strokes are blended in the same way, equal to the loop up to rounding.
+    Args:
+        canvas_patches: a tensor with shape ... x 3 x py x px, usually a view of a canvas.
+        foregrounds: a tensor with shape ... x n_strokes x 3 x py x px.
+        alphas: a tensor with the same shape as foregrounds, zero for strokes that are not drawn.
+    """
+    # transmittance[..., i, :, :, :] = prod_{j >= i} (1 - a_j)
+    transmittance = torch.flip(torch.cumprod(torch.flip(1 - alphas, [-4]), dim=-4), [-4])
+    contribution = foregrounds * alphas
+    strokes = contribution[..., -1, :, :, :] + (
+            contribution[..., :-1, :, :, :] * transmittance[..., 1:, :, :, :]).sum(-4)
+    del contribution
+    canvas_patches.mul_(transmittance[..., 0, :, :, :])
+    del transmittance
+    canvas_patches.add_(strokes)
+
+
+def composite_masked_strokes(canvas_patches, foregrounds, alphas):
+    """
+    Composite strokes with bool alphas over canvas patches in place, in stroke order.
+    With binary alphas, every pixel ends up with the foreground of the last stroke covering it, or keeps its canvas
+    value if there is none, so the result is selected rather than blended and no arithmetic is done in the
+    reduced precision of the canvas.
+    Args:
+        canvas_patches: a tensor with shape ... x 3 x py x px, usually a view of a canvas.
+        foregrounds: a tensor with shape ... x n_strokes x 3 x py x px, in the dtype of the canvas.
+        alphas: a bool tensor with shape ... x n_strokes x 1 x py x px, False for strokes that are not drawn.
+    """
+    s = alphas.shape[-4]
+    covered = alphas.any(dim=-4)
+    # argmax returns the first maximum, so on flipped strokes it finds the last stroke covering a pixel.
+    last = s - 1 - torch.flip(alphas, [-4]).to(torch.uint8).argmax(dim=-4, keepdim=True)
+    last = last.expand(*last.shape[:-3], foregrounds.shape[-3], *last.shape[-2:])
+    top = torch.gather(foregrounds, -4, last).squeeze(-4)
+    canvas_patches.copy_(torch.where(covered, top, canvas_patches))
+
+
+def active_columns(decision):
+    """
+    The patch columns from the first to the last one with an active stroke, as a slice, or None without any.
+    Args:
+        decision: a bool tensor with shape b x n_y x n_x x n_stroke_per_patch.
+    """
+    columns = decision.any(-1).any(1).any(0).nonzero()
+    if columns.numel() == 0:
+        return None
+    return slice(columns[0].item(), columns[-1].item() + 1)
+
+
+def render_group(canvas_patches, param, decision, meta_brushes, max_render_bytes=planner.DEFAULT_RENDER_BYTES):
+    """
+    Rasterize the strokes of one parity group and composite them onto its canvas patches in place.
+    Args:
+        canvas_patches: a view with shape b x n_y x n_x x 3 x py x px, as returned by group_patches. Its dtype
+         selects the render mode: float32, or the low-precision mode for float16 and bfloat16.
+        param: a tensor with shape b x n_y x n_x x n_stroke_per_patch x n_param_per_stroke.
+        decision: a bool tensor with shape b x n_y x n_x x n_stroke_per_patch.
+        meta_brushes: a tensor with shape 2 x 3 x meta_brush_height x meta_brush_width.
+        max_render_bytes: memory budget for rasterized strokes. Strokes are rendered in chunks of patch rows
+         (and of stroke indices, if a single row does not fit, and of patch columns, if a single stroke index of
+         a row does not fit) that are composited and freed before the next chunk is rasterized, down to a single
+         stroke, as planner.render_bytes assumes. None means all strokes of the group are rendered at once.
+
+    Only the columns between the first and last patch with an active stroke are rendered, in the group and in
+    every chunk, so a small painted region of a large image costs its own width rather than the image width.
+    Patches left out by a mask have no active strokes, see predict_strokes.
+    """
+    columns = active_columns(decision)
+    if columns is None:
+        return
+    param, decision, canvas_patches = param[:, :, columns], decision[:, :, columns], canvas_patches[:, :, columns]
+    b, n_y, n_x, s, p = param.shape
+    patch_size_y, patch_size_x = canvas_patches.shape[-2:]
+    # A float32 canvas is painted exactly as it always was. A reduced precision canvas selects the low-precision
+    # render mode: foregrounds in the dtype of the canvas and single channel bool alphas.
+    if canvas_patches.dtype == torch.float32:
+        stroke_dtype, alpha_dtype, alpha_channels = None, torch.float32, 3
+    else:
+        stroke_dtype, alpha_dtype, alpha_channels = canvas_patches.dtype, torch.bool, 1
+    # Patches of one parity group never overlap, and chunks of the same patches are composited in stroke order,
+    # so the result does not depend on the chunking.
+    if max_render_bytes is None:
+        rows_per_chunk, columns_per_chunk, strokes_per_chunk = n_y, n_x, s
+    else:
+        stroke_bytes = planner.stroke_bytes(patch_size_y, patch_size_x)
+        rows_per_chunk = max(1, min(n_y, max_render_bytes // max(b * n_x * s * stroke_bytes, 1)))
+        columns_per_chunk, strokes_per_chunk = n_x, s
+        if rows_per_chunk == 1:
+            strokes_per_chunk = max(1, min(s, max_render_bytes // max(b * n_x * stroke_bytes, 1)))
+        if strokes_per_chunk == 1:
+            columns_per_chunk = max(1, min(n_x, max_render_bytes // max(b * stroke_bytes, 1)))
+    for row, column, first_stroke in itertools.product(range(0, n_y, rows_per_chunk),
+                                                        range(0, n_x, columns_per_chunk),
+                                                        range(0, s, strokes_per_chunk)):
+        rows = slice(row, row + rows_per_chunk)
+        strokes = slice(first_stroke, first_stroke + strokes_per_chunk)
+        columns = active_columns(decision[:, rows, column:column + columns_per_chunk, strokes])
+        if columns is None:
+            continue
+        columns = slice(column + columns.start, column + columns.stop)
+        chunk_decision = decision[:, rows, columns, strokes]
+        chunk_shape = chunk_decision.shape
+        n = chunk_decision.numel()
+        chunk_param = param[:, rows, columns, strokes].reshape(n, p)
+        chunk_decision = chunk_decision.reshape(n)
+        foregrounds = torch.zeros(n, 3, patch_size_y, patch_size_x, device=canvas_patches.device,
+                                  dtype=canvas_patches.dtype)
+        alphas = torch.zeros(n, alpha_channels, patch_size_y, patch_size_x, device=canvas_patches.device,
+                             dtype=alpha_dtype)
+        with profiling.stage('param2stroke'):
+            foregrounds[chunk_decision, :, :, :], alphas[chunk_decision, :, :, :] = \
+                param2stroke(chunk_param[chunk_decision, :], patch_size_y, patch_size_x, meta_brushes,
+                             stroke_dtype)
+        # foreground, alpha: b, rows, n_x, strokes, 3, py, px
+        foregrounds = foregrounds.view(*chunk_shape, 3, patch_size_y, patch_size_x)
+        alphas = alphas.view(*chunk_shape, alpha_channels, patch_size_y, patch_size_x)
+        with profiling.stage('composite'):
+            if stroke_dtype is None:
+                composite_strokes(canvas_patches[:, rows, columns], foregrounds, alphas)
+            else:
+                composite_masked_strokes(canvas_patches[:, rows, columns], foregrounds, alphas)
+        del foregrounds, alphas
+
+
 def param2img_serial(
-        param, decision, meta_brushes, cur_canvas, frame_dir, has_border=False, original_h=None, original_w=None):
+        param, decision, meta_brushes, cur_canvas, ctx, has_border=False, original_h=None, original_w=None):
     """
-    Input stroke parameters and decisions for each patch, meta brushes, current canvas, frame directory,
+    Input stroke parameters and decisions for each patch, meta brushes, current canvas, painting context,
     and whether there is a border (if intermediate painting results are required).
     Output the painting results of adding the corresponding strokes on the current canvas.
     Args:
@@ -91,7 +380,8 @@ def param2img_serial(
         The first slice on the batch dimension denotes vertical brush and the second one denotes horizontal brush.
         cur_canvas: a tensor with shape batch size x 3 x H x W,
          where H and W denote height and width of padded results of original images.
-        frame_dir: directory to save intermediate painting results. None means intermediate results are not required.
+        ctx: the PaintContext of this painting run, which receives intermediate painting results.
+         None means intermediate results are not required.
         has_border: on the last painting layer, in order to make sure that the painting results do not miss
          any important detail, we choose to paint again on this layer but shift patch_size // 2 pixels when
          cutting patches. In this case, if intermediate results are required, we need to cut the shifted length
@@ -105,125 +395,42 @@ def param2img_serial(
     # param: b, h, w, stroke_per_patch, param_per_stroke
     # decision: b, h, w, stroke_per_patch
     b, h, w, s, p = param.shape
+    decision = decision.bool()
     H, W = cur_canvas.shape[-2:]
-    is_odd_y = h % 2 == 1
-    is_odd_x = w % 2 == 1
     patch_size_y = 2 * H // h
     patch_size_x = 2 * W // w
-    even_idx_y = torch.arange(0, h, 2, device=cur_canvas.device)
-    even_idx_x = torch.arange(0, w, 2, device=cur_canvas.device)
-    odd_idx_y = torch.arange(1, h, 2, device=cur_canvas.device)
-    odd_idx_x = torch.arange(1, w, 2, device=cur_canvas.device)
-    even_y_even_x_coord_y, even_y_even_x_coord_x = torch.meshgrid([even_idx_y, even_idx_x])
-    odd_y_odd_x_coord_y, odd_y_odd_x_coord_x = torch.meshgrid([odd_idx_y, odd_idx_x])
-    even_y_odd_x_coord_y, even_y_odd_x_coord_x = torch.meshgrid([even_idx_y, odd_idx_x])
-    odd_y_even_x_coord_y, odd_y_even_x_coord_x = torch.meshgrid([odd_idx_y, even_idx_x])
+    # Strokes are composited in place into this padded canvas, through strided views of its patches.
     cur_canvas = F.pad(cur_canvas, [patch_size_x // 4, patch_size_x // 4,
                                     patch_size_y // 4, patch_size_y // 4, 0, 0, 0, 0])
 
-    def partial_render(this_canvas, patch_coord_y, patch_coord_x, stroke_id):
-        canvas_patch = F.unfold(this_canvas, (patch_size_y, patch_size_x),
-                                stride=(patch_size_y // 2, patch_size_x // 2))
-        # canvas_patch: b, 3 * py * px, h * w
-        canvas_patch = canvas_patch.view(b, 3, patch_size_y, patch_size_x, h, w).contiguous()
-        canvas_patch = canvas_patch.permute(0, 4, 5, 1, 2, 3).contiguous()
-        # canvas_patch: b, h, w, 3, py, px
-        selected_canvas_patch = canvas_patch[:, patch_coord_y, patch_coord_x, :, :, :]
-        selected_h, selected_w = selected_canvas_patch.shape[1:3]
-        selected_param = param[:, patch_coord_y, patch_coord_x, stroke_id, :].view(-1, p).contiguous()
-        selected_decision = decision[:, patch_coord_y, patch_coord_x, stroke_id].view(-1).contiguous()
-        selected_foregrounds = torch.zeros(selected_param.shape[0], 3, patch_size_y, patch_size_x,
-                                           device=this_canvas.device)
-        selected_alphas = torch.zeros(selected_param.shape[0], 3, patch_size_y, patch_size_x, device=this_canvas.device)
-        if selected_param[selected_decision, :].shape[0] > 0:
-            selected_foregrounds[selected_decision, :, :, :], selected_alphas[selected_decision, :, :, :] = \
-                param2stroke(selected_param[selected_decision, :], patch_size_y, patch_size_x, meta_brushes)
-        selected_foregrounds = selected_foregrounds.view(
-            b, selected_h, selected_w, 3, patch_size_y, patch_size_x).contiguous()
-        selected_alphas = selected_alphas.view(b, selected_h, selected_w, 3, patch_size_y, patch_size_x).contiguous()
-        selected_decision = selected_decision.view(b, selected_h, selected_w, 1, 1, 1).contiguous()
-        selected_canvas_patch = selected_foregrounds * selected_alphas * selected_decision + selected_canvas_patch * (
-                1 - selected_alphas * selected_decision)
-        this_canvas = selected_canvas_patch.permute(0, 3, 1, 4, 2, 5).contiguous()
-        # this_canvas: b, 3, selected_h, py, selected_w, px
-        this_canvas = this_canvas.view(b, 3, selected_h * patch_size_y, selected_w * patch_size_x).contiguous()
-        # this_canvas: b, 3, selected_h * py, selected_w * px
-        return this_canvas
-
-    global idx
+    need_frames = ctx is not None and ctx.need_frames
     if has_border:
         factor = 2
     else:
         factor = 4
-    if even_idx_y.shape[0] > 0 and even_idx_x.shape[0] > 0:
-        for i in range(s):
-            canvas = partial_render(cur_canvas, even_y_even_x_coord_y, even_y_even_x_coord_x, i)
-            if not is_odd_y:
-                canvas = torch.cat([canvas, cur_canvas[:, :, -patch_size_y // 2:, :canvas.shape[3]]], dim=2)
-            if not is_odd_x:
-                canvas = torch.cat([canvas, cur_canvas[:, :, :canvas.shape[2], -patch_size_x // 2:]], dim=3)
-            cur_canvas = canvas
-            idx += 1
-            if frame_dir is not None:
-                frame = crop(cur_canvas[:, :, patch_size_y // factor:-patch_size_y // factor,
-                             patch_size_x // factor:-patch_size_x // factor], original_h, original_w)
-                save_img(frame[0], os.path.join(frame_dir, '%03d.jpg' % idx))
-
-    if odd_idx_y.shape[0] > 0 and odd_idx_x.shape[0] > 0:
+    for offset_y, offset_x, n_y, n_x in parity_groups(h, w):
+        if ctx is not None:
+            ctx.check_cancelled()
+        canvas_patches = group_patches(cur_canvas, offset_y, offset_x, n_y, n_x, patch_size_y, patch_size_x)
+        group_param = param[:, offset_y::2, offset_x::2]
+        group_decision = decision[:, offset_y::2, offset_x::2]
         for i in range(s):
-            canvas = partial_render(cur_canvas, odd_y_odd_x_coord_y, odd_y_odd_x_coord_x, i)
-            canvas = torch.cat([cur_canvas[:, :, :patch_size_y // 2, -canvas.shape[3]:], canvas], dim=2)
-            canvas = torch.cat([cur_canvas[:, :, -canvas.shape[2]:, :patch_size_x // 2], canvas], dim=3)
-            if is_odd_y:
-                canvas = torch.cat([canvas, cur_canvas[:, :, -patch_size_y // 2:, :canvas.shape[3]]], dim=2)
-            if is_odd_x:
-                canvas = torch.cat([canvas, cur_canvas[:, :, :canvas.shape[2], -patch_size_x // 2:]], dim=3)
-            cur_canvas = canvas
-            idx += 1
-            if frame_dir is not None:
+            render_group(canvas_patches, group_param[:, :, :, i:i + 1], group_decision[:, :, :, i:i + 1],
+                         meta_brushes)
+            if need_frames:
                 frame = crop(cur_canvas[:, :, patch_size_y // factor:-patch_size_y // factor,
                              patch_size_x // factor:-patch_size_x // factor], original_h, original_w)
-                save_img(frame[0], os.path.join(frame_dir, '%03d.jpg' % idx))
-
-    if odd_idx_y.shape[0] > 0 and even_idx_x.shape[0] > 0:
-        for i in range(s):
-            canvas = partial_render(cur_canvas, odd_y_even_x_coord_y, odd_y_even_x_coord_x, i)
-            canvas = torch.cat([cur_canvas[:, :, :patch_size_y // 2, :canvas.shape[3]], canvas], dim=2)
-            if is_odd_y:
-                canvas = torch.cat([canvas, cur_canvas[:, :, -patch_size_y // 2:, :canvas.shape[3]]], dim=2)
-            if not is_odd_x:
-                canvas = torch.cat([canvas, cur_canvas[:, :, :canvas.shape[2], -patch_size_x // 2:]], dim=3)
-            cur_canvas = canvas
-            idx += 1
-            if frame_dir is not None:
-                frame = crop(cur_canvas[:, :, patch_size_y // factor:-patch_size_y // factor,
-                             patch_size_x // factor:-patch_size_x // factor], original_h, original_w)
-                save_img(frame[0], os.path.join(frame_dir, '%03d.jpg' % idx))
-
-    if even_idx_y.shape[0] > 0 and odd_idx_x.shape[0] > 0:
-        for i in range(s):
-            canvas = partial_render(cur_canvas, even_y_odd_x_coord_y, even_y_odd_x_coord_x, i)
-            canvas = torch.cat([cur_canvas[:, :, :canvas.shape[2], :patch_size_x // 2], canvas], dim=3)
-            if not is_odd_y:
-                canvas = torch.cat([canvas, cur_canvas[:, :, -patch_size_y // 2:, -canvas.shape[3]:]], dim=2)
-            if is_odd_x:
-                canvas = torch.cat([canvas, cur_canvas[:, :, :canvas.shape[2], -patch_size_x // 2:]], dim=3)
-            cur_canvas = canvas
-            idx += 1
-            if frame_dir is not None:
-                frame = crop(cur_canvas[:, :, patch_size_y // factor:-patch_size_y // factor,
-                             patch_size_x // factor:-patch_size_x // factor], original_h, original_w)
-                save_img(frame[0], os.path.join(frame_dir, '%03d.jpg' % idx))
+                ctx.add_frame(frame)
 
     cur_canvas = cur_canvas[:, :, patch_size_y // 4:-patch_size_y // 4, patch_size_x // 4:-patch_size_x // 4]
 
     return cur_canvas
 
 
-def param2img_parallel(param, decision, meta_brushes, cur_canvas):
+def param2img_parallel(param, decision, meta_brushes, cur_canvas, max_render_bytes=planner.DEFAULT_RENDER_BYTES,
+                       ctx=None, cull=True):
     """
-        Input stroke parameters and decisions for each patch, meta brushes, current canvas, frame directory,
-        and whether there is a border (if intermediate painting results are required).
+        Input stroke parameters and decisions for each patch, meta brushes and current canvas.
         Output the painting results of adding the corresponding strokes on the current canvas.
         Args:
             param: a tensor with shape batch size x patch along height dimension x patch along width dimension
@@ -234,6 +441,12 @@ def param2img_parallel(param, decision, meta_brushes, cur_canvas):
             The first slice on the batch dimension denotes vertical brush and the second one denotes horizontal brush.
             cur_canvas: a tensor with shape batch size x 3 x H x W,
              where H and W denote height and width of padded results of original images.
+            max_render_bytes: memory budget for rasterized strokes, see render_group, and for culling, see
+             culling.hidden_strokes. None means all strokes of a parity group are rendered at once.
+            ctx: the PaintContext of this painting run, checked for cancellation before every parity group.
+             None means the call cannot be cancelled.
+            cull: whether to drop strokes that later strokes fully cover before rasterizing them, see
+             inference.culling. The result is the same either way.
 
         Returns:
             cur_canvas: a tensor with shape batch size x 3 x H x W, denoting painting results.
@@ -241,97 +454,25 @@ def param2img_parallel(param, decision, meta_brushes, cur_canvas):
     # param: b, h, w, stroke_per_patch, param_per_stroke
     # decision: b, h, w, stroke_per_patch
     b, h, w, s, p = param.shape
-    param = param.view(-1, 8).contiguous()
-    decision = decision.view(-1).contiguous().bool()
+    decision = decision.bool()
     H, W = cur_canvas.shape[-2:]
-    is_odd_y = h % 2 == 1
-    is_odd_x = w % 2 == 1
     patch_size_y = 2 * H // h
     patch_size_x = 2 * W // w
-    even_idx_y = torch.arange(0, h, 2, device=cur_canvas.device)
-    even_idx_x = torch.arange(0, w, 2, device=cur_canvas.device)
-    odd_idx_y = torch.arange(1, h, 2, device=cur_canvas.device)
-    odd_idx_x = torch.arange(1, w, 2, device=cur_canvas.device)
-    even_y_even_x_coord_y, even_y_even_x_coord_x = torch.meshgrid([even_idx_y, even_idx_x])
-    odd_y_odd_x_coord_y, odd_y_odd_x_coord_x = torch.meshgrid([odd_idx_y, odd_idx_x])
-    even_y_odd_x_coord_y, even_y_odd_x_coord_x = torch.meshgrid([even_idx_y, odd_idx_x])
-    odd_y_even_x_coord_y, odd_y_even_x_coord_x = torch.meshgrid([odd_idx_y, even_idx_x])
+    # Strokes are composited in place into this padded canvas, through strided views of its patches.
     cur_canvas = F.pad(cur_canvas, [patch_size_x // 4, patch_size_x // 4,
                                     patch_size_y // 4, patch_size_y // 4, 0, 0, 0, 0])
-    foregrounds = torch.zeros(param.shape[0], 3, patch_size_y, patch_size_x, device=cur_canvas.device)
-    alphas = torch.zeros(param.shape[0], 3, patch_size_y, patch_size_x, device=cur_canvas.device)
-    valid_foregrounds, valid_alphas = param2stroke(param[decision, :], patch_size_y, patch_size_x, meta_brushes)
-    foregrounds[decision, :, :, :] = valid_foregrounds
-    alphas[decision, :, :, :] = valid_alphas
-    # foreground, alpha: b * h * w * stroke_per_patch, 3, patch_size_y, patch_size_x
-    foregrounds = foregrounds.view(-1, h, w, s, 3, patch_size_y, patch_size_x).contiguous()
-    alphas = alphas.view(-1, h, w, s, 3, patch_size_y, patch_size_x).contiguous()
-    # foreground, alpha: b, h, w, stroke_per_patch, 3, render_size_y, render_size_x
-    decision = decision.view(-1, h, w, s, 1, 1, 1).contiguous()
-
-    # decision: b, h, w, stroke_per_patch, 1, 1, 1
-
-    def partial_render(this_canvas, patch_coord_y, patch_coord_x):
-
-        canvas_patch = F.unfold(this_canvas, (patch_size_y, patch_size_x),
-                                stride=(patch_size_y // 2, patch_size_x // 2))
-        # canvas_patch: b, 3 * py * px, h * w
-        canvas_patch = canvas_patch.view(b, 3, patch_size_y, patch_size_x, h, w).contiguous()
-        canvas_patch = canvas_patch.permute(0, 4, 5, 1, 2, 3).contiguous()
-        # canvas_patch: b, h, w, 3, py, px
-        selected_canvas_patch = canvas_patch[:, patch_coord_y, patch_coord_x, :, :, :]
-        selected_foregrounds = foregrounds[:, patch_coord_y, patch_coord_x, :, :, :, :]
-        selected_alphas = alphas[:, patch_coord_y, patch_coord_x, :, :, :, :]
-        selected_decisions = decision[:, patch_coord_y, patch_coord_x, :, :, :, :]
-        for i in range(s):
-            cur_foreground = selected_foregrounds[:, :, :, i, :, :, :]
-            cur_alpha = selected_alphas[:, :, :, i, :, :, :]
-            cur_decision = selected_decisions[:, :, :, i, :, :, :]
-            selected_canvas_patch = cur_foreground * cur_alpha * cur_decision + selected_canvas_patch * (
-                    1 - cur_alpha * cur_decision)
-        this_canvas = selected_canvas_patch.permute(0, 3, 1, 4, 2, 5).contiguous()
-        # this_canvas: b, 3, h_half, py, w_half, px
-        h_half = this_canvas.shape[2]
-        w_half = this_canvas.shape[4]
-        this_canvas = this_canvas.view(b, 3, h_half * patch_size_y, w_half * patch_size_x).contiguous()
-        # this_canvas: b, 3, h_half * py, w_half * px
-        return this_canvas
-
-    if even_idx_y.shape[0] > 0 and even_idx_x.shape[0] > 0:
-        canvas = partial_render(cur_canvas, even_y_even_x_coord_y, even_y_even_x_coord_x)
-        if not is_odd_y:
-            canvas = torch.cat([canvas, cur_canvas[:, :, -patch_size_y // 2:, :canvas.shape[3]]], dim=2)
-        if not is_odd_x:
-            canvas = torch.cat([canvas, cur_canvas[:, :, :canvas.shape[2], -patch_size_x // 2:]], dim=3)
-        cur_canvas = canvas
-
-    if odd_idx_y.shape[0] > 0 and odd_idx_x.shape[0] > 0:
-        canvas = partial_render(cur_canvas, odd_y_odd_x_coord_y, odd_y_odd_x_coord_x)
-        canvas = torch.cat([cur_canvas[:, :, :patch_size_y // 2, -canvas.shape[3]:], canvas], dim=2)
-        canvas = torch.cat([cur_canvas[:, :, -canvas.shape[2]:, :patch_size_x // 2], canvas], dim=3)
-        if is_odd_y:
-            canvas = torch.cat([canvas, cur_canvas[:, :, -patch_size_y // 2:, :canvas.shape[3]]], dim=2)
-        if is_odd_x:
-            canvas = torch.cat([canvas, cur_canvas[:, :, :canvas.shape[2], -patch_size_x // 2:]], dim=3)
-        cur_canvas = canvas
-
-    if odd_idx_y.shape[0] > 0 and even_idx_x.shape[0] > 0:
-        canvas = partial_render(cur_canvas, odd_y_even_x_coord_y, odd_y_even_x_coord_x)
-        canvas = torch.cat([cur_canvas[:, :, :patch_size_y // 2, :canvas.shape[3]], canvas], dim=2)
-        if is_odd_y:
-            canvas = torch.cat([canvas, cur_canvas[:, :, -patch_size_y // 2:, :canvas.shape[3]]], dim=2)
-        if not is_odd_x:
-            canvas = torch.cat([canvas, cur_canvas[:, :, :canvas.shape[2], -patch_size_x // 2:]], dim=3)
-        cur_canvas = canvas
-
-    if even_idx_y.shape[0] > 0 and odd_idx_x.shape[0] > 0:
-        canvas = partial_render(cur_canvas, even_y_odd_x_coord_y, even_y_odd_x_coord_x)
-        canvas = torch.cat([cur_canvas[:, :, :canvas.shape[2], :patch_size_x // 2], canvas], dim=3)
-        if not is_odd_y:
-            canvas = torch.cat([canvas, cur_canvas[:, :, -patch_size_y // 2:, -canvas.shape[3]:]], dim=2)
-        if is_odd_x:
-            canvas = torch.cat([canvas, cur_canvas[:, :, :canvas.shape[2], -patch_size_x // 2:]], dim=3)
-        cur_canvas = canvas
+    if cull and decision.any():
+        with profiling.stage('culling'):
+            hidden = culling.hidden_strokes(param, decision, meta_brushes, patch_size_y, patch_size_x,
+                                            max_render_bytes)
+            decision = decision & ~hidden
+        profiling.count('culled_strokes', hidden)
+    for offset_y, offset_x, n_y, n_x in parity_groups(h, w):
+        if ctx is not None:
+            ctx.check_cancelled()
+        canvas_patches = group_patches(cur_canvas, offset_y, offset_x, n_y, n_x, patch_size_y, patch_size_x)
+        render_group(canvas_patches, param[:, offset_y::2, offset_x::2], decision[:, offset_y::2, offset_x::2],
+                     meta_brushes, max_render_bytes)
 
     cur_canvas = cur_canvas[:, :, patch_size_y // 4:-patch_size_y // 4, patch_size_x // 4:-patch_size_x // 4]
 
@@ -350,6 +491,33 @@ def read_img(img_path, img_type='RGB', h=None, w=None):
     return img
 
 
+def img_to_tensor(img, device=None):
+    """
+    Convert an in-memory image to a 1 x 3 x H x W float tensor with values in [0, 1].
+    Args:
+        img: a PIL image, or a numpy array with shape H x W or H x W x C. uint8 arrays are scaled by 1 / 255,
+         floating point arrays are expected to already be in [0, 1]. An alpha channel is dropped.
+        device: device of the returned tensor. None means cpu.
+
+    Returns:
+        img: a tensor with shape 1 x 3 x H x W.
+    """
+    if isinstance(img, Image.Image):
+        img = np.array(img.convert('RGB'))
+    if img.ndim == 2:
+        img = img[:, :, None]
+    if img.shape[2] == 1:
+        img = np.repeat(img, 3, axis=2)
+    img = img[:, :, :3]
+    src = torch.from_numpy(np.ascontiguousarray(img)).permute(2, 0, 1).unsqueeze(0)
+    # A single copy converts both the layout (HWC -> CHW) and the dtype.
+    result = torch.empty(src.shape, dtype=torch.float32, device=device)
+    result.copy_(src)
+    if src.dtype == torch.uint8:
+        result.div_(255.)
+    return result
+
+
 def pad(img, H, W):
     b, c, h, w = img.shape
     pad_h = (H - h) // 2
@@ -373,117 +541,333 @@ def crop(img, h, w):
     return img
 
 
-def main(input_path, model_path, output_dir, need_animation=False, resize_h=None, resize_w=None, serial=False):
-    if not os.path.exists(output_dir):
-        os.mkdir(output_dir)
-    input_name = os.path.basename(input_path)
-    output_path = os.path.join(output_dir, input_name)
-    frame_dir = None
-    if need_animation:
-        if not serial:
-            print('It must be under serial mode if animation results are required, so serial flag is set to True!')
-            serial = True
-        frame_dir = os.path.join(output_dir, input_name[:input_name.find('.')])
-        if not os.path.exists(frame_dir):
-            os.mkdir(frame_dir)
-    patch_size = 32
-    stroke_num = 8
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    net_g = network.Painter(5, stroke_num, 256, 8, 3, 3).to(device)
-    net_g.load_state_dict(torch.load(model_path, weights_only=True))
+def load_painter(model_path, device=None, stroke_num=8, mmap=True):
+    """
+    Build the Paint Transformer network and load its weights from model_path, ready for inference.
+
+    The network is built on the meta device, which skips initializing weights that are overwritten anyway, and
+    with mmap the checkpoint is memory-mapped instead of read and deserialized up front. On cpu the weights are
+    used in place, so loading costs little more than opening the file.
+    """
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    with torch.device('meta'):
+        net_g = network.Painter(5, stroke_num, 256, 8, 3, 3)
+    try:
+        state_dict = torch.load(model_path, map_location='cpu', weights_only=True, mmap=mmap)
+    except RuntimeError:
+        if not mmap:
+            raise
+        # Checkpoints in the legacy (pre zip) format cannot be memory-mapped.
+        state_dict = torch.load(model_path, map_location='cpu', weights_only=True)
+    net_g.load_state_dict(state_dict, assign=True)
+    net_g = net_g.to(device)
     net_g.eval()
     for param in net_g.parameters():
         param.requires_grad = False
+    return net_g
 
-    brush_large_vertical = read_img('inference/brush/brush_large_vertical.png', 'L').to(device)
-    brush_large_horizontal = read_img('inference/brush/brush_large_horizontal.png', 'L').to(device)
-    meta_brushes = torch.cat(
-        [brush_large_vertical, brush_large_horizontal], dim=0)
 
-    with torch.no_grad():
-        original_img = read_img(input_path, 'RGB', resize_h, resize_w).to(device)
-        original_h, original_w = original_img.shape[-2:]
-        K = max(math.ceil(math.log2(max(original_h, original_w) / patch_size)), 0)
-        original_img_pad_size = patch_size * (2 ** K)
-        original_img_pad = pad(original_img, original_img_pad_size, original_img_pad_size)
-        final_result = torch.zeros_like(original_img_pad).to(device)
-        for layer in range(0, K + 1):
-            layer_size = patch_size * (2 ** layer)
-            img = F.interpolate(original_img_pad, (layer_size, layer_size))
-            result = F.interpolate(final_result, (patch_size * (2 ** layer), patch_size * (2 ** layer)))
-            img_patch = F.unfold(img, (patch_size, patch_size), stride=(patch_size, patch_size))
-            result_patch = F.unfold(result, (patch_size, patch_size),
-                                    stride=(patch_size, patch_size))
-            # There are patch_num * patch_num patches in total
-            patch_num = (layer_size - patch_size) // patch_size + 1
-
-            # img_patch, result_patch: b, 3 * output_size * output_size, h * w
-            img_patch = img_patch.permute(0, 2, 1).contiguous().view(-1, 3, patch_size, patch_size).contiguous()
-            result_patch = result_patch.permute(0, 2, 1).contiguous().view(
-                -1, 3, patch_size, patch_size).contiguous()
+def load_meta_brushes(device=None, name=brushes.DEFAULT_SET):
+    """
+    The full resolution brushes of a brush set, see brushes.BrushLibrary.meta_brushes.
+    """
+    return brushes.load_library(device).meta_brushes(name)
+
+
+def load_brushes(device=None):
+    """
+    The brush library of a device, with every brush set. It can be passed to paint instead of meta brushes.
+    """
+    return brushes.load_library(device)
+
+
+def layer_brushes(meta_brushes, schedule, layer, render_size, brush_mode='texture'):
+    """
+    Brushes of one painting pass.
+    Args:
+        meta_brushes: a brushes.BrushLibrary, or a tensor with shape 2 x 1 x meta_brush_height x meta_brush_width.
+        schedule: the brush set of every layer, see brushes.brush_set. Ignored for a tensor.
+        layer: the layer of the pass, an int or 'border'.
+        render_size: the size strokes of the pass are rendered at.
+        brush_mode: 'texture' for brushes, or one of analytic.SHAPES for analytic strokes.
+
+    Returns:
+        meta_brushes: a tensor with shape 2 x 1 x H x W, resized to render_size when taken from a library, or the
+         name of the analytic shape, which param2stroke rasterizes without brushes.
+    """
+    if brush_mode != 'texture':
+        return brush_mode
+    if isinstance(meta_brushes, brushes.BrushLibrary):
+        return meta_brushes.brushes(brushes.brush_set(schedule, layer, render_size), render_size)
+    return meta_brushes
+
+
+def active_patches(mask, patch_num, border=False):
+    """
+    Find the patches of a painting pass whose rendering area intersects a mask.
+    Args:
+        mask: a tensor with shape 1 x 1 x H x W, the mask padded like the canvas. Nonzero pixels are masked.
+        patch_num: number of patches along each dimension of the layer.
+        border: whether this is the shifted border pass, which has patch_num + 1 patches along each dimension,
+         shifted by half a patch.
+
+    Returns:
+        active: a bool tensor with shape h x w, the patches whose strokes can reach the mask.
+    """
+    # Strokes of a patch are rendered into its cell plus half a cell on every side, so work on a grid of
+    # half cells: a patch covers 2 x 2 of them and its rendering area 4 x 4.
+    cells = F.adaptive_max_pool2d((mask != 0).float(), 2 * patch_num)
+    if border:
+        cells = F.pad(cells, [1, 1, 1, 1])
+    return F.max_pool2d(cells, 4, stride=2, padding=1)[0, 0].bool()
+
+
+def predict_strokes(net_g, img_patch, result_patch, h, w, active=None, batch_size=None):
+    """
+    Predict the strokes of every patch and sample their colors from the original image.
+    Args:
+        net_g: a Painter network.
+        img_patch: a tensor with shape h * w x 3 x patch_size x patch_size, cut from the original image.
+        result_patch: a tensor with the same shape, cut from the current painting result.
+        h: number of patches along height dimension.
+        w: number of patches along width dimension.
+        active: a bool tensor with shape h x w. Only active patches are run through net_g, the others get no
+         active strokes. None means every patch is active.
+        batch_size: number of patches run through net_g at once. None means every patch in one forward pass.
+
+    Returns:
+        param: a tensor with shape 1 x h x w x n_stroke_per_patch x n_param_per_stroke,
+         with positions and sizes already mapped to the rendering area of each patch.
+        decision_logits: a tensor with shape 1 x h x w x n_stroke_per_patch.
+    """
+    patch_size = img_patch.shape[-1]
+    stroke_num = net_g.query_pos.shape[0]
+    if active is not None:
+        index = active.flatten().nonzero().squeeze(1)
+        if index.numel() == 0:
+            return (img_patch.new_zeros(1, h, w, stroke_num, 8), img_patch.new_zeros(1, h, w, stroke_num))
+        img_patch = img_patch[index]
+        result_patch = result_patch[index]
+    with profiling.stage('net_g'):
+        if batch_size is None or batch_size >= img_patch.shape[0]:
             shape_param, stroke_decision = net_g(img_patch, result_patch)
-            stroke_decision = network.SignWithSigmoidGrad.apply(stroke_decision)
-
-            grid = shape_param[:, :, :2].view(img_patch.shape[0] * stroke_num, 1, 1, 2).contiguous()
-            img_temp = img_patch.unsqueeze(1).contiguous().repeat(1, stroke_num, 1, 1, 1).view(
-                img_patch.shape[0] * stroke_num, 3, patch_size, patch_size).contiguous()
-            color = F.grid_sample(img_temp, 2 * grid - 1, align_corners=False).view(
-                img_patch.shape[0], stroke_num, 3).contiguous()
-            stroke_param = torch.cat([shape_param, color], dim=-1)
-            # stroke_param: b * h * w, stroke_per_patch, param_per_stroke
-            # stroke_decision: b * h * w, stroke_per_patch, 1
-            param = stroke_param.view(1, patch_num, patch_num, stroke_num, 8).contiguous()
-            decision = stroke_decision.view(1, patch_num, patch_num, stroke_num).contiguous().bool()
-            # param: b, h, w, stroke_per_patch, 8
-            # decision: b, h, w, stroke_per_patch
-            param[..., :2] = param[..., :2] / 2 + 0.25
-            param[..., 2:4] = param[..., 2:4] / 2
-            if serial:
-                final_result = param2img_serial(param, decision, meta_brushes, final_result,
-                                                frame_dir, False, original_h, original_w)
-            else:
-                final_result = param2img_parallel(param, decision, meta_brushes, final_result)
-
-        border_size = original_img_pad_size // (2 * patch_num)
-        img = F.interpolate(original_img_pad, (patch_size * (2 ** layer), patch_size * (2 ** layer)))
-        result = F.interpolate(final_result, (patch_size * (2 ** layer), patch_size * (2 ** layer)))
-        img = F.pad(img, [patch_size // 2, patch_size // 2, patch_size // 2, patch_size // 2,
-                          0, 0, 0, 0])
-        result = F.pad(result, [patch_size // 2, patch_size // 2, patch_size // 2, patch_size // 2,
-                                0, 0, 0, 0])
-        img_patch = F.unfold(img, (patch_size, patch_size), stride=(patch_size, patch_size))
-        result_patch = F.unfold(result, (patch_size, patch_size), stride=(patch_size, patch_size))
-        final_result = F.pad(final_result, [border_size, border_size, border_size, border_size, 0, 0, 0, 0])
-        h = (img.shape[2] - patch_size) // patch_size + 1
-        w = (img.shape[3] - patch_size) // patch_size + 1
-        # img_patch, result_patch: b, 3 * output_size * output_size, h * w
-        img_patch = img_patch.permute(0, 2, 1).contiguous().view(-1, 3, patch_size, patch_size).contiguous()
-        result_patch = result_patch.permute(0, 2, 1).contiguous().view(-1, 3, patch_size, patch_size).contiguous()
-        shape_param, stroke_decision = net_g(img_patch, result_patch)
+        else:
+            outputs = [net_g(img_patch[i:i + batch_size], result_patch[i:i + batch_size])
+                       for i in range(0, img_patch.shape[0], batch_size)]
+            shape_param = torch.cat([output[0] for output in outputs])
+            stroke_decision = torch.cat([output[1] for output in outputs])
 
+    with profiling.stage('color_sampling'):
         grid = shape_param[:, :, :2].view(img_patch.shape[0] * stroke_num, 1, 1, 2).contiguous()
         img_temp = img_patch.unsqueeze(1).contiguous().repeat(1, stroke_num, 1, 1, 1).view(
             img_patch.shape[0] * stroke_num, 3, patch_size, patch_size).contiguous()
         color = F.grid_sample(img_temp, 2 * grid - 1, align_corners=False).view(
             img_patch.shape[0], stroke_num, 3).contiguous()
-        stroke_param = torch.cat([shape_param, color], dim=-1)
-        # stroke_param: b * h * w, stroke_per_patch, param_per_stroke
-        # stroke_decision: b * h * w, stroke_per_patch, 1
-        param = stroke_param.view(1, h, w, stroke_num, 8).contiguous()
-        decision = stroke_decision.view(1, h, w, stroke_num).contiguous().bool()
-        # param: b, h, w, stroke_per_patch, 8
-        # decision: b, h, w, stroke_per_patch
-        param[..., :2] = param[..., :2] / 2 + 0.25
-        param[..., 2:4] = param[..., 2:4] / 2
-        if serial:
-            final_result = param2img_serial(param, decision, meta_brushes, final_result,
-                                            frame_dir, True, original_h, original_w)
-        else:
-            final_result = param2img_parallel(param, decision, meta_brushes, final_result)
-        final_result = final_result[:, :, border_size:-border_size, border_size:-border_size]
+    stroke_param = torch.cat([shape_param, color], dim=-1)
+    if active is not None:
+        # Inactive patches get zero logits, which no decision rule turns into an active stroke.
+        stroke_param = stroke_param.new_zeros(h * w, *stroke_param.shape[1:]).index_copy_(0, index, stroke_param)
+        stroke_decision = stroke_decision.new_zeros(h * w, *stroke_decision.shape[1:]).index_copy_(
+            0, index, stroke_decision)
+    # stroke_param: b * h * w, stroke_per_patch, param_per_stroke
+    # stroke_decision: b * h * w, stroke_per_patch, 1
+    param = stroke_param.view(1, h, w, stroke_num, 8).contiguous()
+    decision_logits = stroke_decision.view(1, h, w, stroke_num).contiguous()
+    # param: b, h, w, stroke_per_patch, 8
+    # decision_logits: b, h, w, stroke_per_patch
+    param[..., :2] = param[..., :2] / 2 + 0.25
+    param[..., 2:4] = param[..., 2:4] / 2
+    return param, decision_logits
+
+
+def limit_strokes(decision, decision_logits, max_strokes):
+    """
+    Keep at most max_strokes active strokes per patch, those with the largest decision logits.
+    Args:
+        decision: a bool tensor with shape batch size x patch along height dimension x patch along width dimension
+         x n_stroke_per_patch.
+        decision_logits: a tensor with the same shape, the logits decision was taken from.
+        max_strokes: maximum number of active strokes per patch. None keeps every active stroke.
+
+    Returns:
+        decision: a bool tensor with the same shape. Kept strokes keep their order.
+    """
+    if max_strokes is None or max_strokes >= decision.shape[-1]:
+        return decision
+    if max_strokes <= 0:
+        return torch.zeros_like(decision)
+    top = decision_logits.topk(max_strokes, dim=-1).indices
+    keep = torch.zeros_like(decision).scatter_(-1, top, True)
+    return decision & keep
+
 
-        final_result = crop(final_result, original_h, original_w)
-        save_img(final_result[0], output_path)
+def paint(original_img, net_g, meta_brushes, ctx=None, serial=False, max_render_bytes=planner.DEFAULT_RENDER_BYTES,
+          preset=None, mask=None, base=None, tuning=None):
+    """
+    Paint an image that is already in memory.
+    Args:
+        original_img: a tensor with shape 1 x 3 x H x W and values in [0, 1], on the same device as net_g.
+        net_g: a Painter network, as returned by load_painter.
+        meta_brushes: a brushes.BrushLibrary as returned by load_brushes, which lets every layer use the brush
+         set of the preset's brush schedule at no resizing cost, or a tensor with shape
+         2 x 1 x meta_brush_height x meta_brush_width as returned by load_meta_brushes, used for every layer.
+        ctx: the PaintContext of this painting run. None means a fresh context without intermediate results.
+         After every pass, ctx.on_progress receives a dict with the layer of the pass ('border' for the border
+         pass), the number of passes done and of passes in total, and the patch and active stroke counts of the
+         pass. The run raises PaintCancelled before the next pass or parity group once ctx is cancelled.
+        serial: whether to use the serial renderer. It is required when ctx needs intermediate results.
+        max_render_bytes: memory budget of the parallel renderer for rasterized strokes, see param2img_parallel.
+        preset: the name or settings of a speed/quality preset, see inference.presets. None means 'standard'.
+        mask: a tensor with shape 1 x 1 x H x W and values in [0, 1], the region to paint. Only patches whose
+         strokes can reach the mask are run through net_g and rendered, and the result is blended with base
+         by the mask. None paints the whole image.
+        base: a tensor with shape 1 x 3 x H x W shown outside the mask, such as a previous painting result.
+         None means original_img.
+        tuning: an execution profile of this machine as returned by autotune.load, which sets the thread counts
+         and the net_g batch size of every pass. Thread counts are process-wide, so tuned passes of concurrent
+         paintings wait for each other, see autotune.threads. None keeps torch's settings.
+
+    Returns:
+        final_result: a tensor with shape 1 x 3 x H x W, denoting the painting result.
+    """
+    settings = presets.resolve(preset)
+    if ctx is None:
+        ctx = PaintContext()
+    if ctx.need_frames and not serial:
+        print('It must be under serial mode if animation results are required, so serial flag is set to True!')
+        serial = True
+    patch_size = 32
+    device = original_img.device
+
+    with profiling.activate(ctx.profiler), torch.no_grad():
+        original_h, original_w = original_img.shape[-2:]
+        K = max(math.ceil(math.log2(max(original_h, original_w) / patch_size)), 0)
+        original_img_pad_size = patch_size * (2 ** K)
+        original_img_pad = pad(original_img, original_img_pad_size, original_img_pad_size)
+        # The canvas is kept in the precision of the preset, and upcast only where net_g reads it.
+        final_result = torch.zeros_like(original_img_pad, dtype=getattr(torch, settings['precision'])).to(device)
+        mask_pad = None
+        if mask is not None:
+            mask = mask.to(device=device, dtype=original_img.dtype)
+            mask_pad = pad(mask, original_img_pad_size, original_img_pad_size)
+        layers = presets.layers(K + 1, settings)
+        passes = len(layers) + (0 if settings['skip_border'] else 1)
+        for layer in layers:
+            ctx.check_cancelled()
+            with profiling.stage('layer', layer):
+                layer_size = patch_size * (2 ** layer)
+                with profiling.stage('pyramid'):
+                    img = F.interpolate(original_img_pad, (layer_size, layer_size))
+                    result = F.interpolate(final_result.float(), (patch_size * (2 ** layer), patch_size * (2 ** layer)))
+                    img_patch = F.unfold(img, (patch_size, patch_size), stride=(patch_size, patch_size))
+                    result_patch = F.unfold(result, (patch_size, patch_size),
+                                            stride=(patch_size, patch_size))
+                    # There are patch_num * patch_num patches in total
+                    patch_num = (layer_size - patch_size) // patch_size + 1
+
+                    # img_patch, result_patch: b, 3 * output_size * output_size, h * w
+                    img_patch = img_patch.permute(0, 2, 1).contiguous().view(
+                        -1, 3, patch_size, patch_size).contiguous()
+                    result_patch = result_patch.permute(0, 2, 1).contiguous().view(
+                        -1, 3, patch_size, patch_size).contiguous()
+                active = None if mask_pad is None else active_patches(mask_pad, patch_num)
+                if active is not None:
+                    profiling.count('active_patches', active)
+                pass_settings = autotune.layer_settings(tuning, patch_num * patch_num)
+                with autotune.threads(pass_settings['net_g_threads']):
+                    param, decision_logits = predict_strokes(net_g, img_patch, result_patch, patch_num, patch_num,
+                                                             active, pass_settings['net_g_batch'])
+                pass_brushes = layer_brushes(meta_brushes, settings['brushes'], layer,
+                                             2 * original_img_pad_size // patch_num, settings['brush_mode'])
+                decision = network.SignWithSigmoidGrad.apply(decision_logits).bool()
+                decision = limit_strokes(decision, decision_logits, settings['max_strokes'])
+                profiling.count('active_strokes', decision)
+                profiling.count('strokes', decision.numel())
+                with profiling.stage('render'), autotune.threads(pass_settings['render_threads']):
+                    if serial:
+                        final_result = param2img_serial(param, decision, pass_brushes, final_result,
+                                                        ctx, False, original_h, original_w)
+                    else:
+                        final_result = param2img_parallel(param, decision, pass_brushes, final_result,
+                                                          max_render_bytes, ctx, settings['cull'])
+
+            ctx.report(layer=layer, done=layer - layers[0] + 1, passes=passes, patches=patch_num * patch_num,
+                       active_strokes=int(decision.sum()) if ctx.on_progress is not None else None)
+
+        if not settings['skip_border']:
+            ctx.check_cancelled()
+            with profiling.stage('layer', 'border'):
+                border_size = original_img_pad_size // (2 * patch_num)
+                with profiling.stage('pyramid'):
+                    img = F.interpolate(original_img_pad, (patch_size * (2 ** layer), patch_size * (2 ** layer)))
+                    result = F.interpolate(final_result.float(), (patch_size * (2 ** layer), patch_size * (2 ** layer)))
+                    img = F.pad(img, [patch_size // 2, patch_size // 2, patch_size // 2, patch_size // 2,
+                                      0, 0, 0, 0])
+                    result = F.pad(result, [patch_size // 2, patch_size // 2, patch_size // 2, patch_size // 2,
+                                            0, 0, 0, 0])
+                    img_patch = F.unfold(img, (patch_size, patch_size), stride=(patch_size, patch_size))
+                    result_patch = F.unfold(result, (patch_size, patch_size), stride=(patch_size, patch_size))
+                    final_result = F.pad(final_result, [border_size, border_size, border_size, border_size, 0, 0, 0, 0])
+                    h = (img.shape[2] - patch_size) // patch_size + 1
+                    w = (img.shape[3] - patch_size) // patch_size + 1
+                    # img_patch, result_patch: b, 3 * output_size * output_size, h * w
+                    img_patch = img_patch.permute(0, 2, 1).contiguous().view(-1, 3, patch_size, patch_size).contiguous()
+                    result_patch = result_patch.permute(0, 2, 1).contiguous().view(
+                        -1, 3, patch_size, patch_size).contiguous()
+                active = None if mask_pad is None else active_patches(mask_pad, patch_num, border=True)
+                if active is not None:
+                    profiling.count('active_patches', active)
+                pass_settings = autotune.layer_settings(tuning, h * w)
+                with autotune.threads(pass_settings['net_g_threads']):
+                    param, decision_logits = predict_strokes(net_g, img_patch, result_patch, h, w, active,
+                                                             pass_settings['net_g_batch'])
+                pass_brushes = layer_brushes(meta_brushes, settings['brushes'], 'border',
+                                             2 * original_img_pad_size // patch_num, settings['brush_mode'])
+                decision = limit_strokes(decision_logits.bool(), decision_logits, settings['max_strokes'])
+                profiling.count('active_strokes', decision)
+                profiling.count('strokes', decision.numel())
+                with profiling.stage('render'), autotune.threads(pass_settings['render_threads']):
+                    if serial:
+                        final_result = param2img_serial(param, decision, pass_brushes, final_result,
+                                                        ctx, True, original_h, original_w)
+                    else:
+                        final_result = param2img_parallel(param, decision, pass_brushes, final_result,
+                                                          max_render_bytes, ctx, settings['cull'])
+                final_result = final_result[:, :, border_size:-border_size, border_size:-border_size]
+            ctx.report(layer='border', done=passes, passes=passes, patches=h * w,
+                       active_strokes=int(decision.sum()) if ctx.on_progress is not None else None)
+
+        final_result = crop(final_result, original_h, original_w).float()
+        if mask is not None:
+            base = original_img if base is None else base.to(device)
+            final_result = torch.lerp(base, final_result, mask)
+    return final_result
+
+
+def main(input_path, model_path, output_dir, need_animation=False, resize_h=None, resize_w=None, serial=False,
+         profiler=None, preset=None, on_progress=None, cancel_event=None, tuned=False):
+    os.makedirs(output_dir, exist_ok=True)
+    input_name = os.path.basename(input_path)
+    output_path = os.path.join(output_dir, input_name)
+    frame_dir = None
+    if need_animation:
+        if not serial:
+            print('It must be under serial mode if animation results are required, so serial flag is set to True!')
+            serial = True
+        frame_dir = os.path.join(output_dir, input_name[:input_name.find('.')])
+        os.makedirs(frame_dir, exist_ok=True)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    net_g = load_painter(model_path, device)
+    meta_brushes = load_brushes(device)
+    tuning = autotune.load(device) if tuned else None
+    with profiling.activate(profiler):
+        with profiling.stage('decode'):
+            original_img = read_img(input_path, 'RGB', resize_h, resize_w).to(device)
+        ctx = PaintContext(frame_dir, profiler=profiler, on_progress=on_progress, cancel_event=cancel_event)
+        final_result = paint(original_img, net_g, meta_brushes, ctx, serial, preset=preset, tuning=tuning)
+        with profiling.stage('save_img'):
+            save_img(final_result[0], output_path)
 
 
 if __name__ == '__main__':
@@ -493,4 +877,9 @@ if __name__ == '__main__':
          need_animation=False,  # whether need intermediate results for animation.
          resize_h=None,         # resize original input to this size. None means do not resize.
          resize_w=None,         # resize original input to this size. None means do not resize.
-         serial=False)          # if need animation, serial must be True.
+         serial=False,          # if need animation, serial must be True.
+         profiler=None,         # a profiling.Profiler to record per-stage timings and memory.
+         preset=None,           # 'draft', 'standard' or 'fine', see inference.presets. None means 'standard'.
+         on_progress=None,      # called with a dict after every painting pass, such as print. None means no progress.
+         cancel_event=None,     # a threading.Event that stops painting when set. None means a new event.
+         tuned=True)            # apply the profile of `python -m inference.autotune`, if this machine has one.
@@ -49,3 +49,14 @@ def dilation(x, m=1):
     channel = nn.functional.unfold(x_pad, 2 * m + 1, padding=0, stride=1).view(b, c, -1, h, w)
     result = torch.max(channel, dim=2)[0]
     return result
+
+
+def max_dilation(x, m=1):
+    # Same result as dilation, with a max pooling instead of a (2m+1)^2 times larger unfold.
+    return F.max_pool2d(x, 2 * m + 1, stride=1, padding=m)
+
+
+def erode_mask(mask, m=1, dtype=torch.float16):
+    # Erosion of a bool mask, where pixels outside of it count as set, like the padding of erosion.
+    # Pooling takes floating point tensors only, so the mask goes through dtype, which holds 0 and 1 exactly.
+    return F.max_pool2d((~mask).to(dtype), 2 * m + 1, stride=1, padding=m) == 0
@@ -0,0 +1,142 @@
+"""
+Staged pipeline for batch jobs.
+
+Decoding and encoding images is Pillow work that releases the GIL, while inference keeps torch busy.
+Running them one after the other leaves either the CPU cores or torch idle, so BatchPipeline overlaps
+them: a pool of decode workers prefetches inputs, inference runs in the calling thread, and a pool of
+encode workers writes results. The queues between the stages are bounded, so at most queue_size
+decoded inputs and queue_size finished results are held in memory at any time.
+
+Every stage reports how many items it processed and how long its workers were busy, which tells
+whether a stage is starved (it could go faster) or is the bottleneck (the others wait for it).
+"""
+import collections
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class Stage:
+    """
+    A pipeline stage: a function plus the statistics of its calls.
+    """
+
+    def __init__(self, name, fn, workers=1):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.items = 0
+        self.failures = 0
+        self.busy_s = 0.
+        self._lock = threading.Lock()
+
+    def __call__(self, *args):
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = self.fn(*args)
+            failed = False
+            return result
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.items += 1
+                self.failures += failed
+                self.busy_s += elapsed
+
+    def stats(self, wall_s):
+        """
+        Args:
+            wall_s: wall time of the whole run.
+
+        Returns:
+            A dict with the number of items and failures, the busy time summed over workers, the achieved
+            throughput, the throughput the stage could sustain if it was never starved (capacity), and the
+            fraction of time its workers were busy (utilization).
+        """
+        return {'name': self.name, 'workers': self.workers, 'items': self.items, 'failures': self.failures,
+                'busy_s': self.busy_s,
+                'items_per_s': self.items / wall_s if wall_s > 0 else 0.,
+                'capacity_items_per_s': self.items * self.workers / self.busy_s if self.busy_s > 0 else 0.,
+                'utilization': self.busy_s / (wall_s * self.workers) if wall_s > 0 else 0.}
+
+
+class BatchPipeline:
+    """
+    Run decode, infer and encode over a batch of items with bounded queues between the stages.
+    Args:
+        decode: function item -> decoded input. Runs in a pool of decode_workers threads.
+        infer: function decoded input -> result. Runs in the thread that iterates over run().
+        encode: function (item, result) -> output. Runs in a pool of encode_workers threads.
+        decode_workers, encode_workers: sizes of the thread pools.
+        queue_size: maximum number of decoded inputs waiting for inference, and of results waiting to be encoded.
+    """
+
+    def __init__(self, decode, infer, encode, decode_workers=2, encode_workers=2, queue_size=4):
+        self.decode = Stage('decode', decode, decode_workers)
+        self.infer = Stage('infer', infer, 1)
+        self.encode = Stage('encode', encode, encode_workers)
+        self.queue_size = max(queue_size, 1)
+        self.wall_s = 0.
+
+    def run(self, items):
+        """
+        Process items and yield (item, output, error) in input order as they finish.
+        error is None on success, and the exception raised by any stage otherwise, in which case output is None.
+        """
+        items = iter(items)
+        start = time.perf_counter()
+        decoding = collections.deque()
+        encoding = collections.deque()
+
+        with ThreadPoolExecutor(self.decode.workers, thread_name_prefix='decode') as decoders, \
+                ThreadPoolExecutor(self.encode.workers, thread_name_prefix='encode') as encoders:
+
+            def prefetch():
+                while len(decoding) < self.queue_size:
+                    item = next(items, _DONE)
+                    if item is _DONE:
+                        return
+                    decoding.append((item, decoders.submit(self.decode, item)))
+
+            def finish(item, future):
+                try:
+                    return item, future.result(), None
+                except Exception as e:
+                    return item, None, e
+
+            prefetch()
+            while decoding:
+                item, future = decoding.popleft()
+                prefetch()
+                try:
+                    result = self.infer(future.result())
+                except Exception as e:
+                    encoding.append((item, _failed(e)))
+                else:
+                    encoding.append((item, encoders.submit(self.encode, item, result)))
+                    del result
+                while len(encoding) > self.queue_size or (encoding and encoding[0][1].done()):
+                    yield finish(*encoding.popleft())
+                    self.wall_s = time.perf_counter() - start
+            while encoding:
+                yield finish(*encoding.popleft())
+        self.wall_s = time.perf_counter() - start
+
+    def stats(self):
+        """
+        Per-stage statistics of the last run, see Stage.stats.
+        """
+        return [stage.stats(self.wall_s) for stage in (self.decode, self.infer, self.encode)]
+
+
+_DONE = object()
+
+
+def _failed(error):
+    """
+    A finished future that raises error, so that failures keep their place in the output order.
+    """
+    future = Future()
+    future.set_exception(error)
+    return future
@@ -0,0 +1,273 @@
+"""
+Memory and runtime planning for painting jobs.
+
+Every buffer of the pipeline has a size that follows from the input size alone: the number of layers K,
+the number of patches of every layer, the number of strokes and the size each stroke is rendered at. This
+module turns those shapes into an estimate of peak memory and runtime before any work starts, and picks
+smaller stroke chunks, a smaller input size, or rejects the job when it does not fit a memory budget.
+
+The cost constants below are deliberately conservative (every stroke is assumed to be active) and can
+be calibrated for a machine from a benchmark baseline with `calibrate`.
+"""
+import json
+import math
+import re
+
+import inference.presets as presets
+
+PATCH_SIZE = 32
+STROKE_NUM = 8
+FLOAT_BYTES = 4
+# Peak activation memory of one 32 x 32 patch in the Painter forward pass, mostly the
+# transformer feed-forward layers (64 tokens x 2048 features) and the first conv layers.
+NET_BYTES_PER_PATCH = 1 << 20
+# Peak working set of param2stroke in units of one 3 x patch x patch float buffer per stroke, dominated
+# by the 3 x 3 unfold of dilation and erosion (9 buffers each) next to the brush, alpha and color maps.
+STROKE_WORK_BUFFERS = 15
+# Temporaries of compositing a chunk of strokes in closed form (transmittance, premultiplied colors and
+# their product), in the same units. They are only alive once the param2stroke working set is freed.
+COMPOSITE_BUFFERS = 4
+# Memory budget of the stroke renderer per rendering pass, see inference.param2img_parallel, and the
+# smallest budget the planner lowers it to before resorting to resizing.
+DEFAULT_RENDER_BYTES = 256 << 20
+MIN_RENDER_BYTES = 8 << 20
+DEFAULT_SECONDS_PER_PATCH = 2e-3
+DEFAULT_SECONDS_PER_STROKE_PIXEL = 2e-8
+
+_UNITS = {'': 1, 'b': 1, 'k': 1 << 10, 'kb': 1 << 10, 'kib': 1 << 10, 'm': 1 << 20, 'mb': 1 << 20, 'mib': 1 << 20,
+          'g': 1 << 30, 'gb': 1 << 30, 'gib': 1 << 30, 't': 1 << 40, 'tb': 1 << 40, 'tib': 1 << 40}
+
+
+class PlanRejected(MemoryError):
+    """
+    Raised when a job cannot be made to fit the memory budget.
+    """
+
+    def __init__(self, message, plan):
+        super().__init__(message)
+        self.plan = plan
+
+
+def parse_size(text):
+    """
+    Parse a memory size such as "512MB", "2 GiB" or "1073741824" into bytes.
+    """
+    match = re.fullmatch(r'\s*([0-9]*\.?[0-9]+)\s*([a-zA-Z]*)\s*', str(text))
+    if match is None or match.group(2).lower() not in _UNITS:
+        raise ValueError('invalid memory size: %r' % text)
+    return int(float(match.group(1)) * _UNITS[match.group(2).lower()])
+
+
+def format_size(n_bytes):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(n_bytes) < 1024 or unit == 'GiB':
+            return '%.1f %s' % (n_bytes, unit) if unit != 'B' else '%d B' % n_bytes
+        n_bytes /= 1024
+
+
+def num_layers(height, width, patch_size=PATCH_SIZE):
+    return max(math.ceil(math.log2(max(height, width) / patch_size)), 0)
+
+
+def render_passes(height, width, patch_size=PATCH_SIZE, preset=None):
+    """
+    Shapes of every rendering pass of inference.paint with the given preset (see inference.presets), in order.
+
+    Returns:
+        A list of dicts with the layer (an int, or 'border' for the final shifted pass), the number of
+        patches along each dimension, the size every stroke is rendered at and the size of the canvas.
+    """
+    K = num_layers(height, width, patch_size)
+    pad_size = patch_size * (2 ** K)
+    settings = presets.resolve(preset)
+    passes = []
+    for layer in presets.layers(K + 1, settings):
+        patch_num = 2 ** layer
+        passes.append({'layer': layer, 'patch_num': patch_num, 'render_patch_size': 2 * pad_size // patch_num,
+                       'canvas_size': pad_size})
+    if settings['skip_border']:
+        return passes
+    border_size = pad_size // (2 * patch_num)
+    passes.append({'layer': 'border', 'patch_num': patch_num + 1, 'render_patch_size': 2 * pad_size // patch_num,
+                   'canvas_size': pad_size + 2 * border_size})
+    return passes
+
+
+def stroke_bytes(render_patch_size_y, render_patch_size_x, density=1.):
+    """
+    Memory needed to rasterize and composite one stroke: its foreground and alpha buffers, plus the
+    param2stroke working set if the stroke is active or the compositing temporaries, whichever is larger.
+    """
+    buffer_bytes = 3 * render_patch_size_y * render_patch_size_x * FLOAT_BYTES
+    return int((2 + max(STROKE_WORK_BUFFERS * density, COMPOSITE_BUFFERS)) * buffer_bytes)
+
+
+def render_bytes(patch_num, render_patch_size, stroke_num=STROKE_NUM, density=1.,
+                 max_render_bytes=DEFAULT_RENDER_BYTES):
+    """
+    Peak memory of param2img_parallel for one pass.
+    Args:
+        patch_num: number of patches along each dimension.
+        render_patch_size: size every stroke is rendered at.
+        stroke_num: number of strokes per patch.
+        density: fraction of strokes that are active.
+        max_render_bytes: memory budget of the renderer for rasterized strokes. None means unlimited.
+    """
+    group_patches = math.ceil(patch_num / 2) ** 2
+    # Strokes are composited in place into the padded canvas, so only the strokes rasterized at once count:
+    # a parity group, or as many as fit the budget, but at least one.
+    chunk_strokes = group_patches * stroke_num
+    if max_render_bytes is not None:
+        fitting_strokes = max_render_bytes // stroke_bytes(render_patch_size, render_patch_size)
+        chunk_strokes = min(chunk_strokes, max(fitting_strokes, 1))
+    return int(chunk_strokes * stroke_bytes(render_patch_size, render_patch_size, density))
+
+
+def estimate(height, width, density=1., seconds_per_patch=DEFAULT_SECONDS_PER_PATCH,
+             seconds_per_stroke_pixel=DEFAULT_SECONDS_PER_STROKE_PIXEL, patch_size=PATCH_SIZE,
+             stroke_num=STROKE_NUM, max_render_bytes=DEFAULT_RENDER_BYTES, preset=None):
+    """
+    Estimate peak memory and runtime of painting an image of the given size with the parallel renderer.
+    Args:
+        height, width: size of the image that is painted, i.e. after any resizing.
+        density: fraction of strokes assumed to be active. 1 gives an upper bound.
+        seconds_per_patch: cost of the Painter forward pass per patch.
+        seconds_per_stroke_pixel: cost of rasterizing and compositing one stroke pixel.
+        max_render_bytes: memory budget of the stroke renderer, see render_bytes.
+        preset: the name or settings of a speed/quality preset, see inference.presets.
+
+    Returns:
+        A dict with the overall peak_bytes and runtime_s, and the same per pass in 'passes'.
+    """
+    K = num_layers(height, width, patch_size)
+    pad_size = patch_size * (2 ** K)
+    settings = presets.resolve(preset)
+    if settings['max_strokes'] is not None:
+        density = min(density, max(settings['max_strokes'], 0) / stroke_num)
+    canvas_bytes = 3 * pad_size * pad_size * FLOAT_BYTES
+    # original image, padded original image and the current result
+    base = 3 * height * width * FLOAT_BYTES + 2 * canvas_bytes
+    passes = []
+    for shape in render_passes(height, width, patch_size, settings):
+        patches = shape['patch_num'] ** 2
+        strokes = patches * stroke_num
+        layer_size = shape['patch_num'] * patch_size
+        patch_bytes = 3 * patch_size * patch_size * FLOAT_BYTES
+        # resized image and result of the layer, and their patches
+        pyramid = 2 * 3 * layer_size * layer_size * FLOAT_BYTES + 2 * patches * patch_bytes
+        net = patches * (NET_BYTES_PER_PATCH + stroke_num * patch_bytes)
+        render = render_bytes(shape['patch_num'], shape['render_patch_size'], stroke_num, density, max_render_bytes)
+        padded_canvas = 3 * shape['canvas_size'] ** 2 * FLOAT_BYTES
+        peak = base + pyramid + max(net, render + padded_canvas)
+        runtime = (patches * seconds_per_patch
+                   + strokes * density * shape['render_patch_size'] ** 2 * seconds_per_stroke_pixel)
+        passes.append(dict(shape, patches=patches, strokes=strokes, peak_bytes=int(peak), runtime_s=runtime))
+    layers = sum(item['layer'] != 'border' for item in passes)
+    return {'height': height, 'width': width, 'layers': layers, 'pad_size': pad_size,
+            'peak_bytes': max(item['peak_bytes'] for item in passes),
+            'runtime_s': sum(item['runtime_s'] for item in passes), 'passes': passes}
+
+
+def _render_budgets(max_render_bytes):
+    """
+    Renderer budgets to try, from the given one down to MIN_RENDER_BYTES.
+    """
+    budgets = [max_render_bytes]
+    while max_render_bytes is not None and max_render_bytes // 2 >= MIN_RENDER_BYTES:
+        max_render_bytes //= 2
+        budgets.append(max_render_bytes)
+    return budgets
+
+
+def plan(height, width, budget=None, allow_resize=True, min_size=PATCH_SIZE,
+         max_render_bytes=DEFAULT_RENDER_BYTES, **estimate_kwargs):
+    """
+    Decide how to run a job so that it fits the memory budget.
+
+    Smaller stroke chunks are preferred over resizing, since they only cost some speed while resizing
+    costs detail.
+    Args:
+        height, width: size of the image that would be painted.
+        budget: memory budget in bytes. None means unlimited.
+        allow_resize: whether the image may be downscaled to fit.
+        min_size: smallest maximum dimension the image may be downscaled to.
+        max_render_bytes: memory budget of the stroke renderer to start from.
+        estimate_kwargs: passed on to estimate.
+
+    Returns:
+        A dict with 'action' ('run', 'chunk' or 'resize'), the 'max_dim' to resize to (or None), the
+        'max_render_bytes' to render strokes with, the 'budget', the 'reason' for the decision and the
+        'estimate' of the job as it will run.
+
+    Raises:
+        PlanRejected: if the job does not fit even after resizing.
+    """
+    current = estimate(height, width, max_render_bytes=max_render_bytes, **estimate_kwargs)
+    result = {'action': 'run', 'max_dim': None, 'max_render_bytes': max_render_bytes, 'budget': budget,
+              'reason': 'fits the budget', 'estimate': current}
+    if budget is None:
+        result['reason'] = 'no memory budget'
+        return result
+    if current['peak_bytes'] <= budget:
+        return result
+    for render_budget in _render_budgets(max_render_bytes)[1:]:
+        chunked = estimate(height, width, max_render_bytes=render_budget, **estimate_kwargs)
+        if chunked['peak_bytes'] <= budget:
+            result.update(action='chunk', max_render_bytes=render_budget, estimate=chunked,
+                          reason='%s needed at %dx%d, rendering strokes in chunks of %s' % (
+                              format_size(current['peak_bytes']), width, height, format_size(render_budget)))
+            return result
+    if allow_resize:
+        # Peak memory is a step function of the number of layers, so try the largest size of every smaller K.
+        max_dim = max(height, width)
+        for K in range(num_layers(height, width) - 1, -1, -1):
+            candidate = min(max_dim, PATCH_SIZE * 2 ** K)
+            if candidate < min_size:
+                break
+            ratio = candidate / max_dim
+            for render_budget in _render_budgets(max_render_bytes):
+                resized = estimate(max(int(height * ratio), 1), max(int(width * ratio), 1),
+                                   max_render_bytes=render_budget, **estimate_kwargs)
+                if resized['peak_bytes'] <= budget:
+                    result.update(action='resize', max_dim=candidate, max_render_bytes=render_budget,
+                                  estimate=resized,
+                                  reason='%s needed at %dx%d, resizing to %d px maximum dimension' % (
+                                      format_size(current['peak_bytes']), width, height, candidate))
+                    return result
+    result.update(action='reject', reason='%s needed at %dx%d exceeds the budget of %s' % (
+        format_size(current['peak_bytes']), width, height, format_size(budget)))
+    raise PlanRejected(result['reason'], result)
+
+
+def calibrate(baseline_path):
+    """
+    Derive the runtime coefficients of estimate from a baseline written by benchmarks/bench_inference.py.
+
+    Returns:
+        A dict with seconds_per_patch and seconds_per_stroke_pixel, to be passed to estimate or plan.
+    """
+    with open(baseline_path) as f:
+        results = json.load(f)['results']
+    coefficients = {'seconds_per_patch': DEFAULT_SECONDS_PER_PATCH,
+                    'seconds_per_stroke_pixel': DEFAULT_SECONDS_PER_STROKE_PIXEL}
+    per_pixel = []
+    for name, result in results.items():
+        match = re.fullmatch(r'param2img_parallel/patches(\d+)/patch(\d+)', name)
+        if match:
+            patch_num, patch_size = int(match.group(1)), int(match.group(2))
+            # the benchmark activates half of the strokes
+            per_pixel.append(result['median_s'] / (patch_num * patch_num * STROKE_NUM * 0.5 * patch_size ** 2))
+    if per_pixel:
+        coefficients['seconds_per_stroke_pixel'] = sorted(per_pixel)[len(per_pixel) // 2]
+    per_patch = []
+    for name, result in results.items():
+        match = re.fullmatch(r'main/.*/(\d+)x(\d+)', name)
+        if match:
+            width, height = int(match.group(1)), int(match.group(2))
+            rendering = estimate(height, width, density=0.5, seconds_per_patch=0.,
+                                 seconds_per_stroke_pixel=coefficients['seconds_per_stroke_pixel'])
+            patches = sum(item['patches'] for item in rendering['passes'])
+            per_patch.append(max(result['median_s'] - rendering['runtime_s'], 0.) / patches)
+    if per_patch:
+        coefficients['seconds_per_patch'] = sorted(per_patch)[len(per_patch) // 2]
+    return coefficients
@@ -0,0 +1,82 @@
+"""
+Speed/quality presets for painting.
+
+Painting runs the Painter on every layer of an image pyramid, from one patch on layer 0 up to layer K where
+patches are 32 pixels of the padded input, and finishes with a shifted pass over the last layer to cover
+the patch borders. Every layer has four times the patches of the previous one, so the last layers and the
+border pass dominate the cost. The knobs below trade that cost for detail:
+
+    max_layers: run at most this many layers, counted from layer 0. None runs every layer.
+    min_layer: first layer to run. Coarser layers are skipped and painting starts from a blank canvas.
+    extra_layers: run this many layers past K, with strokes finer than the input patches.
+    skip_border: skip the final shifted border pass.
+    max_strokes: keep at most this many active strokes per patch, those with the largest decision logits.
+     None keeps every active stroke.
+    brushes: the brush set of every layer, see inference.brushes.brush_set. 'auto' paints the finest layers
+     with the small brushes.
+    precision: dtype of the canvas and the rasterized strokes, one of PRECISIONS. 'float16' and 'bfloat16'
+     select the low-precision render mode, with bool alpha masks, which moves 2 to 4 times less memory;
+     colours are then rounded to the precision of the canvas.
+    brush_mode: 'texture' to warp the brush images, or one of BRUSH_MODES[1:] to rasterize every stroke as an
+     anti-aliased ellipse or rounded rectangle of its colour, see inference.analytic. Analytic strokes skip the
+     texture sampling and the morphology of texture brushes, and the brushes knob is then ignored.
+    cull: drop the strokes that later strokes fully cover before rasterizing them, see inference.culling. The
+     result is the same either way; the parallel renderer is then faster on dense layers.
+
+The 'standard' preset is the original Paint Transformer schedule.
+"""
+
+PRESETS = {
+    'draft': {'max_layers': 4, 'min_layer': 0, 'extra_layers': 0, 'skip_border': True, 'max_strokes': 4,
+              'brushes': 'large', 'precision': 'float32', 'brush_mode': 'texture', 'cull': True},
+    'standard': {'max_layers': None, 'min_layer': 0, 'extra_layers': 0, 'skip_border': False, 'max_strokes': None,
+                 'brushes': 'large', 'precision': 'float32', 'brush_mode': 'texture', 'cull': True},
+    'fine': {'max_layers': None, 'min_layer': 0, 'extra_layers': 1, 'skip_border': False, 'max_strokes': None,
+             'brushes': 'auto', 'precision': 'float32', 'brush_mode': 'texture', 'cull': True},
+}
+PRECISIONS = ('float32', 'float16', 'bfloat16')
+BRUSH_MODES = ('texture', 'ellipse', 'roundrect')
+DEFAULT_PRESET = 'standard'
+
+
+def resolve(preset=None, **knobs):
+    """
+    Turn a preset and explicit knobs into the settings of a painting run.
+    Args:
+        preset: the name of a preset, a dict of settings (as returned by resolve, possibly partial, on top of
+         the default preset), or None for the default preset.
+        knobs: settings that override the preset. None values are ignored.
+
+    Returns:
+        A dict with every knob.
+    """
+    if preset is None:
+        preset = DEFAULT_PRESET
+    if isinstance(preset, str):
+        if preset not in PRESETS:
+            raise ValueError('unknown preset %r, expected one of %s' % (preset, ', '.join(PRESETS)))
+        settings = dict(PRESETS[preset])
+    else:
+        settings = dict(PRESETS[DEFAULT_PRESET])
+        knobs = dict(preset, **{key: value for key, value in knobs.items() if value is not None})
+    for key, value in knobs.items():
+        if key not in settings:
+            raise ValueError('unknown preset setting %r' % key)
+        if value is not None:
+            settings[key] = value
+    if settings['precision'] not in PRECISIONS:
+        raise ValueError('unknown precision %r, expected one of %s' % (settings['precision'], ', '.join(PRECISIONS)))
+    if settings['brush_mode'] not in BRUSH_MODES:
+        raise ValueError('unknown brush mode %r, expected one of %s' % (settings['brush_mode'], ', '.join(BRUSH_MODES)))
+    return settings
+
+
+def layers(num_layers, settings):
+    """
+    Layers painted for an input with num_layers pyramid layers (K + 1), in order.
+    At least one layer is always painted.
+    """
+    last = num_layers - 1 + settings['extra_layers']
+    if settings['max_layers'] is not None:
+        last = min(last, max(settings['max_layers'], 1) - 1)
+    return range(min(settings['min_layer'], last), last + 1)
@@ -0,0 +1,272 @@
+"""
+Per-stage profiling of the painting pipeline.
+
+A Profiler records the wall time, CPU time and memory use of every stage of a painting run, plus
+counters such as the number of active strokes per layer, and exports them as JSON or as a Chrome
+trace (open it in chrome://tracing or https://ui.perfetto.dev).
+
+Code inside the pipeline opens stages with the module-level `stage` function, which reports to the
+profiler activated for the current thread or task and does nothing when profiling is disabled:
+
+    profiler = Profiler()
+    with profiler.activate():
+        with stage('net_g', layer=0):
+            ...
+    profiler.save_json('profile.json')
+
+CPU memory is measured with torch.profiler: while a Profiler is active, a torch profiler with profile_memory runs,
+and every stage is a record_function range whose allocations are read back when the Profiler is deactivated.
+"""
+import bisect
+import collections
+import contextlib
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+
+_current = contextvars.ContextVar('profiler', default=None)
+
+
+def _attach_cpu_memory(events, records):
+    """
+    Set the CPU memory of stage records from the events of a torch profiler run with profile_memory.
+    Args:
+        events: the events of the run, as returned by torch.profiler.profile.events().
+        records: the stage records by the label of their record_function range.
+
+    Allocations are placed at the start of the innermost op that made them, so peaks are resolved per op.
+    """
+    timelines = collections.defaultdict(list)
+    for event in events:
+        if event.self_cpu_memory_usage:
+            timelines[event.thread].append((event.time_range.start, event.self_cpu_memory_usage))
+    levels = {}
+    for thread, deltas in timelines.items():
+        deltas.sort(key=lambda delta: delta[0])
+        levels[thread] = ([start for start, _ in deltas], list(itertools.accumulate(size for _, size in deltas)))
+    for event in events:
+        record = records.get(event.name)
+        if record is None:
+            continue
+        times, totals = levels.get(event.thread, ([], []))
+        first = bisect.bisect_left(times, event.time_range.start)
+        last = bisect.bisect_right(times, event.time_range.end)
+        before = totals[first - 1] if first else 0
+        record['cpu_allocated_bytes'] = event.cpu_memory_usage
+        record['cpu_peak_bytes'] = max([total - before for total in totals[first:last]]
+                                       + [0, event.cpu_memory_usage])
+
+
+class Profiler:
+    """
+    Collects stage timings, memory use and counters of one painting run.
+    Args:
+        cuda: whether to synchronize CUDA at stage boundaries and record CUDA allocator statistics.
+         None means whenever CUDA is available.
+        memory: whether to record the CPU memory of every stage with torch.profiler, which slows down
+         every op a little. It is skipped while another torch profiler runs in the process.
+
+    Every stage record holds its name, layer, nesting depth, start and wall time, CPU time, the net CPU
+    allocation of the stage and its peak CPU allocation above the level at its start, and with CUDA the
+    peak allocated memory and the net allocation of the stage. CPU time is process-wide, so it also
+    includes other threads.
+    """
+
+    def __init__(self, cuda=None, memory=True):
+        # torch is imported where it is needed, so that importing this module does not import it.
+        import torch
+        if cuda is None:
+            cuda = torch.cuda.is_available()
+        self.cuda = cuda
+        self.memory = memory
+        self.stages = []
+        self.counters = []
+        self._origin = time.perf_counter()
+        self._stack = []
+        self._lock = threading.Lock()
+        self._activations = 0
+        self._torch_profiler = None
+        self._labels = itertools.count()
+        self._pending = {}
+
+    @contextlib.contextmanager
+    def activate(self):
+        """
+        Make this profiler receive the stages and counters reported in the current thread or task.
+        """
+        token = _current.set(self)
+        self._start_memory_profiler()
+        try:
+            yield self
+        finally:
+            self._stop_memory_profiler()
+            _current.reset(token)
+
+    def _start_memory_profiler(self):
+        with self._lock:
+            self._activations += 1
+            if self._activations > 1 or not self.memory:
+                return
+            import torch
+            profiler = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True)
+            try:
+                profiler.start()
+            except RuntimeError:
+                # Another torch profiler is running, and stages go without CPU memory.
+                return
+            self._torch_profiler = profiler
+
+    def _stop_memory_profiler(self):
+        with self._lock:
+            self._activations -= 1
+            if self._activations or self._torch_profiler is None:
+                return
+            profiler, self._torch_profiler = self._torch_profiler, None
+            pending, self._pending = self._pending, {}
+            profiler.stop()
+        _attach_cpu_memory(profiler.events(), pending)
+
+    @contextlib.contextmanager
+    def stage(self, name, layer=None):
+        if layer is None and self._stack:
+            layer = self._stack[-1]['layer']
+        record = {'name': name, 'layer': layer, 'depth': len(self._stack), 'tid': threading.get_ident()}
+        cuda_peak = 0
+        if self.cuda:
+            import torch
+            torch.cuda.synchronize()
+            if self._stack:
+                parent = self._stack[-1]
+                parent['_cuda_peak'] = max(parent['_cuda_peak'], torch.cuda.max_memory_allocated())
+            torch.cuda.reset_peak_memory_stats()
+            cuda_allocated = torch.cuda.memory_allocated()
+        record['_cuda_peak'] = cuda_peak
+        record['cpu_allocated_bytes'] = record['cpu_peak_bytes'] = None
+        scope = contextlib.nullcontext()
+        if self._torch_profiler is not None:
+            import torch
+            # A unique label finds the range of this stage among the events of the torch profiler.
+            label = '%s#%d' % (name, next(self._labels))
+            self._pending[label] = record
+            scope = torch.profiler.record_function(label)
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        self._stack.append(record)
+        try:
+            with scope:
+                yield record
+        finally:
+            self._stack.pop()
+            if self.cuda:
+                torch.cuda.synchronize()
+            end = time.perf_counter()
+            record['start_ms'] = (start - self._origin) * 1e3
+            record['wall_ms'] = (end - start) * 1e3
+            record['cpu_ms'] = (time.process_time() - cpu_start) * 1e3
+            cuda_peak = record.pop('_cuda_peak')
+            if self.cuda:
+                cuda_peak = max(cuda_peak, torch.cuda.max_memory_allocated())
+                record['cuda_peak_bytes'] = cuda_peak
+                record['cuda_allocated_bytes'] = torch.cuda.memory_allocated() - cuda_allocated
+                if self._stack:
+                    parent = self._stack[-1]
+                    parent['_cuda_peak'] = max(parent['_cuda_peak'], cuda_peak)
+            self.stages.append(record)
+
+    def count(self, name, value, layer=None):
+        """
+        Record a counter. A tensor value is reduced with sum(), e.g. the number of active strokes of a decision map.
+        """
+        if layer is None and self._stack:
+            layer = self._stack[-1]['layer']
+        import torch
+        if torch.is_tensor(value):
+            value = value.sum().item()
+        self.counters.append({'name': name, 'layer': layer, 'value': value,
+                              'time_ms': (time.perf_counter() - self._origin) * 1e3})
+
+    def summary(self):
+        """
+        Aggregate stages by name and layer.
+
+        Returns:
+            A list of dicts with name, layer, calls, total and max wall time, sorted by total wall time.
+        """
+        totals = {}
+        for record in self.stages:
+            key = (record['name'], record['layer'])
+            entry = totals.setdefault(key, {'name': record['name'], 'layer': record['layer'], 'calls': 0,
+                                            'total_ms': 0., 'max_ms': 0.})
+            entry['calls'] += 1
+            entry['total_ms'] += record['wall_ms']
+            entry['max_ms'] = max(entry['max_ms'], record['wall_ms'])
+        return sorted(totals.values(), key=lambda entry: -entry['total_ms'])
+
+    def to_dict(self):
+        return {'stages': sorted(self.stages, key=lambda record: record['start_ms']),
+                'counters': list(self.counters),
+                'summary': self.summary()}
+
+    def to_chrome_trace(self):
+        """
+        Convert the records to the Chrome trace event format.
+        """
+        pid = os.getpid()
+        events = []
+        for record in self.stages:
+            args = {key: value for key, value in record.items()
+                    if key not in ('name', 'start_ms', 'wall_ms', 'tid') and value is not None}
+            events.append({'name': record['name'] if record['layer'] is None
+                           else '%s [layer %s]' % (record['name'], record['layer']),
+                           'cat': 'paint', 'ph': 'X', 'pid': pid, 'tid': record['tid'],
+                           'ts': record['start_ms'] * 1e3, 'dur': record['wall_ms'] * 1e3, 'args': args})
+        for counter in self.counters:
+            events.append({'name': counter['name'], 'cat': 'paint', 'ph': 'C', 'pid': pid,
+                           'ts': counter['time_ms'] * 1e3, 'args': {counter['name']: counter['value']}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def save_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome_trace(), f)
+
+
+def current():
+    """
+    Return the profiler activated for the current thread or task, or None.
+    """
+    return _current.get()
+
+
+def activate(profiler):
+    """
+    Like Profiler.activate, but accepts None to leave profiling disabled.
+    """
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.activate()
+
+
+def stage(name, layer=None):
+    """
+    Open a stage on the active profiler. Without one, this is a no-op context manager.
+    """
+    profiler = _current.get()
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(name, layer)
+
+
+def count(name, value, layer=None):
+    """
+    Record a counter on the active profiler. Without one, value is not evaluated.
+    """
+    profiler = _current.get()
+    if profiler is not None:
+        profiler.count(name, value, layer)